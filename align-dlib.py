@@ -15,18 +15,30 @@
 # limitations under the License.
 
 import argparse
+from collections import deque
 import cv2
 import dlib
+import multiprocessing
 import numpy as np
 from numpy.linalg import inv
 import os
 import random
 import shutil
+import sys
+import time
 
 import openface
 import openface.helper
 from openface.data import iterImgs
 
+import metricas
+from landmark_cache import LandmarkCache, imageKey
+from prefetch_reader import PrefetchReader
+from shard_store import ShardWriter
+from corpus_split import parseShard, filtraShard, shardDe
+from face_scan import leManifesto
+from warp_engines import warpLoop, warpNumpy, warpCv2, NUMPY_TOLERANCE
+
 TEMPLATE = np.float32([
                        (0.0792396913815, 0.339223741112), (0.0829219487236, 0.456955367943),
                        (0.0967927109165, 0.575648016728), (0.122141515615, 0.691921601066),
@@ -91,15 +103,27 @@ class AlignDlib:
     #: Landmark indices corresponding to the outer eyes and nose.
     OUTER_EYES_AND_NOSE = [36, 45, 33]
 
-    def __init__(self, facePredictor):
+    #: Resampling engines accepted by `AlignDlib` (see `warpLoop`, `warpNumpy`, `warpCv2`).
+    ENGINES = ['loop', 'numpy', 'cv2']
+
+    def __init__(self, facePredictor, engine='numpy', cache=None):
         """
         Instantiate an 'AlignDlib' object.
 
         :param facePredictor: The path to dlib's
         :type facePredictor: str
+        :param engine: How `align` resamples the face: 'loop' (per-pixel reference), \
+                       'numpy' (vectorized, same output) or 'cv2' (one warpAffine call).
+        :type engine: str
+        :param cache: Optional on-disk cache of boxes and landmarks, \
+                      consulted before running dlib.
+        :type cache: LandmarkCache
         """
         assert facePredictor is not None
+        assert engine in self.ENGINES
 
+        self.engine = engine
+        self.cache = cache
         self.detector = dlib.get_frontal_face_detector()
         self.predictor = dlib.shape_predictor(facePredictor)
 
@@ -114,13 +138,27 @@ class AlignDlib:
         """
         assert rgbImg is not None
 
+        if self.cache is not None:
+            imgKey = imageKey(rgbImg)
+            boxes = self.cache.getBoxes(imgKey)
+            if boxes is not None:
+                faces = dlib.rectangles()
+                for b in boxes:
+                    faces.append(dlib.rectangle(*b))
+                return faces
+
         try:
-            return self.detector(rgbImg, 1)
+            with metricas.tempo("dlib_detect"):
+                faces = self.detector(rgbImg, 1)
         except Exception as e:
             print("Warning: {}".format(e))
             # In rare cases, exceptions are thrown.
             return []
 
+        if self.cache is not None:
+            self.cache.putBoxes(imgKey, [rectToTuple(bb) for bb in faces])
+        return faces
+
     def getLargestFaceBoundingBox(self, rgbImg):
         """
         Find the largest face bounding box in an image.
@@ -152,8 +190,19 @@ class AlignDlib:
         assert rgbImg is not None
         assert bb is not None
 
-        points = self.predictor(rgbImg, bb)
-        return list(map(lambda p: (p.x, p.y), points.parts()))
+        if self.cache is not None:
+            imgKey = imageKey(rgbImg)
+            landmarks = self.cache.getLandmarks(imgKey, rectToTuple(bb))
+            if landmarks is not None:
+                return landmarks
+
+        with metricas.tempo("landmarks"):
+            points = self.predictor(rgbImg, bb)
+            landmarks = list(map(lambda p: (p.x, p.y), points.parts()))
+
+        if self.cache is not None:
+            self.cache.putLandmarks(imgKey, rectToTuple(bb), landmarks)
+        return landmarks
 
     def align(self, imgDim, rgbImg, bb=None,
               landmarks=None, landmarkIndices=INNER_EYES_AND_BOTTOM_LIP):
@@ -188,53 +237,160 @@ class AlignDlib:
         if landmarks is None:
             landmarks = self.findLandmarks(rgbImg, bb)
 
-        npLandmarks = np.float32(landmarks)
+        H = transformMatrix(landmarks, landmarkIndices)
+
+        with metricas.tempo("warp"):
+            if self.engine == 'loop':
+                return warpLoop(rgbImg, H, imgDim)
+            elif self.engine == 'cv2':
+                return warpCv2(rgbImg, H, imgDim)
+            else:
+                return warpNumpy(rgbImg, H, imgDim)
+
+    def alignBatch(self, imgDim, rgbImgsOrBoxes, landmarkIndices=INNER_EYES_AND_BOTTOM_LIP,
+                   allFaces=False):
+        r"""alignBatch(imgDim, rgbImgsOrBoxes, landmarkIndices=INNER_EYES_AND_BOTTOM_LIP, allFaces=False)
+
+        Transform and align several faces into one preallocated array.
+
+        :param imgDim: The edge length in pixels of the square the images are resized to.
+        :type imgDim: int
+        :param rgbImgsOrBoxes: RGB images, or (rgbImg, bb) pairs when the \
+                               bounding boxes are already known.
+        :type rgbImgsOrBoxes: list of numpy.ndarray or list of (numpy.ndarray, dlib.rectangle)
+        :param landmarkIndices: The indices to transform to.
+        :type landmarkIndices: list of ints
+        :param allFaces: For plain images, align every face found instead of \
+                         only the largest one.
+        :type allFaces: bool
+        :return: The aligned RGB faces, shape (N, imgDim, imgDim, 3), and for \
+                 each face the index of its source in `rgbImgsOrBoxes` and its box.
+        :rtype: (numpy.ndarray, list of (int, dlib.rectangle))
+        """
+        assert imgDim is not None
+        assert rgbImgsOrBoxes is not None
+        assert landmarkIndices is not None
+
+        faces = []
+        for i, item in enumerate(rgbImgsOrBoxes):
+            if isinstance(item, tuple):
+                rgbImg, bb = item
+                bbs = [bb]
+            else:
+                rgbImg = item
+                if allFaces:
+                    bbs = self.getAllFaceBoundingBoxes(rgbImg)
+                else:
+                    bb = self.getLargestFaceBoundingBox(rgbImg)
+                    bbs = [bb] if bb is not None else []
+            for bb in bbs:
+                faces.append((i, rgbImg, bb))
+
+        thumbnails = np.zeros((len(faces), imgDim, imgDim, 3), np.uint8)
+        if len(faces) == 0:
+            return thumbnails, []
+
         npLandmarkIndices = np.array(landmarkIndices)
+        fidPoints = np.float32([np.float32(self.findLandmarks(rgbImg, bb))[npLandmarkIndices]
+                                for (i, rgbImg, bb) in faces])
+        Hs = transformMatrices(fidPoints)
+
+        for n, (i, rgbImg, bb) in enumerate(faces):
+            if self.engine == 'loop':
+                thumbnails[n] = warpLoop(rgbImg, Hs[n], imgDim)
+            elif self.engine == 'cv2':
+                thumbnails[n] = warpCv2(rgbImg, Hs[n], imgDim)
+            else:
+                warpNumpy(rgbImg, Hs[n], imgDim, out=thumbnails[n])
+
+        return thumbnails, [(i, bb) for (i, rgbImg, bb) in faces]
+
+
+def rectToTuple(bb):
+    """
+    :param bb: Bounding box.
+    :type bb: dlib.rectangle
+    :return: (left, top, right, bottom)
+    :rtype: tuple of ints
+    """
+    return (int(bb.left()), int(bb.top()), int(bb.right()), int(bb.bottom()))
+
+
+def haarToRect(box, shape):
+    """
+    Convert a Haar cascade box into the dlib box used by the shape predictor.
+
+    :param box: (x, y, width, height), as in the face_detect_rotation manifest.
+    :type box: sequence of ints
+    :param shape: Shape of the image the box refers to.
+    :type shape: tuple
+    :return: The box, or None if it does not fit inside the image.
+    :rtype: dlib.rectangle
+    """
+    x, y, w, h = [int(v) for v in box]
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > shape[1] or y + h > shape[0]:
+        return None
+    return dlib.rectangle(x, y, x + w - 1, y + h - 1)
+
+
+def loadHaarBoxes(manifests):
+    """
+    Read the face boxes written by face_detect_rotation.
+
+    :param manifests: manifesto_*.jsonl files (one per shard, if sharded).
+    :type manifests: list of str
+    :return: Image name without extension -> (x, y, width, height) in the crop.
+    :rtype: dict
+    """
+    boxes = {}
+    for manifest in manifests:
+        for entry in leManifesto(manifest)[0]:
+            if entry.get('caixa') is not None:
+                boxes[os.path.splitext(entry['nome'])[0]] = entry['caixa']
+    return boxes
+
+
+def transformMatrix(landmarks, landmarkIndices):
+    """
+    Affine matrix from output (thumbnail) pixel coordinates to input pixel coordinates.
+
+    :param landmarks: Detected landmark locations.
+    :type landmarks: list of (x,y) tuples
+    :param landmarkIndices: The indices to transform to.
+    :type landmarkIndices: list of ints
+    :return: Transformation matrix. Shape: (2, 3)
+    :rtype: numpy.ndarray
+    """
+    npLandmarks = np.float32(landmarks)
+    npLandmarkIndices = np.array(landmarkIndices)
+
+    fidPoints = npLandmarks[npLandmarkIndices]
+    templateMat = INV_TEMPLATE
+
+    #create transformation matrix from output pixel coordinates to input pixel coordinates
+    H = np.zeros((2,3), dtype=np.float32)
+    for i in range(3):
+        H[0][i] = fidPoints[0][0] * templateMat[0][i] + fidPoints[1][0] * templateMat[1][i] + fidPoints[2][0] * templateMat[2][i]
+        H[1][i] = fidPoints[0][1] * templateMat[0][i] + fidPoints[1][1] * templateMat[1][i] + fidPoints[2][1] * templateMat[2][i]
+    return H
+
+
+def transformMatrices(fidPoints):
+    """
+    `transformMatrix` for N faces at once, with the same float32 operation
+    order so each matrix matches the single-face one exactly.
+
+    :param fidPoints: The three fiducial points of each face. Shape: (N, 3, 2)
+    :type fidPoints: numpy.ndarray
+    :return: Transformation matrices. Shape: (N, 2, 3)
+    :rtype: numpy.ndarray
+    """
+    fidPoints = np.float32(fidPoints)
+    templateMat = INV_TEMPLATE
+    return (fidPoints[:, 0, :, None] * templateMat[0] +
+            fidPoints[:, 1, :, None] * templateMat[1] +
+            fidPoints[:, 2, :, None] * templateMat[2])
 
-        fidPoints = npLandmarks[npLandmarkIndices]
-        templateMat = INV_TEMPLATE
-
-        #create transformation matrix from output pixel coordinates to input pixel coordinates
-        H = np.zeros((2,3), dtype=np.float32)
-        for i in range(3):
-            H[0][i] = fidPoints[0][0] * templateMat[0][i] + fidPoints[1][0] * templateMat[1][i] + fidPoints[2][0] * templateMat[2][i]
-            H[1][i] = fidPoints[0][1] * templateMat[0][i] + fidPoints[1][1] * templateMat[1][i] + fidPoints[2][1] * templateMat[2][i]
-
-        print H
-        print fidPoints
-        print npLandmarkIndices
-        imgWidth = np.shape(rgbImg)[0]
-        imgHeight = np.shape(rgbImg)[1]
-        thumbnail = np.zeros((imgDim, imgDim,3), np.uint8)
-
-        #interpolation from input image to output pixels using transformation mat H to compute
-        #which input coordinates map to output
-        for y in range(imgDim):
-            for x in range(imgDim):
-                xprime = x * H[0][1] + y * H[0][0] + H[0][2]
-                yprime = x * H[1][1] + y * H[1][0] + H[1][2]
-                tx = int(xprime)
-                ty = int(yprime)
-                horzOffset = 1
-                vertOffset = 1
-                if(tx < 0 or tx >= imgWidth or ty < 0 or ty >= imgHeight):
-                    continue
-                if(tx == imgWidth - 1):
-                    horzOffset = 0
-                if(ty == imgHeight - 1):
-                    vertOffset = 0
-                f1 = xprime - float(tx)
-                f2 = yprime - float(ty)
-                upperLeft = rgbImg[ty][tx]
-                upperRight = rgbImg[ty][tx + horzOffset]
-                bottomLeft = rgbImg[ty + vertOffset][tx]
-                bottomRight = rgbImg[ty + vertOffset][tx + horzOffset]
-
-                thumbnail[x][y][0] = upperLeft[0] * (1.0 - f1) * (1.0 - f2) + upperRight[0] * f1 * (1.0 - f2) + bottomLeft[0] * (1.0 - f1) * f2 + bottomRight[0] * f1 * f2
-                thumbnail[x][y][1] = upperLeft[1] * (1.0 - f1) * (1.0 - f2) + upperRight[1] * f1 * (1.0 - f2) + bottomLeft[1] * (1.0 - f1) * f2 + bottomRight[1] * f1 * f2
-                thumbnail[x][y][2] = upperLeft[2] * (1.0 - f1) * (1.0 - f2) + upperRight[2] * f1 * (1.0 - f2) + bottomLeft[2] * (1.0 - f1) * f2 + bottomRight[2] * f1 * f2
-
-        return thumbnail
 
 fileDir = os.path.dirname(os.path.realpath(__file__))
 modelDir = os.path.join(fileDir, '..', 'models')
@@ -252,24 +408,185 @@ def write(vals, fName):
             f.write("\n")
 
 
-def computeMeanMain(args):
-    align = openface.AlignDlib(args.dlibFacePredictor)
+class RunningStats:
+    """
+    Online mean and variance of fixed-shape arrays, in constant memory.
 
-    imgs = list(iterImgs(args.inputDir))
-    if args.numImages > 0:
-        imgs = random.sample(imgs, args.numImages)
+    Single samples are added with Welford's update; partial results from
+    other workers are combined with the parallel (Chan et al.) merge, so
+    the order in which chunks arrive does not matter.
+    """
 
-    facePoints = []
-    for img in imgs:
-        rgb = img.getRGB()
-        bb = align.getLargestFaceBoundingBox(rgb)
-        alignedPoints = align.align(rgb, bb)
-        if alignedPoints:
-            facePoints.append(alignedPoints)
+    def __init__(self, shape=None):
+        self.n = 0
+        self.mean = None if shape is None else np.zeros(shape)
+        self.m2 = None if shape is None else np.zeros(shape)
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (float(other.n) / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (float(self.n) * other.n / n)
+        self.n = n
+
+    def std(self):
+        """
+        Population standard deviation, like `np.std`.
+        """
+        return np.sqrt(self.m2 / max(self.n, 1))
+
+
+def reservoirSample(iterable, k, rng=random):
+    """
+    Uniform sample of `k` items from an iterable of unknown length,
+    holding only `k` items at a time (Algorithm R).
+    """
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            sample.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                sample[j] = item
+    return sample
+
+
+def normalizedLandmarks(align, rgbImg):
+    """
+    Landmarks of the largest face, relative to its bounding box
+    (0..1 inside the box), the frame `TEMPLATE` is expressed in.
+
+    :return: Array of shape (68, 2), or None if no face was found.
+    :rtype: numpy.ndarray
+    """
+    bb = align.getLargestFaceBoundingBox(rgbImg)
+    if bb is None:
+        return None
+    points = np.float64(align.findLandmarks(rgbImg, bb))
+    origin = np.float64([bb.left(), bb.top()])
+    size = np.float64([max(bb.width(), 1), max(bb.height(), 1)])
+    return (points - origin) / size
+
+
+# AlignDlib of each computeMean worker process.
+meanWorkerAlign = None
+
+
+def initMeanWorker(facePredictor, cachePath, withMetrics=False):
+    global meanWorkerAlign
+    cv2.setNumThreads(1)
+    if withMetrics:
+        # Workers only accumulate; the parent merges and writes.
+        metricas.configura(None)
+    # Every worker writes to the same file: commit each write so no worker
+    # keeps the write lock for a whole chunk.
+    cache = LandmarkCache(cachePath, facePredictor, commitEvery=1) if cachePath else None
+    meanWorkerAlign = AlignDlib(facePredictor, cache=cache)
+
+
+def landmarkStatsOfChunk(paths):
+    """
+    Worker task: statistics of one chunk of images, merged by the parent.
+
+    :return: (RunningStats, metric deltas or None)
+    """
+    stats = RunningStats()
+    for path in paths:
+        bgr = cv2.imread(path)
+        if bgr is None:
+            continue
+        points = normalizedLandmarks(meanWorkerAlign, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+        if points is not None:
+            stats.add(points)
+    return stats, metricas.deltas()
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def computeMeanMain(args):
+    """
+    Mean and standard deviation of the normalized landmarks over inputDir.
+
+    Images are streamed: only the running statistics (and, with
+    --numImages, the reservoir of sampled paths) are kept in memory.
+    """
+    openface.helper.mkdirP(args.modelDir)
 
-    facePointsNp = np.array(facePoints)
-    mean = np.mean(facePointsNp, axis=0)
-    std = np.std(facePointsNp, axis=0)
+    paths = (img.path for img in iterImgs(args.inputDir))
+    if args.shard is not None:
+        paths = (path for path in paths
+                 if shardDe(os.path.relpath(path, args.inputDir), args.shard[1]) == args.shard[0])
+    if args.numImages > 0:
+        paths = reservoirSample(paths, args.numImages)
+
+    stats = RunningStats()
+    if args.workers <= 1:
+        align = AlignDlib(args.dlibFacePredictor,
+                          cache=LandmarkCache(args.cache, args.dlibFacePredictor) if args.cache else None)
+        reader = PrefetchReader(((path, path) for path in paths),
+                                lambda path: cv2.imread(path), emVoo=args.prefetch)
+        for path, bgr in reader:
+            if bgr is None:
+                continue
+            points = normalizedLandmarks(align, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+            if points is not None:
+                stats.add(points)
+            metricas.gravaPeriodico()
+        if align.cache is not None:
+            align.cache.close()
+    else:
+        # At most 2 chunks per worker in flight, so paths are never all queued.
+        pool = multiprocessing.Pool(args.workers, initMeanWorker,
+                                    (args.dlibFacePredictor, args.cache, metricas.ativo))
+        pending = deque()
+
+        def mergeNext():
+            chunkStats, deltas = pending.popleft().get()
+            stats.merge(chunkStats)
+            metricas.mescla(deltas)
+            metricas.gravaPeriodico()
+
+        for chunk in chunks(paths, args.chunkSize):
+            pending.append(pool.apply_async(landmarkStatsOfChunk, (chunk,)))
+            while len(pending) >= 2 * args.workers:
+                mergeNext()
+        while pending:
+            mergeNext()
+        pool.close()
+        pool.join()
+
+    if stats.n == 0:
+        print("No faces found in {}.".format(args.inputDir))
+        sys.exit(1)
+    print("Landmarks of {} faces.".format(stats.n))
+
+    mean = stats.mean
+    std = stats.std()
 
     write(mean, "{}/mean.csv".format(args.modelDir))
     write(std, "{}/std.csv".format(args.modelDir))
@@ -292,6 +609,9 @@ def alignMain(args):
 
     imgs = list(iterImgs(args.inputDir))
 
+    # With --shard i/N each machine keeps a disjoint, stable part of the corpus.
+    imgs = filtraShard(imgs, args.shard, lambda img: os.path.relpath(img.path, args.inputDir))
+
     # Shuffle so multiple versions can be run at once.
     random.shuffle(imgs)
 
@@ -302,27 +622,63 @@ def alignMain(args):
     else:
         raise Exception("Landmarks unrecognized: {}".format(args.landmarks))
 
-    align = AlignDlib(args.dlibFacePredictor)
+    cache = LandmarkCache(args.cache, args.dlibFacePredictor) if args.cache else None
+    align = AlignDlib(args.dlibFacePredictor, engine=args.engine, cache=cache)
+
+    # With --shards the faces are appended to .npy shards under outputDir
+    # instead of one PNG each.
+    shards = ShardWriter(args.outputDir, (args.size, args.size, 3)) if args.shards else None
+
+    def outputName(imgObject):
+        return os.path.join(args.outputDir, imgObject.cls, imgObject.name) + ".png"
+
+    # Faces already found by the Haar cascade in face_detect_rotation: the
+    # box goes straight to the shape predictor and the HOG detector (with
+    # upsampling, the costliest step after the warp) only runs without one.
+    haarBoxes = loadHaarBoxes(args.boxes) if args.boxes else {}
+    nHaar = 0
+    nHog = 0
+
+    def alreadyDone(imgObject):
+        if shards is not None:
+            return shards.contem(imgObject.name, imgObject.cls)
+        return os.path.isfile(outputName(imgObject))
+
+    def loadRGB(imgObject):
+        # Already aligned images are not decoded at all.
+        if alreadyDone(imgObject):
+            return None
+        with metricas.tempo("decode"):
+            return imgObject.getRGB()
 
     nFallbacks = 0
-    for imgObject in imgs:
+    reader = PrefetchReader([(imgObject, imgObject) for imgObject in imgs], loadRGB,
+                            emVoo=args.prefetch)
+    for imgObject, rgb in reader:
         print("=== {} ===".format(imgObject.path))
         outDir = os.path.join(args.outputDir, imgObject.cls)
-        openface.helper.mkdirP(outDir)
+        if shards is None:
+            openface.helper.mkdirP(outDir)
         outputPrefix = os.path.join(outDir, imgObject.name)
         imgName = outputPrefix + ".png"
 
-        if os.path.isfile(imgName):
+        if alreadyDone(imgObject):
             if args.verbose:
                 print("  + Already found, skipping.")
         else:
-            rgb = imgObject.getRGB()
+            bb = None
             if rgb is None:
                 if args.verbose:
                     print("  + Unable to load.")
                 outRgb = None
             else:
-                outRgb = align.align(args.size, rgb,
+                if imgObject.name in haarBoxes:
+                    bb = haarToRect(haarBoxes[imgObject.name], rgb.shape)
+                if bb is not None:
+                    nHaar += 1
+                else:
+                    nHog += 1
+                outRgb = align.align(args.size, rgb, bb=bb,
                                      landmarkIndices=landmarkIndices)
                 if outRgb is None and args.verbose:
                     print("  + Unable to align.")
@@ -332,31 +688,130 @@ def alignMain(args):
                 deepFunneled = "{}/{}.jpg".format(os.path.join(args.fallbackLfw,
                                                                imgObject.cls),
                                                   imgObject.name)
-                shutil.copy(deepFunneled, "{}/{}.jpg".format(os.path.join(args.outputDir,
-                                                                          imgObject.cls),
-                                                             imgObject.name))
+                if shards is not None:
+                    # No class folders in shard mode: the fallback goes into
+                    # the shards too, at the thumbnail size they hold.
+                    fallbackBgr = cv2.imread(deepFunneled)
+                    if fallbackBgr is None:
+                        print("  + Unable to load fallback {}.".format(deepFunneled))
+                    else:
+                        if fallbackBgr.shape[:2] != (args.size, args.size):
+                            fallbackBgr = cv2.resize(fallbackBgr, (args.size, args.size),
+                                                     interpolation=cv2.INTER_AREA)
+                        with metricas.tempo("write"):
+                            shards.adiciona(imgObject.name, fallbackBgr, imgObject.cls)
+                else:
+                    shutil.copy(deepFunneled, "{}/{}.jpg".format(os.path.join(args.outputDir,
+                                                                              imgObject.cls),
+                                                                 imgObject.name))
 
             if outRgb is not None:
                 if args.verbose:
                     print("  + Writing aligned file to disk.")
                 outBgr = cv2.cvtColor(outRgb, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(imgName, outBgr)
+                with metricas.tempo("write"):
+                    if shards is not None:
+                        shards.adiciona(imgObject.name, outBgr, imgObject.cls)
+                    else:
+                        cv2.imwrite(imgName, outBgr)
+            metricas.conta("aligned", result="ok" if outRgb is not None else "fail",
+                           box="haar" if bb is not None else "hog")
+        metricas.gravaPeriodico()
 
     if args.fallbackLfw:
         print('nFallbacks:', nFallbacks)
 
+    if args.boxes:
+        print("Face boxes: {} from the Haar manifest, {} from the HOG detector.".format(nHaar, nHog))
+
+    if shards is not None:
+        shards.close()
+
+    if cache is not None:
+        cache.close()
+        print("Landmark cache: {} hits, {} misses.".format(cache.hits, cache.misses))
+
+
+def compareEnginesMain(args):
+    """
+    Regression check: run every engine on the same transform and compare
+    against the per-pixel reference. Exits non-zero if 'numpy' differs by
+    more than `--tolerance` on any pixel. Needs dlib and real faces; the
+    same comparison on synthetic data runs with `python warp_engines.py`.
+    """
+    align = AlignDlib(args.dlibFacePredictor)
+
+    imgs = list(iterImgs(args.inputDir))
+    if args.numImages > 0:
+        imgs = imgs[:args.numImages]
+
+    engines = [('numpy', warpNumpy), ('cv2', warpCv2)]
+    times = dict((name, 0.0) for name in ['loop'] + [e[0] for e in engines])
+    maxDiffs = dict((e[0], 0) for e in engines)
+    nCompared = 0
+    nFailed = 0
+    for imgObject in imgs:
+        rgb = imgObject.getRGB()
+        if rgb is None:
+            continue
+        bb = align.getLargestFaceBoundingBox(rgb)
+        if bb is None:
+            continue
+        H = transformMatrix(align.findLandmarks(rgb, bb), AlignDlib.INNER_EYES_AND_BOTTOM_LIP)
+
+        start = time.time()
+        reference = warpLoop(rgb, H, args.size)
+        times['loop'] += time.time() - start
+
+        for name, warp in engines:
+            start = time.time()
+            out = warp(rgb, H, args.size)
+            times[name] += time.time() - start
+            diff = np.abs(reference.astype(np.int16) - out).max()
+            maxDiffs[name] = max(maxDiffs[name], diff)
+            if name == 'numpy' and diff > args.tolerance:
+                nFailed += 1
+                print("  + {}: numpy engine differs by {}".format(imgObject.path, diff))
+        nCompared += 1
+
+    print("Compared {} faces at {}px.".format(nCompared, args.size))
+    for name in ['loop'] + [e[0] for e in engines]:
+        perFace = times[name] / max(nCompared, 1)
+        print("  {:6s} {:.5f}s/face  max diff vs loop: {}".format(
+            name, perFace, maxDiffs.get(name, 0)))
+
+    if nFailed > 0:
+        sys.exit(1)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('inputDir', type=str, help="Input image directory.")
     parser.add_argument('--dlibFacePredictor', type=str, help="Path to dlib's face predictor.",
                         default=os.path.join(dlibModelDir, "shape_predictor_68_face_landmarks.dat"))
+    parser.add_argument('--shard', type=parseShard,
+                        help="i/N: align only part i of N of the images (hash of the relative path).")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="Images decoded ahead on background threads (caps memory use).")
+    parser.add_argument('--cache', type=str,
+                        help="SQLite file caching face boxes and landmarks by image content and predictor.")
+    parser.add_argument('--metrics', type=str,
+                        help="Record per-stage timings and write them to <METRICS>.json and "
+                        "<METRICS>.prom (Prometheus text format).")
+    parser.add_argument('--metricsInterval', type=float, default=30,
+                        help="Seconds between metric dumps.")
 
     subparsers = parser.add_subparsers(dest='mode', help="Mode")
     computeMeanParser = subparsers.add_parser(
         'computeMean', help='Compute the image mean of a directory of images.')
     computeMeanParser.add_argument('--numImages', type=int, help="The number of images. '0' for all images.",
                                    default=0)  # <= 0 ===> all imgs
+    computeMeanParser.add_argument('--modelDir', type=str, default=openfaceModelDir,
+                                   help="Where mean.csv, std.csv and mean.png are written.")
+    computeMeanParser.add_argument('--workers', type=int, default=1,
+                                   help="Worker processes, each with its own dlib models.")
+    computeMeanParser.add_argument('--chunkSize', type=int, default=64,
+                                   help="Images per worker task.")
     alignmentParser = subparsers.add_parser(
         'align', help='Align a directory of images.')
     alignmentParser.add_argument('landmarks', type=str,
@@ -369,13 +824,35 @@ if __name__ == '__main__':
     alignmentParser.add_argument('--fallbackLfw', type=str,
                                  help="If alignment doesn't work, fallback to copying the deep funneled version from this directory..")
     alignmentParser.add_argument('--verbose', action='store_true')
+    alignmentParser.add_argument('--shards', action='store_true',
+                                 help="Append the faces to (N, size, size, 3) .npy shards in outputDir "
+                                 "(see shard_store.py) instead of writing one PNG per face.")
+    alignmentParser.add_argument('--boxes', type=str, nargs='+',
+                                 help="manifesto_*.jsonl from face_detect_rotation: use its Haar box "
+                                 "for each crop and run the HOG detector only for images without one.")
+    alignmentParser.add_argument('--engine', type=str, choices=AlignDlib.ENGINES, default='numpy',
+                                 help="Resampling engine used to warp the face.")
+    compareParser = subparsers.add_parser(
+        'compareEngines', help='Check the resampling engines against the per-pixel reference.')
+    compareParser.add_argument('--size', type=int, help="Default image size.",
+                               default=96)
+    compareParser.add_argument('--numImages', type=int, help="The number of images. '0' for all images.",
+                               default=0)
+    compareParser.add_argument('--tolerance', type=int, default=NUMPY_TOLERANCE,
+                               help="Largest per-pixel difference accepted for the numpy engine "
+                                    "(default: warp_engines.NUMPY_TOLERANCE).")
 
     args = parser.parse_args()
+    if args.metrics:
+        metricas.configura(args.metrics, args.metricsInterval)
 
     if args.mode == 'computeMean':
         computeMeanMain(args)
+    elif args.mode == 'compareEngines':
+        compareEnginesMain(args)
     else:
         alignMain(args)
+    metricas.grava()
 
 # Pode utilizar usando os dois métodos abaixo:
 
@@ -0,0 +1,74 @@
+# ORDEM DOS ANGULOS NA BUSCA POR ROTACAO
+#
+# angle_scheduler.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# SEQUENCIA DA BUSCA ORIGINAL: ORIGINAL, PREDEFINIDOS E DE 30 EM 30 (COM REPETICOES)
+ANGULOS_ORIGINAIS = [0, 45, 90, 180, 270] + list(range(0, 300, 30))
+
+# A MESMA ORDEM SEM REPETIR, MAIS 300 E 330: E A BUSCA DE TODOS OS MODOS
+ANGULOS_BUSCA = []
+for angulo in ANGULOS_ORIGINAIS + [300, 330]:
+    if angulo not in ANGULOS_BUSCA:
+        ANGULOS_BUSCA.append(angulo)
+
+
+class AngleScheduler:
+    """
+    Decide em que ordem os angulos sao testados em cada documento.
+
+    Cada angulo aparece uma unica vez (a busca original repetia 0, 90, 180
+    e 270 e nunca chegava em 300 e 330). Com `adaptativo`, os angulos que
+    mais encontraram faces no lote passam para a frente da fila.
+
+    Tambem contabiliza as chamadas ao detector contra o que a busca
+    original teria feito para o mesmo resultado.
+    """
+
+    def __init__(self, adaptativo=False):
+        self.adaptativo = adaptativo
+        self.angulos = list(ANGULOS_BUSCA)
+        self.posicao = dict((angulo, i) for i, angulo in enumerate(self.angulos))
+        self.sucessos = dict((angulo, 0) for angulo in self.angulos)
+        self.qtdDocumentos = 0
+        self.qtdChamadas = 0
+        self.qtdChamadasOriginais = 0
+
+    def ordem(self):
+        if not self.adaptativo:
+            return list(self.angulos)
+        # MAIS SUCESSOS PRIMEIRO; EMPATE MANTEM A ORDEM ORIGINAL
+        return sorted(self.angulos, key=lambda a: (-self.sucessos[a], self.posicao[a]))
+
+    def registra(self, angulo, chamadas):
+        """
+        :param angulo: angulo em que a face foi encontrada, ou None.
+        :param chamadas: chamadas ao detector feitas no documento.
+        """
+        if angulo is not None and angulo in self.sucessos:
+            self.sucessos[angulo] += 1
+        self.qtdDocumentos += 1
+        self.qtdChamadas += chamadas
+        self.qtdChamadasOriginais += chamadasOriginais(angulo)
+
+    def economizadas(self):
+        return self.qtdChamadasOriginais - self.qtdChamadas
+
+    def resumo(self):
+        docs = max(self.qtdDocumentos, 1)
+        return ("CHAMADAS AO DETECTOR: {0} ({1:.2f} por doc), busca original: {2} ({3:.2f} por doc), "
+                "economizadas: {4} ({5:.2f} por doc)\nORDEM DOS ANGULOS: {6}\n").format(
+                self.qtdChamadas, float(self.qtdChamadas) / docs,
+                self.qtdChamadasOriginais, float(self.qtdChamadasOriginais) / docs,
+                self.economizadas(), float(self.economizadas()) / docs,
+                " ".join(str(a) for a in self.ordem()))
+
+
+def chamadasOriginais(angulo):
+    # NA BUSCA ORIGINAL, QUEM NAO ACHA (OU SO ACHARIA EM 300/330) PAGA AS 15 TENTATIVAS
+    if angulo in ANGULOS_ORIGINAIS:
+        return ANGULOS_ORIGINAIS.index(angulo) + 1
+    return len(ANGULOS_ORIGINAIS)
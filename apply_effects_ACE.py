@@ -1,4 +1,3 @@
-
 #!/usr/bin/python
 # atenuar efeitos de iluminacao (Apenas ACE)
 
@@ -8,36 +7,55 @@
 
 # EXECUTAR COM PYTHON 2 : python2 apply_effects_ACE.py
 
+import argparse
 import cv2, sys, glob, os, os.path, time
-from PIL import Image
-import colorcorrect.algorithm as cca
-from colorcorrect.util import from_pil, to_pil
+from effects import aplicaACE
+from effects_runner import executaEfeito
+import metricas
+from shard_store import ShardWriter
+from corpus_split import parseShard, filtraShard
 
 pastaEntrada = "../pessoas_224x224_crop_bruta/"
 pastaSaida = "../pessoas_224x224_ACE/"
 
-count = 1
-
-def applyEffectsACE(count, filename, file):
-    # print("{0} > apply ACE em {1}".format(count, pastaSaida + file))
-    nomeParaSalvar = pastaSaida + file
-    img = Image.open(filename)
-    img = to_pil(cca.automatic_color_equalization(from_pil(img)))
-    img.save(nomeParaSalvar)
-
-# PEGA PASTAS E SUBPASTAS
-
-for root, dirs, files in os.walk(pastaEntrada):
-    # TESTE
-    if count > 5:
-        break
-    for file in files:
-        filename = os.path.join(root, file)
-        if "_id" in filename or "_selfie" in filename:
-            with open(filename, "r") as auto:
-                applyEffectsACE(count, filename, file)
-                count = count + 1
-        else:
-            print("### REJEITADO: {0}".format(filename))
-
-print("QTD ARQUIVOS COPIADOS: {0}".format(count))
+motorACE = "rapido"  # "colorcorrect" para o ACE original (bem mais lento)
+
+def applyEffectsACE(bgr):
+    # O ACE TRATA OS CANAIS IGUAIS, ENTAO LER COM cv2 (BGR) DA O MESMO QUE COM PIL (RGB)
+    return aplicaACE(bgr, motorACE)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--processos", action="store_true",
+        help="usa processos em vez de threads")
+    ap.add_argument("--shard", type=parseShard,
+        help="i/N: processa so a parte i de N dos arquivos (hash do caminho relativo)")
+    ap.add_argument("--shards",
+        help="grava as imagens em shards .npy nesta pasta (shard_store.py) em vez de arquivos soltos")
+    ap.add_argument("--metricas",
+        help="grava o tempo de cada etapa em <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    args = vars(ap.parse_args())
+    if args["metricas"]:
+        metricas.configura(args["metricas"])
+    shards = ShardWriter(args["shards"]) if args["shards"] else None
+
+    # PEGA PASTAS E SUBPASTAS
+    tarefas = []
+    for root, dirs, files in os.walk(pastaEntrada):
+        # TESTE
+        if len(tarefas) >= 5:
+            break
+        for file in files:
+            filename = os.path.join(root, file)
+            if "_id" in filename or "_selfie" in filename:
+                tarefas.append((filename, pastaSaida + file))
+            else:
+                print("### REJEITADO: {0}".format(filename))
+
+    tarefas = filtraShard(tarefas, args["shard"], lambda t: os.path.relpath(t[0], pastaEntrada))
+    countOK, countFail = executaEfeito(applyEffectsACE, tarefas, "ACE", args["workers"], args["processos"], shards=shards)
+    if shards is not None:
+        shards.close()
+    print("QTD ARQUIVOS COPIADOS: {0}".format(countOK))
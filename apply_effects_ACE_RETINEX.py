@@ -6,38 +6,77 @@
 #   Johnatan Oliveira (johnoliv@gmail.com)
 #   www.johnatan.net
 
+import argparse
 import cv2, sys, glob, os, os.path, time
-from PIL import Image
-import colorcorrect.algorithm as cca
-from colorcorrect.util import from_pil, to_pil
+from effects import aplicaACE, aplicaRetinex
+from effects_runner import executaEfeito, copiaArquivos
+from illumination_analysis import analisaTarefas, carregaLimiares, LIMIARES_PADRAO, COMPLETO
+import metricas
+from shard_store import ShardWriter
+from corpus_split import parseShard, filtraShard
 
 pastaEntrada = "../pessoas_align_crop_inner/"
 pastaSaida = "../pessoas_align_crop_inner_effects/"
 
 prefixo1 = "doc1"
 prefixo2 = "selfie"
-count = 1
-
-def applyEffectsACE_RETINEX(count, filename, file):
-    print("{0} > apply ACE/RETINEX em {1}".format(count, filename))
-    chaveF = filename[28:36]
-    nomeParaSalvar = pastaSaida + chaveF + '_' + file
-    img = Image.open(filename)
-    img = to_pil(cca.automatic_color_equalization(from_pil(img)))
-    img = to_pil(cca.retinex(from_pil(img)))
-    img.save(nomeParaSalvar)
-
-
-# PEGA PASTAS E SUBPASTAS
-
-for root, dirs, files in os.walk(pastaEntrada):
-    # if count > 5:
-    #     break
-    for file in files:
-        filename = os.path.join(root, file)
-        if file.endswith(prefixo1,0,4) or file.endswith(prefixo2,0,6) :
-            with open(filename, "r") as auto:
-                applyEffectsACE_RETINEX(count, filename, file)
-                count = count + 1
+motorACE = "rapido"  # "colorcorrect" para o ACE original (bem mais lento)
+motorRetinex = "maximo"  # mesma saida do cca.retinex; "msr" para o multi-escala
+
+def applyEffectsACE_RETINEX(bgr):
+    # ENTRE OS EFEITOS A IMAGEM FICA EM NUMPY; LE E GRAVA UMA VEZ SO
+    return aplicaRetinex(aplicaACE(bgr, motorACE), motorRetinex)
+
+
+def semEfeito(bgr):
+    # --condicional COM --shards: FACE QUE NAO PRECISA DE ACE/RETINEX SEGUE COMO ESTA
+    # (SEM SHARDS O ARQUIVO E SO COPIADO, copiaArquivos)
+    return bgr
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--processos", action="store_true",
+        help="usa processos em vez de threads")
+    ap.add_argument("--shard", type=parseShard,
+        help="i/N: processa so a parte i de N dos arquivos (hash do caminho relativo)")
+    ap.add_argument("--shards",
+        help="grava as imagens em shards .npy nesta pasta (shard_store.py) em vez de arquivos soltos")
+    ap.add_argument("--condicional", action="store_true",
+        help="analisa a iluminacao de cada face e so aplica ACE/RETINEX onde precisa (illumination_analysis.py)")
+    ap.add_argument("--limiares",
+        help="--condicional: JSON com os limiares (chaves de illumination_analysis.LIMIARES_PADRAO)")
+    ap.add_argument("--ramos", default="ramos_iluminacao.jsonl",
+        help="--condicional: diario com o ramo de cada arquivo, lido depois pelo apply_effects_CLAHE.py --ramos")
+    ap.add_argument("--metricas",
+        help="grava o tempo de cada etapa em <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    args = vars(ap.parse_args())
+    if args["metricas"]:
+        metricas.configura(args["metricas"])
+    shards = ShardWriter(args["shards"]) if args["shards"] else None
+
+    # PEGA PASTAS E SUBPASTAS
+    tarefas = []
+    for root, dirs, files in os.walk(pastaEntrada):
+        for file in files:
+            filename = os.path.join(root, file)
+            if file.endswith(prefixo1,0,4) or file.endswith(prefixo2,0,6) :
+                chaveF = filename[28:36]
+                tarefas.append((filename, pastaSaida + chaveF + '_' + file))
+            else:
+                print("REJEITADO: {0}".format(filename))
+
+    tarefas = filtraShard(tarefas, args["shard"], lambda t: os.path.relpath(t[0], pastaEntrada))
+    if args["condicional"]:
+        limiares = carregaLimiares(args["limiares"]) if args["limiares"] else LIMIARES_PADRAO
+        ramos = analisaTarefas(tarefas, limiares, args["ramos"], args["workers"])
+        semACE = [tarefa for tarefa in tarefas if ramos.get(tarefa[1], COMPLETO) != COMPLETO]
+        tarefas = [tarefa for tarefa in tarefas if ramos.get(tarefa[1], COMPLETO) == COMPLETO]
+        if shards is None:
+            copiaArquivos(semACE, "SEM ACE/RETINEX")
         else:
-            print("REJEITADO: {0}".format(filename))
+            executaEfeito(semEfeito, semACE, "SEM ACE/RETINEX", args["workers"], args["processos"], shards=shards)
+    executaEfeito(applyEffectsACE_RETINEX, tarefas, "ACE/RETINEX", args["workers"], args["processos"], shards=shards)
+    if shards is not None:
+        shards.close()
@@ -6,34 +6,65 @@
 #   Johnatan Oliveira (johnoliv@gmail.com)
 #   www.johnatan.net
 
+import argparse
 import cv2, sys, os
+from effects import aplicaCLAHE
+from effects_runner import executaEfeito, copiaArquivos
+from illumination_analysis import leRamos, NENHUM
+import metricas
+from shard_store import ShardWriter
+from corpus_split import parseShard, filtraShard
 
 pastaEntrada = "../pessoas_effects_ace_retinex/"
 pastaSaida = "../pessoas_effects_final/"
 
 prefixo = "F"
-count = 1
-
-def applyEffectsCLAHE(count, file):
-    print("{0} > apply CLAHE em {1}".format(count, file))
-    nomeParaSalvar = pastaSaida + file
-
-    bgr = cv2.imread(pastaEntrada + file)
-    other = cv2.cvtColor(bgr, cv2.COLOR_BGR2YCR_CB)
-    lum = other[:, :, 0]
-    clahe = cv2.createCLAHE()
-    lum = clahe.apply(lum)
-    other[:, :, 0] = lum
-    bgr = cv2.cvtColor(other, cv2.COLOR_YCR_CB2BGR)
-    cv2.imwrite(nomeParaSalvar, bgr)
-
-
-for file in os.listdir( pastaEntrada ):
-    # if count > 5:
-    #     break
-    if file.endswith(prefixo,0,1) :
-        # print("arquivo: {0}".format(pastaEntrada + file))
-        applyEffectsCLAHE(count, file)
-        count = count + 1
-    else:
-        print("REJEITADO: {0}".format(file))
+
+def applyEffectsCLAHE(bgr):
+    # O CLAHE E CRIADO UMA VEZ POR THREAD (effects.claheDaThread)
+    return aplicaCLAHE(bgr)
+
+
+def semEfeito(bgr):
+    # SO COM --shards; SEM SHARDS O ARQUIVO E COPIADO (copiaArquivos)
+    return bgr
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4,
+        help="threads; o CLAHE do OpenCV solta o GIL")
+    ap.add_argument("--shard", type=parseShard,
+        help="i/N: processa so a parte i de N dos arquivos (hash do caminho relativo)")
+    ap.add_argument("--shards",
+        help="grava as imagens em shards .npy nesta pasta (shard_store.py) em vez de arquivos soltos")
+    ap.add_argument("--ramos",
+        help="diario do apply_effects_ACE_RETINEX.py --condicional: os arquivos do ramo "
+             "'nenhum' passam sem CLAHE")
+    ap.add_argument("--metricas",
+        help="grava o tempo de cada etapa em <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    args = vars(ap.parse_args())
+    if args["metricas"]:
+        metricas.configura(args["metricas"])
+    shards = ShardWriter(args["shards"]) if args["shards"] else None
+
+    tarefas = []
+    for file in os.listdir( pastaEntrada ):
+        if file.endswith(prefixo,0,1) :
+            # print("arquivo: {0}".format(pastaEntrada + file))
+            tarefas.append((pastaEntrada + file, pastaSaida + file))
+        else:
+            print("REJEITADO: {0}".format(file))
+
+    tarefas = filtraShard(tarefas, args["shard"], lambda t: os.path.relpath(t[0], pastaEntrada))
+    if args["ramos"]:
+        ramos = leRamos(args["ramos"])
+        semCLAHE = [tarefa for tarefa in tarefas if ramos.get(os.path.basename(tarefa[0])) == NENHUM]
+        tarefas = [tarefa for tarefa in tarefas if ramos.get(os.path.basename(tarefa[0])) != NENHUM]
+        if shards is None:
+            copiaArquivos(semCLAHE, "SEM CLAHE")
+        else:
+            executaEfeito(semEfeito, semCLAHE, "SEM CLAHE", args["workers"], shards=shards)
+    executaEfeito(applyEffectsCLAHE, tarefas, "CLAHE", args["workers"], shards=shards)
+    if shards is not None:
+        shards.close()
@@ -0,0 +1,387 @@
+# BENCHMARK DE TODAS AS ETAPAS COM ENTRADAS SINTETICAS
+#
+# benchmark_suite.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# NAO PRECISA DE DOCUMENTOS DE CLIENTES: OS DOCUMENTOS SAO FOLHAS COM "TEXTO"
+# E UM ROSTO DESENHADO (O CASCADE FRONTAL ENXERGA) EM TAMANHO E ANGULO
+# CONHECIDOS; AS FACES SAO RECORTES 224x224 DO MESMO DESENHO COM ILUMINACAO
+# VARIADA. COM A MESMA --semente AS ENTRADAS SAO AS MESMAS EM QUALQUER MAQUINA.
+#
+# python benchmark_suite.py roda --saida bench_antes.json
+# python benchmark_suite.py roda --saida bench_depois.json
+# python benchmark_suite.py compara bench_antes.json bench_depois.json --tolerancia 0.10
+# python benchmark_suite.py servico --documentos 10 --etapas detect,ace,retinex,clahe
+#
+# O RESULTADO (JSON) TEM, POR ETAPA, VAZAO E PERCENTIS DE LATENCIA; O compara
+# APONTA A ETAPA QUE FICOU MAIS LENTA E SAI COM CODIGO 1.
+
+import argparse
+import cv2, json, os, platform, shutil, sys, tempfile, threading, time
+import imutils
+import numpy as np
+from timeit import default_timer
+from face_detector import FaceDetector
+from face_scan import verificaImagem, buscaFace
+from effects import aplicaACE, aplicaRetinex, aplicaCLAHE
+from quality_gate import avaliaQualidade
+from illumination_analysis import analisaImagem, RAMOS
+
+ETAPAS = ["portao", "verificaImagem", "busca_exaustiva", "busca_coarse", "align", "iluminacao", "ace", "ace_retinex", "clahe"]
+
+# ANGULOS DOS DOCUMENTOS (ROTACAO HORARIA DO DOCUMENTO INTEIRO)
+ANGULOS_DOCUMENTO = [0, 90, 180, 270, 60]
+
+
+def rostoSintetico(lado, rng):
+    """
+    Rosto frontal desenhado (oval, olhos, sobrancelhas, nariz e boca), com
+    tom de pele e fundo sorteados. E detectado pelo haarcascade_frontalface.
+    """
+    fundo = int(rng.randint(170, 230))
+    img = np.full((lado, lado, 3), fundo, np.uint8)
+    c = lado // 2
+    pele = tuple(int(v) for v in rng.randint(90, 210, 3))
+    cv2.ellipse(img, (c, c), (int(lado * 0.36), int(lado * 0.46)), 0, 0, 360, pele, -1)
+    olhoY = int(lado * 0.40)
+    dx = int(lado * 0.16)
+    for lado_ in (-1, 1):
+        cv2.ellipse(img, (c + lado_ * dx, olhoY), (int(lado * 0.08), int(lado * 0.04)), 0, 0, 360, (40, 40, 40), -1)
+        cv2.line(img, (c + lado_ * dx - int(lado * 0.1), olhoY - int(lado * 0.09)),
+                 (c + lado_ * dx + int(lado * 0.1), olhoY - int(lado * 0.09)), (30, 30, 30), max(1, lado // 30))
+    nariz = tuple(int(v * 0.75) for v in pele)
+    cv2.ellipse(img, (c, int(lado * 0.58)), (int(lado * 0.04), int(lado * 0.08)), 0, 0, 360, nariz, -1)
+    cv2.ellipse(img, (c, int(lado * 0.72)), (int(lado * 0.14), int(lado * 0.04)), 0, 0, 360, (60, 60, 140), -1)
+    return cv2.GaussianBlur(img, (0, 0), lado / 80.0)
+
+
+def iluminacaoSintetica(bgr, rng):
+    # GRADIENTE DE LUZ E DOMINANTE DE COR, PARA OS EFEITOS TEREM O QUE CORRIGIR
+    h, w = bgr.shape[:2]
+    gradiente = np.linspace(rng.uniform(0.4, 0.8), rng.uniform(1.0, 1.4), w)[np.newaxis, :, np.newaxis]
+    dominante = rng.uniform(0.8, 1.2, 3)[np.newaxis, np.newaxis, :]
+    return np.uint8(np.clip(bgr * gradiente * dominante, 0, 255))
+
+
+def documentoSintetico(rng, ladoRosto, angulo, altura=1400, largura=1000, comRosto=True):
+    """
+    :param comRosto: False deixa so o "texto" (amostra negativa do detector_tuning.py).
+    :return: (documento BGR, caixa (x,y,w,h) do rosto antes da rotacao).
+    """
+    doc = np.full((altura, largura, 3), 235, np.uint8)
+    # LINHAS DE "TEXTO"
+    for y in range(60, altura - 40, 36):
+        x = 60
+        while x < largura - 120:
+            palavra = int(rng.randint(20, 90))
+            cv2.rectangle(doc, (x, y), (x + palavra, y + 12), (70, 70, 70), -1)
+            x += palavra + int(rng.randint(10, 25))
+    x = int(rng.randint(40, largura - ladoRosto - 40))
+    y = int(rng.randint(40, altura - ladoRosto - 40))
+    if comRosto:
+        doc[y:y + ladoRosto, x:x + ladoRosto] = rostoSintetico(ladoRosto, rng)
+    if angulo != 0:
+        doc = imutils.rotate_bound(doc, angulo)
+    return doc, (x, y, ladoRosto, ladoRosto)
+
+
+def geraEntradas(semente, quantidadeDocumentos, quantidadeFaces, minSize, ladoFace=224):
+    rng = np.random.RandomState(semente)
+    documentos = []
+    for i in range(quantidadeDocumentos):
+        angulo = ANGULOS_DOCUMENTO[i % len(ANGULOS_DOCUMENTO)]
+        ladoRosto = int(rng.randint(int(minSize * 1.5), 320))
+        doc, caixa = documentoSintetico(rng, ladoRosto, angulo)
+        documentos.append(("doc{0:03d}_{1}.jpg".format(i, angulo), doc, angulo))
+    faces = []
+    for i in range(quantidadeFaces):
+        faces.append(("face{0:03d}.png".format(i), iluminacaoSintetica(rostoSintetico(ladoFace, rng), rng)))
+    return documentos, faces
+
+
+def percentis(latencias):
+    latencias = np.array(latencias)
+    total = float(latencias.sum())
+    return {
+        'quantidade': int(len(latencias)),
+        'total': total,
+        'porSegundo': len(latencias) / total if total > 0 else None,
+        'media': float(latencias.mean()),
+        'p50': float(np.percentile(latencias, 50)),
+        'p90': float(np.percentile(latencias, 90)),
+        'p99': float(np.percentile(latencias, 99)),
+        'max': float(latencias.max()),
+    }
+
+
+def mede(funcao, itens, aquecimento=2, repeticoes=1):
+    """
+    Latencia de cada chamada `funcao(item)`; as primeiras `aquecimento`
+    chamadas (caches, carga de modelos) ficam de fora.
+
+    :return: (latencias, resultados da ultima repeticao)
+    """
+    for item in itens[:aquecimento]:
+        funcao(item)
+    latencias = []
+    resultados = []
+    for repeticao in range(repeticoes):
+        resultados = []
+        for item in itens:
+            inicio = default_timer()
+            resultados.append(funcao(item))
+            latencias.append(default_timer() - inicio)
+    return latencias, resultados
+
+
+def anguloCerto(encontrado, anguloDocumento, tolerancia=20):
+    # O DETECTOR GIRA NO SENTIDO HORARIO: O DOCUMENTO GIRADO DE a VOLTA EM 360 - a
+    diferenca = (encontrado + anguloDocumento) % 360
+    return min(diferenca, 360 - diferenca) <= tolerancia
+
+
+def rodaBusca(detector, documentos, opcoes, repeticoes):
+    latencias, resultados = mede(lambda d: buscaFace(detector, d[1], d[0], opcoes), documentos,
+                                 repeticoes=repeticoes)
+    resultado = percentis(latencias)
+    achados = [(r[0] >= 1, r[1]) for r in resultados]
+    resultado['encontrados'] = sum(1 for achou, angulo in achados if achou)
+    resultado['anguloCerto'] = sum(1 for (achou, angulo), d in zip(achados, documentos)
+                                   if achou and anguloCerto(angulo, d[2]))
+    resultado['chamadasDetector'] = int(sum(r[3] for r in resultados))
+    return resultado
+
+
+def rodaAlign(faces, facePredictor, tamanho, repeticoes):
+    try:
+        import dlib
+        from pipeline import carregaAlignDlib
+        alignDlib = carregaAlignDlib()
+        align = alignDlib.AlignDlib(facePredictor)
+    except (ImportError, IOError, RuntimeError) as e:
+        return {'pulado': str(e)}
+    rgbs = [cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB) for nome, bgr in faces]
+    # CAIXA CONHECIDA DO DESENHO (COMO NO --boxes): MEDE LANDMARKS + WARP
+    lado = rgbs[0].shape[0]
+    bb = dlib.rectangle(int(lado * 0.14), int(lado * 0.04), int(lado * 0.86), int(lado * 0.96))
+    latencias, resultados = mede(
+        lambda rgb: align.align(tamanho, rgb, bb=bb, landmarkIndices=alignDlib.AlignDlib.INNER_EYES_AND_BOTTOM_LIP),
+        rgbs, repeticoes=repeticoes)
+    return percentis(latencias)
+
+
+def roda(args):
+    etapas = [e.strip() for e in args["etapas"].split(",") if e.strip()]
+    for etapa in etapas:
+        if etapa not in ETAPAS:
+            raise ValueError("etapa desconhecida: {0} (use {1})".format(etapa, ",".join(ETAPAS)))
+    # UMA THREAD: OS NUMEROS NAO DEPENDEM DE QUANTOS NUCLEOS ESTAO LIVRES
+    if not args["threads"]:
+        cv2.setNumThreads(1)
+
+    inicio = time.time()
+    documentos, faces = geraEntradas(args["semente"], args["documentos"], args["faces"], args["minSize"])
+    print("entradas sinteticas: {0} documentos, {1} faces ({2:.1f}s)".format(
+        len(documentos), len(faces), time.time() - inicio))
+
+    detector = FaceDetector(args["cascPath"], args["minSize"])
+    resultados = {}
+    for etapa in etapas:
+        inicio = time.time()
+        if etapa == "portao":
+            # TODOS OS DOCUMENTOS SINTETICOS TEM FACE: NENHUM PODE SER BARRADO
+            latencias, saidas = mede(lambda d: avaliaQualidade(d[1], args["minSize"]), documentos,
+                                     repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+            resultados[etapa]['barrados'] = sum(1 for motivo in saidas if motivo is not None)
+        elif etapa == "verificaImagem":
+            # UMA TENTATIVA, JA NO ANGULO CERTO
+            latencias, saidas = mede(lambda d: verificaImagem(detector, d[1], d[0], (360 - d[2]) % 360),
+                                     documentos, repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+            resultados[etapa]['encontrados'] = sum(1 for qtd, saida in saidas if qtd >= 1)
+        elif etapa == "busca_exaustiva":
+            resultados[etapa] = rodaBusca(detector, documentos, {'busca': 'exaustiva'}, args["repeticoes"])
+        elif etapa == "busca_coarse":
+            resultados[etapa] = rodaBusca(detector, documentos, {'busca': 'coarse', 'ladoBusca': 800},
+                                          args["repeticoes"])
+        elif etapa == "align":
+            resultados[etapa] = rodaAlign(faces, args["dlibFacePredictor"], args["size"], args["repeticoes"])
+        elif etapa == "iluminacao":
+            latencias, saidas = mede(lambda f: analisaImagem(f[1]), faces, repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+            resultados[etapa]['ramos'] = dict((ramo, sum(1 for s in saidas if s['ramo'] == ramo)) for ramo in RAMOS)
+        elif etapa == "ace":
+            latencias, saidas = mede(lambda f: aplicaACE(f[1]), faces, repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+        elif etapa == "ace_retinex":
+            latencias, saidas = mede(lambda f: aplicaRetinex(aplicaACE(f[1])), faces, repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+        elif etapa == "clahe":
+            latencias, saidas = mede(lambda f: aplicaCLAHE(f[1]), faces, repeticoes=args["repeticoes"])
+            resultados[etapa] = percentis(latencias)
+        r = resultados[etapa]
+        if 'pulado' in r:
+            print("{0:16s} pulado: {1}".format(etapa, r['pulado']))
+        else:
+            print("{0:16s} {1:9.1f}/s  p50 {2:8.2f} ms  p90 {3:8.2f} ms  p99 {4:8.2f} ms  ({5:.1f}s)".format(
+                etapa, r['porSegundo'] or 0, r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000,
+                time.time() - inicio))
+
+    saida = {
+        'formato': 1,
+        'quando': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'ambiente': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'plataforma': platform.platform(),
+            'processador': platform.processor(),
+            'threadsOpenCV': cv2.getNumThreads(),
+        },
+        'parametros': dict((k, args[k]) for k in ("semente", "documentos", "faces", "repeticoes", "minSize", "size")),
+        'etapas': resultados,
+    }
+    with open(args["saida"], 'w') as f:
+        json.dump(saida, f, indent=1, sort_keys=True)
+    print("gravado em " + args["saida"])
+
+
+def servico(args):
+    """
+    Sobe o WatchService numa pasta temporaria, solta documentos sinteticos
+    la dentro (gravados como .tmp e renomeados, como um entregador deve
+    fazer) e mede a latencia de cada um, do arquivo pronto ate a saida.
+    """
+    from watch_service import WatchService
+    from pipeline import Pipeline, criaEtapas
+
+    nomesEtapas = [e.strip() for e in args["etapas"].split(",") if e.strip()]
+    opcoes = {'cascPath': args["cascPath"], 'minSize': args["minSize"], 'busca': args["busca"],
+              'ladoBusca': 800, 'facePredictor': args["dlibFacePredictor"], 'tamanho': args["size"]}
+    inicio = time.time()
+    pipeline = Pipeline(criaEtapas(nomesEtapas, opcoes))
+    print("modelos carregados em {0:.1f}s".format(time.time() - inicio))
+
+    documentos, faces = geraEntradas(args["semente"], args["documentos"], 0, args["minSize"])
+    raiz = tempfile.mkdtemp(prefix="watch_service_")
+    entrada = os.path.join(raiz, "entrada")
+    os.makedirs(entrada)
+    try:
+        servicoPasta = WatchService(pipeline, entrada, os.path.join(raiz, "saida"), intervalo=args["intervalo"])
+        thread = threading.Thread(target=servicoPasta.roda)
+        thread.start()
+        try:
+            for nome, doc, angulo in documentos:
+                temporario = os.path.join(entrada, nome + ".tmp")
+                # O cv2.imwrite ESCOLHE O FORMATO PELA EXTENSAO, QUE AQUI E .tmp
+                cv2.imencode(".jpg", doc)[1].tofile(temporario)
+                os.rename(temporario, os.path.join(entrada, nome))
+                time.sleep(args["espaco"])
+            # ESPERA OS ULTIMOS SAIREM DA PASTA DE ENTRADA
+            limite = time.time() + args["espera"]
+            while time.time() < limite and len(servicoPasta.latencias) < len(documentos):
+                time.sleep(0.05)
+        finally:
+            servicoPasta.para()
+            thread.join()
+        print(servicoPasta.resumo())
+        resultado = percentis(servicoPasta.latencias) if servicoPasta.latencias else {}
+        resultado['processados'] = len(servicoPasta.latencias)
+        resultado['enviados'] = len(documentos)
+        saida = {'formato': 1, 'quando': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 'parametros': dict((k, args[k]) for k in ("semente", "documentos", "etapas", "intervalo", "espaco")),
+                 'etapas': {'servico': resultado}}
+        with open(args["saida"], 'w') as f:
+            json.dump(saida, f, indent=1, sort_keys=True)
+        print("gravado em " + args["saida"])
+    finally:
+        shutil.rmtree(raiz, ignore_errors=True)
+
+
+def compara(args):
+    """
+    Compara a `metrica` (latencia) de cada etapa entre duas execucoes.
+
+    :return: quantidade de etapas que pioraram mais que a tolerancia.
+    """
+    with open(args["base"]) as f:
+        base = json.load(f)
+    with open(args["novo"]) as f:
+        novo = json.load(f)
+    if base.get('parametros') != novo.get('parametros'):
+        print("AVISO: parametros diferentes, as entradas nao sao as mesmas")
+    metrica = args["metrica"]
+    regressoes = 0
+    for etapa in ETAPAS:
+        a = base['etapas'].get(etapa)
+        b = novo['etapas'].get(etapa)
+        if not a or not b or metrica not in a or metrica not in b:
+            continue
+        razao = b[metrica] / a[metrica] if a[metrica] > 0 else float('inf')
+        marca = ""
+        if razao > 1 + args["tolerancia"]:
+            marca = "  REGRESSAO"
+            regressoes += 1
+        elif razao < 1 - args["tolerancia"]:
+            marca = "  melhorou"
+        print("{0:16s} {1} {2:9.2f} ms -> {3:9.2f} ms  ({4:+.1f}%){5}".format(
+            etapa, metrica, a[metrica] * 1000, b[metrica] * 1000, (razao - 1) * 100, marca))
+        for chave in ('encontrados', 'anguloCerto'):
+            if chave in a and chave in b and a[chave] != b[chave]:
+                print("{0:16s} {1}: {2} -> {3}  MUDOU".format("", chave, a[chave], b[chave]))
+                regressoes += 1
+    return regressoes
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    modos = ap.add_subparsers(dest="modo")
+    apRoda = modos.add_parser("roda", help="gera as entradas e mede as etapas")
+    apRoda.add_argument("--saida", default="benchmark.json", help="arquivo JSON com os resultados")
+    apRoda.add_argument("--etapas", default=",".join(ETAPAS),
+        help="etapas separadas por virgula: " + ",".join(ETAPAS))
+    apRoda.add_argument("--semente", type=int, default=0)
+    apRoda.add_argument("--documentos", type=int, default=20)
+    apRoda.add_argument("--faces", type=int, default=50)
+    apRoda.add_argument("--repeticoes", type=int, default=1,
+        help="passadas sobre as entradas (mais amostras para os percentis)")
+    apRoda.add_argument("--threads", action="store_true",
+        help="deixa o OpenCV usar as threads dele (o padrao e 1, para numeros estaveis)")
+    apRoda.add_argument("--cascPath", default="haarcascade_frontalface_default.xml")
+    apRoda.add_argument("--minSize", type=int, default=72)
+    apRoda.add_argument("--dlibFacePredictor", default="shape_predictor_68_face_landmarks.dat")
+    apRoda.add_argument("--size", type=int, default=224)
+    apServico = modos.add_parser("servico", help="latencia por documento do watch_service.py")
+    apServico.add_argument("--saida", default="benchmark_servico.json")
+    apServico.add_argument("--etapas", default="detect,ace,retinex,clahe")
+    apServico.add_argument("--semente", type=int, default=0)
+    apServico.add_argument("--documentos", type=int, default=10)
+    apServico.add_argument("--intervalo", type=float, default=0.1,
+        help="segundos entre as varreduras da pasta")
+    apServico.add_argument("--espaco", type=float, default=0.5,
+        help="segundos entre um documento e o proximo")
+    apServico.add_argument("--espera", type=float, default=300,
+        help="segundos de espera, depois do ultimo envio, pelos que faltam")
+    apServico.add_argument("--cascPath", default="haarcascade_frontalface_default.xml")
+    apServico.add_argument("--minSize", type=int, default=72)
+    apServico.add_argument("--busca", choices=["exaustiva", "coarse"], default="exaustiva")
+    apServico.add_argument("--dlibFacePredictor", default="shape_predictor_68_face_landmarks.dat")
+    apServico.add_argument("--size", type=int, default=224)
+    apCompara = modos.add_parser("compara", help="compara dois resultados do roda")
+    apCompara.add_argument("base")
+    apCompara.add_argument("novo")
+    apCompara.add_argument("--metrica", choices=["p50", "p90", "p99", "media"], default="p50")
+    apCompara.add_argument("--tolerancia", type=float, default=0.10,
+        help="fracao de piora aceita antes de apontar regressao")
+    args = vars(ap.parse_args())
+
+    if args["modo"] == "compara":
+        sys.exit(1 if compara(args) > 0 else 0)
+    elif args["modo"] == "servico":
+        servico(args)
+    else:
+        roda(args)
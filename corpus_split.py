@@ -0,0 +1,65 @@
+# DIVISAO DETERMINISTICA DO CORPUS ENTRE MAQUINAS (--shard i/N)
+#
+# corpus_split.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# CADA ARQUIVO VAI PARA O SHARD md5(caminho relativo) % N. NAO PRECISA DE
+# COORDENACAO: CADA MAQUINA RODA COM O SEU i E NENHUM ARQUIVO E FEITO DUAS
+# VEZES. O RESULTADO NAO MUDA COM A ORDEM DO os.listdir NEM COM ARQUIVOS NOVOS.
+
+import argparse
+import hashlib
+import re
+
+
+def parseShard(texto):
+    """
+    "i/N" -> (i, N), com 0 <= i < N. Serve como `type` do argparse.
+    """
+    try:
+        i, n = [int(parte) for parte in texto.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("use i/N, por exemplo 0/4: {0}".format(texto))
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard fora do intervalo: {0}".format(texto))
+    return i, n
+
+
+def shardDe(caminhoRelativo, n):
+    chave = caminhoRelativo.replace("\\", "/")
+    if not isinstance(chave, bytes):
+        chave = chave.encode("utf-8")
+    return int(hashlib.md5(chave).hexdigest(), 16) % n
+
+
+def filtraShard(itens, shard, chave=lambda item: item):
+    """
+    :param shard: (i, N) de parseShard, ou None para ficar com tudo.
+    :param chave: caminho relativo de cada item (o mesmo em todas as maquinas).
+    """
+    if shard is None:
+        return list(itens)
+    i, n = shard
+    return [item for item in itens if shardDe(chave(item), n) == i]
+
+
+def sufixoShard(shard):
+    # PARA OS NOMES DOS RELATORIOS DE CADA SHARD NAO SE MISTURAREM
+    if shard is None:
+        return ""
+    return "_shard{0}de{1}".format(shard[0], shard[1])
+
+
+def leSufixoShard(nome):
+    """
+    Inverso de `sufixoShard`: procura _shard{i}de{N} no nome do arquivo.
+
+    :return: (i, N), ou None se o nome nao tem sufixo de shard.
+    """
+    encontrado = re.search(r"_shard([0-9]+)de([0-9]+)", nome)
+    if encontrado is None:
+        return None
+    return int(encontrado.group(1)), int(encontrado.group(2))
@@ -0,0 +1,288 @@
+# AJUSTE DOS PARAMETROS DO detectMultiScale: RECALL x DOCUMENTOS POR SEGUNDO
+#
+# detector_tuning.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# RODA A BUSCA COMPLETA (buscaFace, COM ROTACAO) NUMA AMOSTRA ROTULADA PARA
+# CADA COMBINACAO DE scaleFactor, minNeighbors, minSize/maxSize RELATIVOS AO
+# DOCUMENTO E REDUCAO, E GRAVA A FRONTEIRA DE PARETO (NENHUMA OUTRA COMBINACAO
+# E MAIS RAPIDA SEM PERDER RECALL). SO ENTRAM NA FRONTEIRA AS COMBINACOES COM
+# TAXA DE FALSOS POSITIVOS ATE --falsosMaximo (PADRAO: A DOS PARAMETROS
+# ATUAIS). O PERFIL ESCOLHIDO (O MAIS RAPIDO COM O RECALL PEDIDO) VAI PARA UM
+# JSON QUE O face_detect_rotation LE COM --perfil.
+#
+# AMOSTRA: amostra/com_face/* E amostra/sem_face/* (O NOME DA PASTA E O ROTULO).
+# NA AMOSTRA SINTETICA A POSICAO DO ROSTO E CONHECIDA: SO CONTA COMO ACHADO SE
+# A FACE DETECTADA CAI EM CIMA DELE.
+#
+# python detector_tuning.py amostra/ --saida tuning.json --perfil perfil_detector.json
+# python detector_tuning.py --sintetico 12 --scaleFactor 1.1 1.2 --reducao 1 2
+# python face_detect_rotation_.0.2.py --perfil perfil_detector.json
+
+import argparse
+import cv2, imutils, itertools, json, os, time
+import numpy as np
+from timeit import default_timer
+from face_detector import FaceDetector, PERFIL_PADRAO
+from face_scan import buscaFace, leDocumento
+
+PASTA_COM_FACE = "com_face"
+PASTA_SEM_FACE = "sem_face"
+
+
+SOBREPOSICAO_MINIMA = 0.5  # FRACAO DA CAIXA DETECTADA QUE PRECISA CAIR NO ROSTO
+ALTURA_SINTETICO, LARGURA_SINTETICO = 1400, 1000
+
+
+def leAmostra(pasta):
+    """
+    :return: lista de (nome, documento BGR, temFace, mascara); mascara e
+             None (a posicao do rosto nao e conhecida).
+    """
+    amostra = []
+    for subpasta, temFace in ((PASTA_COM_FACE, True), (PASTA_SEM_FACE, False)):
+        caminho = os.path.join(pasta, subpasta)
+        if not os.path.isdir(caminho):
+            continue
+        for nome in sorted(os.listdir(caminho)):
+            image = leDocumento(os.path.join(caminho, nome))
+            if image is not None:
+                amostra.append((os.path.join(subpasta, nome), image, temFace, None))
+    return amostra
+
+
+def mascaraRosto(forma, caixa, angulo):
+    """
+    :param forma: (altura, largura) do documento antes da rotacao.
+    :param caixa: (x, y, w, h) do rosto antes da rotacao.
+    :return: mascara uint8 (255 no rosto) com a mesma rotacao do documento.
+    """
+    x, y, w, h = caixa
+    mascara = np.zeros(forma, np.uint8)
+    mascara[y:y + h, x:x + w] = 255
+    return imutils.rotate_bound(mascara, angulo) if angulo != 0 else mascara
+
+
+def amostraSintetica(semente, quantidade, minSize):
+    # METADE COM ROSTO (benchmark_suite, NA MESMA SEQUENCIA DO geraEntradas), METADE SO COM "TEXTO"
+    from benchmark_suite import documentoSintetico, ANGULOS_DOCUMENTO
+    amostra = []
+    rng = np.random.RandomState(semente)
+    for i in range(quantidade - quantidade // 2):
+        angulo = ANGULOS_DOCUMENTO[i % len(ANGULOS_DOCUMENTO)]
+        ladoRosto = int(rng.randint(int(minSize * 1.5), 320))
+        doc, caixa = documentoSintetico(rng, ladoRosto, angulo, ALTURA_SINTETICO, LARGURA_SINTETICO)
+        mascara = mascaraRosto((ALTURA_SINTETICO, LARGURA_SINTETICO), caixa, angulo)
+        amostra.append(("doc{0:03d}_{1}.jpg".format(i, angulo), doc, True, mascara))
+    rng = np.random.RandomState(semente + 1)
+    for i in range(quantidade // 2):
+        angulo = ANGULOS_DOCUMENTO[i % len(ANGULOS_DOCUMENTO)]
+        doc, caixa = documentoSintetico(rng, int(minSize * 1.5), angulo, ALTURA_SINTETICO, LARGURA_SINTETICO,
+                                        comRosto=False)
+        amostra.append(("texto{0:03d}_{1}.jpg".format(i, angulo), doc, False, None))
+    return amostra
+
+
+def caiNoRosto(detector, image, angulo, mascara):
+    """
+    Detecta de novo no angulo em que a busca parou e confere se alguma face
+    cai em cima do rosto conhecido (SOBREPOSICAO_MINIMA da caixa detectada).
+    """
+    faces, rotacionada = detector.detect(image, angulo)
+    if angulo:
+        mascara = imutils.rotate_bound(mascara, angulo)
+    for (x, y, w, h) in faces:
+        if w > 0 and h > 0 and (mascara[y:y + h, x:x + w] > 127).sum() >= SOBREPOSICAO_MINIMA * w * h:
+            return True
+    return False
+
+
+def grade(args):
+    """
+    :return: lista de perfis (dicts como PERFIL_PADRAO); o padrao vem primeiro.
+    """
+    perfis = [dict(PERFIL_PADRAO, minSize=args["minSize"])]
+    for scaleFactor, minNeighbors, minRelativo, maxRelativo, reducao in itertools.product(
+            args["scaleFactor"], args["minNeighbors"], args["minSizeRelativo"],
+            args["maxSizeRelativo"], args["reducao"]):
+        if maxRelativo and maxRelativo <= minRelativo:
+            continue
+        perfil = {'scaleFactor': scaleFactor, 'minNeighbors': minNeighbors, 'minSize': args["minSize"],
+                  'minSizeRelativo': minRelativo, 'maxSizeRelativo': maxRelativo, 'reducao': reducao}
+        if perfil not in perfis:
+            perfis.append(perfil)
+    return perfis
+
+
+def avaliaPerfil(cascPath, perfil, amostra, opcoes):
+    """
+    Busca completa em cada documento da amostra com os parametros do perfil.
+
+    :return: dict com parametros, recall (com_face achados), falsosPositivos
+             (sem_face com face), foraDoRosto (com_face com mascara em que a
+             face achada nao era o rosto; nao entram no recall), porSegundo
+             e chamadas ao detector.
+    """
+    detector = FaceDetector(cascPath, **perfil)
+    # AQUECIMENTO (CASCADE, BUFFER DE CINZA)
+    buscaFace(detector, amostra[0][1], amostra[0][0], opcoes)
+    achados = falsos = chamadas = 0
+    conferir = []
+    inicio = default_timer()
+    for nome, image, temFace, mascara in amostra:
+        qtdFaces, angulo, saida, chamadasDoc = buscaFace(detector, image, nome, opcoes)
+        chamadas += chamadasDoc
+        if qtdFaces >= 1 and temFace:
+            if mascara is None:
+                achados += 1
+            else:
+                conferir.append((image, angulo, mascara))
+        elif qtdFaces >= 1:
+            falsos += 1
+    total = default_timer() - inicio
+    # FORA DO TEMPO MEDIDO
+    foraDoRosto = 0
+    for image, angulo, mascara in conferir:
+        if caiNoRosto(detector, image, angulo, mascara):
+            achados += 1
+        else:
+            foraDoRosto += 1
+    comFace = sum(1 for item in amostra if item[2])
+    semFace = len(amostra) - comFace
+    return {
+        'parametros': perfil,
+        'recall': float(achados) / comFace if comFace else None,
+        'falsosPositivos': float(falsos) / semFace if semFace else None,
+        'foraDoRosto': foraDoRosto,
+        'porSegundo': len(amostra) / total,
+        'chamadas': chamadas,
+    }
+
+
+def filtraFalsos(resultados, falsosMaximo):
+    """
+    :return: os resultados com taxa de falsos positivos ate falsosMaximo
+             (None: a amostra nao tem sem_face e nao ha o que filtrar).
+    """
+    if falsosMaximo is None:
+        return list(resultados)
+    return [r for r in resultados if r['falsosPositivos'] is None or r['falsosPositivos'] <= falsosMaximo]
+
+
+def fronteiraPareto(resultados):
+    """
+    :return: os resultados que nenhum outro supera em porSegundo e recall ao
+             mesmo tempo, do mais rapido para o mais lento.
+    """
+    fronteira = []
+    melhorRecall = -1.0
+    for resultado in sorted(resultados, key=lambda r: (-r['porSegundo'], -(r['recall'] or 0))):
+        if (resultado['recall'] or 0) > melhorRecall:
+            fronteira.append(resultado)
+            melhorRecall = resultado['recall'] or 0
+    return fronteira
+
+
+def escolhe(fronteira, recallMinimo):
+    # O MAIS RAPIDO QUE CHEGA NO RECALL; SE NENHUM CHEGA, O DE MAIOR RECALL
+    for resultado in fronteira:
+        if (resultado['recall'] or 0) >= recallMinimo:
+            return resultado
+    return fronteira[-1]
+
+
+def descreve(resultado):
+    p = resultado['parametros']
+    return ("scaleFactor {0:<5} minNeighbors {1:<2} minRel {2:<5} maxRel {3:<5} reducao {4:<4} "
+            "| {5:6.2f} doc/s recall {6:.3f} falsos {7} fora do rosto {8}").format(
+            p['scaleFactor'], p['minNeighbors'], p['minSizeRelativo'], p['maxSizeRelativo'], p['reducao'],
+            resultado['porSegundo'], resultado['recall'] or 0,
+            "-" if resultado['falsosPositivos'] is None else "{0:.3f}".format(resultado['falsosPositivos']),
+            resultado['foraDoRosto'])
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("amostra", nargs="?",
+        help="pasta com " + PASTA_COM_FACE + "/ e " + PASTA_SEM_FACE + "/")
+    ap.add_argument("--sintetico", type=int,
+        help="sem amostra: gera N documentos sinteticos (metade com rosto)")
+    ap.add_argument("--semente", type=int, default=0)
+    ap.add_argument("--saida", default="tuning_detector.json",
+        help="todas as combinacoes medidas e a fronteira de Pareto")
+    ap.add_argument("--perfil", default="perfil_detector.json",
+        help="perfil escolhido, para o --perfil do face_detect_rotation")
+    ap.add_argument("--recallMinimo", type=float,
+        help="recall que o perfil escolhido precisa ter (padrao: o recall dos parametros atuais)")
+    ap.add_argument("--falsosMaximo", type=float,
+        help="taxa de falsos positivos (sem_face com face) aceita nos candidatos "
+             "(padrao: a dos parametros atuais)")
+    ap.add_argument("--cascPath", default="haarcascade_frontalface_default.xml")
+    ap.add_argument("--busca", choices=["exaustiva", "coarse"], default="exaustiva")
+    ap.add_argument("--minSize", type=int, default=PERFIL_PADRAO['minSize'])
+    ap.add_argument("--scaleFactor", type=float, nargs="+", default=[1.05, 1.1, 1.2, 1.3])
+    ap.add_argument("--minNeighbors", type=int, nargs="+", default=[3, 4, 6])
+    ap.add_argument("--minSizeRelativo", type=float, nargs="+", default=[0.0, 0.08],
+        help="fracao do menor lado do documento (0 = so o minSize)")
+    ap.add_argument("--maxSizeRelativo", type=float, nargs="+", default=[0.0, 0.6],
+        help="fracao do menor lado do documento (0 = sem limite)")
+    ap.add_argument("--reducao", type=float, nargs="+", default=[1.0, 1.5, 2.0],
+        help="o cascade roda na imagem reduzida em 1/reducao")
+    ap.add_argument("--threads", action="store_true",
+        help="deixa o OpenCV usar todos os nucleos (o padrao e 1, para medidas estaveis)")
+    args = vars(ap.parse_args())
+    if not args["amostra"] and not args["sintetico"]:
+        ap.error("informe a pasta da amostra ou --sintetico N")
+    if not args["threads"]:
+        cv2.setNumThreads(1)
+
+    if args["amostra"]:
+        amostra = leAmostra(args["amostra"])
+    else:
+        amostra = amostraSintetica(args["semente"], args["sintetico"], args["minSize"])
+    comFace = sum(1 for item in amostra if item[2])
+    if comFace == 0:
+        ap.error("a amostra precisa de documentos em " + PASTA_COM_FACE + "/")
+    print("amostra: {0} documentos, {1} com face".format(len(amostra), comFace))
+
+    opcoes = {'busca': args["busca"], 'ladoBusca': 800}
+    perfis = grade(args)
+    resultados = []
+    inicio = time.time()
+    for i, perfil in enumerate(perfis):
+        resultado = avaliaPerfil(args["cascPath"], perfil, amostra, opcoes)
+        resultados.append(resultado)
+        print("({0}/{1}) {2}".format(i + 1, len(perfis), descreve(resultado)))
+    padrao = resultados[0]
+    recallMinimo = args["recallMinimo"] if args["recallMinimo"] is not None else padrao['recall']
+    falsosMaximo = args["falsosMaximo"] if args["falsosMaximo"] is not None else padrao['falsosPositivos']
+
+    # O PADRAO SEMPRE PASSA NO FILTRO PADRAO; COM --falsosMaximo MAIS APERTADO PODE SOBRAR NADA
+    candidatos = filtraFalsos(resultados, falsosMaximo)
+    if not candidatos:
+        ap.error("nenhuma combinacao com falsos positivos ate {0}".format(falsosMaximo))
+    fronteira = fronteiraPareto(candidatos)
+    escolhido = escolhe(fronteira, recallMinimo)
+    print("\nFRONTEIRA DE PARETO (doc/s x recall, falsos ate {0}):".format(
+        "-" if falsosMaximo is None else "{0:.3f}".format(falsosMaximo)))
+    for resultado in fronteira:
+        print(("  * " if resultado is escolhido else "    ") + descreve(resultado))
+    print("\nPADRAO:    " + descreve(padrao))
+    print("ESCOLHIDO: " + descreve(escolhido) +
+          " ({0:.2f}x)".format(escolhido['porSegundo'] / padrao['porSegundo']))
+
+    with open(args["saida"], 'w') as f:
+        json.dump({'amostra': {'documentos': len(amostra), 'comFace': comFace,
+                               'origem': args["amostra"] or "sintetico:{0}".format(args["semente"])},
+                   'busca': args["busca"], 'recallMinimo': recallMinimo, 'falsosMaximo': falsosMaximo,
+                   'segundos': time.time() - inicio,
+                   'resultados': resultados, 'fronteira': fronteira, 'escolhido': escolhido},
+                  f, indent=1, sort_keys=True)
+    with open(args["perfil"], 'w') as f:
+        json.dump({'parametros': escolhido['parametros'],
+                   'medidas': dict((k, escolhido[k]) for k in ('recall', 'falsosPositivos', 'foraDoRosto', 'porSegundo'))},
+                  f, indent=1, sort_keys=True)
+    print("gravados " + args["saida"] + " e " + args["perfil"])
@@ -0,0 +1,111 @@
+# DOCUMENTOS REPETIDOS (REENVIO DO MESMO SCAN) POR HASH PERCEPTUAL
+#
+# duplicate_index.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# dHash DE 64 BITS NUMA MINIATURA EM CINZA (O JPEG E DECODIFICADO EM 1/8 NO
+# PROPRIO DCT, ENTAO SAI BARATO). DOIS DOCUMENTOS SAO O MESMO SE OS HASHES
+# DIFEREM EM ATE `distanciaMaxima` BITS. O INDICE PARTE O HASH EM 8 FAIXAS DE
+# 8 BITS: COM ATE 7 BITS DIFERENTES, PELO MENOS UMA FAIXA E IGUAL, ENTAO SO
+# OS HASHES QUE CAEM NUMA MESMA FAIXA SAO COMPARADOS.
+#
+# NAO PEGA O MESMO SCAN ROTACIONADO OU RECORTADO DE OUTRO JEITO: SO REENVIOS
+# (RECOMPRESSAO, REDIMENSIONAMENTO, PEQUENAS DIFERENCAS DE BRILHO).
+
+import cv2
+import numpy as np
+from prefetch_reader import PrefetchReader
+
+FAIXAS = 8
+BITS_FAIXA = 8
+
+
+def dHash(cinza):
+    """
+    :param cinza: imagem em cinza (qualquer tamanho).
+    :return: int de 64 bits; cada bit diz se o pixel e mais claro que o vizinho da direita.
+    """
+    miniatura = cv2.resize(cinza, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (miniatura[:, 1:] > miniatura[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def leMiniatura(caminho):
+    return cv2.imread(caminho, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+
+def distancia(hashA, hashB):
+    return bin(hashA ^ hashB).count("1")
+
+
+def hashTexto(valor):
+    return "{0:016x}".format(valor)
+
+
+class DuplicateIndex:
+    """
+    Indice em memoria de hashes; `procura` devolve o documento ja visto
+    mais parecido, dentro de `distanciaMaxima` bits.
+    """
+
+    def __init__(self, distanciaMaxima=4):
+        if not 0 <= distanciaMaxima < FAIXAS:
+            raise ValueError("distanciaMaxima deve ficar entre 0 e {0}".format(FAIXAS - 1))
+        self.distanciaMaxima = distanciaMaxima
+        self.faixas = [{} for i in range(FAIXAS)]
+
+    def _chaves(self, valor):
+        mascara = (1 << BITS_FAIXA) - 1
+        return [(valor >> (i * BITS_FAIXA)) & mascara for i in range(FAIXAS)]
+
+    def adiciona(self, valor, nome):
+        for faixa, chave in zip(self.faixas, self._chaves(valor)):
+            faixa.setdefault(chave, []).append((valor, nome))
+
+    def procura(self, valor):
+        """
+        :return: (nome, distancia) do mais parecido, ou None.
+        """
+        melhor = None
+        for faixa, chave in zip(self.faixas, self._chaves(valor)):
+            for outro, nome in faixa.get(chave, ()):
+                d = distancia(valor, outro)
+                if d <= self.distanciaMaxima and (melhor is None or d < melhor[1]):
+                    melhor = (nome, d)
+        return melhor
+
+
+def calculaHashes(itens, emVoo=32):
+    """
+    :param itens: sequencia de (nome, caminho).
+    :return: gerador de (nome, hash ou None se nao deu para ler), na mesma ordem.
+    """
+    for nome, cinza in PrefetchReader(itens, leMiniatura, emVoo=emVoo):
+        yield nome, (dHash(cinza) if cinza is not None else None)
+
+
+def agrupaDuplicados(itens, indice, emVoo=32):
+    """
+    Pre-passagem: o primeiro de cada grupo (na ordem de `itens`) e o
+    original; os seguintes apontam para ele.
+
+    :param indice: DuplicateIndex, possivelmente ja com documentos de uma
+                   execucao anterior.
+    :return: (hashes, duplicados) - hashes: nome -> hash; duplicados:
+             nome -> (nome do original, distancia).
+    """
+    hashes = {}
+    duplicados = {}
+    for nome, valor in calculaHashes(itens, emVoo):
+        if valor is None:
+            continue
+        hashes[nome] = valor
+        achado = indice.procura(valor)
+        if achado is not None:
+            duplicados[nome] = achado
+        else:
+            indice.adiciona(valor, nome)
+    return hashes, duplicados
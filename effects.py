@@ -0,0 +1,398 @@
+# EFEITOS DE ILUMINACAO (ACE, RETINEX E CLAHE) SOBRE ARRAYS NUMPY
+#
+# effects.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# AS IMAGENS SAO BGR uint8, COMO O cv2.imread DEVOLVE. O colorcorrect TRABALHA
+# EM RGB, ENTAO A CONVERSAO E FEITA AQUI DENTRO.
+
+import argparse
+import numpy as np
+import cv2, os, time, threading
+import metricas
+
+# PARAMETROS DO ACE (OS MESMOS DEFAULTS DO colorcorrect)
+ACE_SLOPE = 10
+ACE_LIMIT = 1000
+
+# MOTOR RAPIDO: GRAU DO POLINOMIO QUE APROXIMA A SATURACAO E ESCALA DO CONTEXTO
+ACE_GRAU = 7
+ACE_ESCALA = 0.25
+
+_coeficientes = {}
+_kernels = {}
+_retinexMSR = None
+_porThread = threading.local()
+
+
+def bgrParaRgb(bgr):
+    return np.ascontiguousarray(bgr[:, :, ::-1])
+
+
+def aplicaACE(bgr, motor="rapido", grau=ACE_GRAU, escala=ACE_ESCALA):
+    """
+    O ACE trata cada canal da mesma forma, entao tanto faz BGR ou RGB.
+
+    :param motor: 'rapido' (aceRapido) ou 'colorcorrect' (o original, com
+                  500 amostras sorteadas por pixel).
+    """
+    with metricas.tempo("ace"):
+        if motor == "colorcorrect":
+            import colorcorrect.algorithm as cca
+            rgb = cca.automatic_color_equalization(bgrParaRgb(bgr))
+            return bgrParaRgb(np.uint8(rgb))
+        return aceRapido(bgr, grau, escala)
+
+
+def coeficientesSaturacao(grau, slope=ACE_SLOPE, limit=ACE_LIMIT):
+    """
+    Polinomio impar que aproxima a saturacao do ACE, clip(slope*d, -limit, limit)/limit,
+    com d = diferenca/255 em [-1, 1].
+
+    :return: lista de (expoente, coeficiente).
+    """
+    chave = (grau, slope, limit)
+    if chave not in _coeficientes:
+        x = np.linspace(-1.0, 1.0, 2001)
+        y = np.clip(x * 255.0 * slope / limit, -1.0, 1.0)
+        expoentes = list(range(1, grau + 1, 2))
+        A = np.stack([x ** k for k in expoentes], axis=1)
+        c = np.linalg.lstsq(A, y, rcond=None)[0]
+        _coeficientes[chave] = list(zip(expoentes, c))
+    return _coeficientes[chave]
+
+
+def kernelDistancia(h, w, raioMinimo):
+    """
+    FFT do peso 1/d do ACE, zerado para d < raioMinimo, no tamanho
+    (2h, 2w) para a convolucao nao dar a volta na imagem.
+    """
+    chave = (h, w, raioMinimo)
+    if chave not in _kernels:
+        dy = np.arange(2 * h)
+        dy = np.where(dy < h, dy, dy - 2 * h)
+        dx = np.arange(2 * w)
+        dx = np.where(dx < w, dx, dx - 2 * w)
+        d = np.hypot(dy[:, None], dx[None, :])
+        k = np.zeros(d.shape)
+        longe = d >= max(raioMinimo, 1e-6)
+        k[longe] = 1.0 / d[longe]
+        _kernels[chave] = np.fft.rfft2(k)
+    return _kernels[chave]
+
+
+def aceRapido(bgr, grau=ACE_GRAU, escala=ACE_ESCALA, slope=ACE_SLOPE, limit=ACE_LIMIT):
+    """
+    ACE sem amostragem: a soma sobre todos os pixels, com a saturacao
+    aproximada por um polinomio, vira convolucoes das potencias da imagem
+    com o peso 1/d (feitas por FFT).
+
+    s(a - b) ~ sum_k c_k (a - b)^k = sum_k c_k sum_j C(k,j) a^j (-b)^(k-j)
+
+    O termo de contexto (as convolucoes) e suave, entao pode ser calculado
+    numa copia reduzida e ampliado.
+
+    :param grau: grau do polinomio (impar); mais alto = mais fiel e mais lento.
+    :param escala: fracao do tamanho usada no contexto; 1.0 = resolucao cheia.
+    :return: imagem uint8 com cada canal esticado para 0..255, como no colorcorrect.
+    """
+    h, w = bgr.shape[:2]
+    img = bgr.astype(np.float64) / 255.0
+    hc = max(int(round(h * escala)), 1)
+    wc = max(int(round(w * escala)), 1)
+    if (hc, wc) != (h, w):
+        contexto = cv2.resize(img, (wc, hc), interpolation=cv2.INTER_AREA)
+    else:
+        contexto = img
+    # O colorcorrect IGNORA AMOSTRAS A MENOS DE altura/5 (DIVISAO INTEIRA)
+    K = kernelDistancia(hc, wc, (h // 5) * float(hc) / h)
+
+    # MOMENTOS NORMALIZADOS: N_m(p) = sum_q b(q)^m w(p,q) / sum_q w(p,q)
+    coeficientes = coeficientesSaturacao(grau, slope, limit)
+    canais = img.shape[2]
+    potencias = np.empty((grau + 1, canais, hc, wc))
+    potencias[0] = 1.0
+    base = contexto.transpose(2, 0, 1)
+    for m in range(1, grau + 1):
+        potencias[m] = potencias[m - 1] * base
+    somas = np.fft.irfft2(np.fft.rfft2(potencias, s=(2 * hc, 2 * wc)) * K,
+                          s=(2 * hc, 2 * wc))[:, :, :hc, :wc]
+    momentos = somas / somas[0]
+    if (hc, wc) != (h, w):
+        momentos = np.stack([cv2.resize(np.ascontiguousarray(m.transpose(1, 2, 0)), (w, h),
+                                        interpolation=cv2.INTER_LINEAR).reshape(h, w, canais)
+                             for m in momentos]).transpose(0, 3, 1, 2)
+
+    a = img.transpose(2, 0, 1)
+    potenciasA = [np.ones_like(a)]
+    for j in range(1, grau + 1):
+        potenciasA.append(potenciasA[-1] * a)
+    r = np.zeros_like(a)
+    for k, c in coeficientes:
+        for j in range(k + 1):
+            termo = binomial(k, j) * (-1) ** (k - j) * c
+            r += termo * potenciasA[j] * momentos[k - j]
+
+    # ESCALA LINEAR PARA 0..255 POR CANAL (TRUNCANDO, COMO O colorcorrect)
+    minimo = r.min(axis=(1, 2), keepdims=True)
+    maximo = r.max(axis=(1, 2), keepdims=True)
+    saida = (r - minimo) * (255.0 / np.maximum(maximo - minimo, 1e-12))
+    return np.ascontiguousarray(saida.transpose(1, 2, 0)).astype(np.uint8)
+
+
+def binomial(n, k):
+    resultado = 1
+    for i in range(1, k + 1):
+        resultado = resultado * (n - i + 1) // i
+    return resultado
+
+
+def aplicaRetinex(bgr, motor="maximo"):
+    """
+    :param motor: 'maximo' (retinexMaximo, mesma saida do colorcorrect sem
+                  passar pelo PIL), 'msr' (RetinexMultiEscala) ou
+                  'colorcorrect' (cca.retinex, o de apply_effects_ACE_RETINEX.py).
+    """
+    global _retinexMSR
+    with metricas.tempo("retinex"):
+        if motor == "colorcorrect":
+            import colorcorrect.algorithm as cca
+            rgb = cca.retinex(bgrParaRgb(bgr))
+            return bgrParaRgb(np.uint8(rgb))
+        if motor == "msr":
+            if _retinexMSR is None:
+                _retinexMSR = RetinexMultiEscala()
+            return _retinexMSR.aplica(bgr)
+        return retinexMaximo(bgr)
+
+
+def retinexMaximo(imagens):
+    """
+    O retinex do colorcorrect: escala os canais azul e vermelho para que o
+    maximo de cada um fique igual ao maximo do verde. Mesma saida, bit a
+    bit, aplicada com uma tabela (cv2.LUT) em vez de contas por pixel.
+
+    :param imagens: uma imagem (H, W, 3) ou um lote (N, H, W, 3), uint8.
+                    O verde e o canal do meio, entao serve BGR ou RGB.
+    """
+    if imagens.ndim == 4:
+        saida = np.empty_like(imagens)
+        for i in range(len(imagens)):
+            saida[i] = retinexMaximo(imagens[i])
+        return saida
+    maximos = [float(cv2.minMaxLoc(canal)[1]) for canal in cv2.split(imagens)]
+    fatores = np.array([maximos[1] / max(m, 1.0) for m in maximos])
+    fatores[1] = 1.0
+    tabela = np.minimum(np.arange(256)[:, None] * fatores, 255).astype(np.uint8)
+    return cv2.LUT(imagens, tabela.reshape(256, 1, 3))
+
+
+class RetinexMultiEscala:
+    """
+    Retinex multi-escala: media, nas escalas `sigmas`, de
+    log(I) - log(gaussiana * I), por canal, com o corte de `corte`% nas
+    pontas para voltar a 0..255.
+
+    As gaussianas sao aplicadas por FFT numa copia reduzida `reducao` vezes
+    (o menor sigma continua com varios pixels) e espelhada (borda
+    refletida), e depois ampliadas. Os filtros de cada tamanho de imagem
+    sao calculados uma vez e reaproveitados; com um lote (N, H, W, 3) de
+    faces do mesmo tamanho, todas passam pelas mesmas FFTs de uma vez.
+    """
+
+    def __init__(self, sigmas=(15, 80, 250), corte=1.0, reducao=4, tamanhoBloco=16):
+        self.sigmas = sigmas
+        self.corte = corte
+        self.reducao = reducao
+        self.tamanhoBloco = tamanhoBloco
+        self.filtros = {}
+
+    def filtro(self, h, w):
+        # FUNCAO DE TRANSFERENCIA DAS GAUSSIANAS NO TAMANHO REDUZIDO E ESPELHADO (2h, 2w)
+        if (h, w) not in self.filtros:
+            fy = np.fft.fftfreq(2 * h)[:, None]
+            fx = np.fft.rfftfreq(2 * w)[None, :]
+            f2 = fy ** 2 + fx ** 2
+            self.filtros[(h, w)] = np.stack([np.exp(-2.0 * np.pi ** 2 * (float(s) / self.reducao) ** 2 * f2)
+                                             for s in self.sigmas]).astype(np.float32)
+        return self.filtros[(h, w)]
+
+    def aplica(self, bgr):
+        return self.aplicaLote(bgr[None])[0]
+
+    def aplicaLote(self, lote):
+        """
+        :param lote: (N, H, W, 3) uint8, todas do mesmo tamanho.
+        :return: (N, H, W, 3) uint8.
+        """
+        lote = np.asarray(lote)
+        saida = np.empty(lote.shape, np.uint8)
+        for inicio in range(0, len(lote), self.tamanhoBloco):
+            fim = inicio + self.tamanhoBloco
+            saida[inicio:fim] = self._aplicaBloco(lote[inicio:fim])
+        return saida
+
+    def _aplicaBloco(self, bloco):
+        n, h, w, canais = bloco.shape
+        hr = max(h // self.reducao, 1)
+        wr = max(w // self.reducao, 1)
+        # TODAS AS IMAGENS E CANAIS DO BLOCO COMO CANAIS DE UMA IMAGEM SO (cv2 ATE 512)
+        planos = bloco.transpose(1, 2, 0, 3).reshape(h, w, n * canais).astype(np.float32) + 1.0
+        reduzida = cv2.resize(planos, (wr, hr), interpolation=cv2.INTER_AREA).reshape(hr, wr, -1)
+        reduzida = reduzida.transpose(2, 0, 1)
+        espelho = np.concatenate([reduzida, reduzida[:, ::-1]], axis=1)
+        espelho = np.concatenate([espelho, espelho[:, :, ::-1]], axis=2)
+        F = np.fft.rfft2(espelho)
+
+        # SOMA DOS LOGS = LOG DO PRODUTO: UM log SO PARA TODAS AS ESCALAS
+        produto = np.ones((h, w, n * canais), np.float32)
+        for H in self.filtro(hr, wr):
+            borrada = np.fft.irfft2(F * H, s=(2 * hr, 2 * wr))[:, :hr, :wr]
+            borrada = np.ascontiguousarray(borrada.transpose(1, 2, 0), dtype=np.float32)
+            borrada = cv2.resize(borrada, (w, h), interpolation=cv2.INTER_LINEAR).reshape(h, w, -1)
+            produto *= np.maximum(borrada, 1e-3)
+        r = np.log(planos) - np.log(produto) / len(self.sigmas)
+
+        # CORTA AS PONTAS E ESTICA PARA 0..255, POR CANAL DE CADA IMAGEM
+        # (OS PERCENTIS SAO ESTIMADOS EM 1 DE CADA 4 PIXELS)
+        plano = np.ascontiguousarray(r[::2, ::2].reshape(-1, n * canais).T)
+        baixo = np.percentile(plano, self.corte, axis=1)
+        alto = np.percentile(plano, 100.0 - self.corte, axis=1)
+        r = (r - baixo) * (255.0 / np.maximum(alto - baixo, 1e-6))
+        r = np.clip(r, 0, 255).astype(np.uint8).reshape(h, w, n, canais)
+        return r.transpose(2, 0, 1, 3)
+
+
+def claheDaThread():
+    # O OBJETO DO CLAHE GUARDA ESTADO, ENTAO CADA THREAD TEM O SEU, CRIADO UMA VEZ
+    if not hasattr(_porThread, "clahe"):
+        _porThread.clahe = cv2.createCLAHE()
+    return _porThread.clahe
+
+
+def aplicaCLAHE(bgr, clahe=None):
+    """
+    CLAHE so na luminancia (canal Y de YCrCb), como em apply_effects_CLAHE.py.
+
+    :param clahe: objeto de cv2.createCLAHE para reaproveitar; sem ele usa o da thread.
+    """
+    with metricas.tempo("clahe"):
+        if clahe is None:
+            clahe = claheDaThread()
+        other = cv2.cvtColor(bgr, cv2.COLOR_BGR2YCR_CB)
+        other[:, :, 0] = clahe.apply(np.ascontiguousarray(other[:, :, 0]))
+        return cv2.cvtColor(other, cv2.COLOR_YCR_CB2BGR)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return 10.0 * np.log10(255.0 ** 2 / mse)
+
+
+def leImagens(pasta, quantidade, tamanho=None):
+    imagens = []
+    for file in sorted(os.listdir(pasta)):
+        image = cv2.imread(os.path.join(pasta, file))
+        if image is None:
+            continue
+        if tamanho:
+            image = cv2.resize(image, (tamanho, tamanho), interpolation=cv2.INTER_AREA)
+        imagens.append((file, image))
+        if len(imagens) >= quantidade:
+            break
+    return imagens
+
+
+def benchmarkACE(imagens, graus, escalas):
+    """
+    Tempo por imagem e PSNR de aceRapido contra o ACE do colorcorrect.
+
+    O colorcorrect sorteia as amostras (semente = relogio), entao duas
+    execucoes dele tambem diferem entre si; o PSNR tem esse teto.
+    """
+    import colorcorrect.algorithm as cca
+    referencias = []
+    inicio = time.time()
+    for nome, image in imagens:
+        referencias.append(cca.automatic_color_equalization(image.copy()))
+    tempoRef = (time.time() - inicio) / len(imagens)
+    print("colorcorrect: {0:.1f} ms/imagem".format(tempoRef * 1000))
+
+    for grau in graus:
+        for escala in escalas:
+            aceRapido(imagens[0][1], grau, escala)  # AQUECE O CACHE DO KERNEL
+            inicio = time.time()
+            saidas = [aceRapido(image, grau, escala) for nome, image in imagens]
+            tempo = (time.time() - inicio) / len(imagens)
+            valores = [psnr(s, r) for s, r in zip(saidas, referencias)]
+            print("rapido grau {0:2d} escala {1:.2f}: {2:7.1f} ms/imagem ({3:5.1f}x), "
+                  "PSNR medio {4:.2f} dB, minimo {5:.2f} dB".format(
+                  grau, escala, tempo * 1000, tempoRef / tempo,
+                  np.mean(valores), np.min(valores)))
+
+
+def benchmarkRetinex(imagens, tamanhoLote):
+    """
+    Imagens por segundo do caminho atual (PIL -> cca.retinex -> PIL) contra
+    os motores nativos, imagem a imagem e em lote.
+    """
+    from PIL import Image
+    import colorcorrect.algorithm as cca
+    from colorcorrect.util import from_pil, to_pil
+
+    pils = [Image.fromarray(bgrParaRgb(image)) for nome, image in imagens]
+    arrays = [image for nome, image in imagens]
+    msr = RetinexMultiEscala(tamanhoBloco=tamanhoLote)
+    msr.aplica(arrays[0])  # AQUECE O CACHE DOS FILTROS
+
+    def lotes(funcao):
+        for inicio in range(0, len(arrays), tamanhoLote):
+            funcao(np.stack(arrays[inicio:inicio + tamanhoLote]))
+
+    casos = [
+        ("colorcorrect (PIL, por imagem)", lambda: [to_pil(cca.retinex(from_pil(p))) for p in pils]),
+        ("maximo (por imagem)", lambda: [retinexMaximo(a) for a in arrays]),
+        ("maximo (lote de {0})".format(tamanhoLote), lambda: lotes(retinexMaximo)),
+        ("msr (por imagem)", lambda: [msr.aplica(a) for a in arrays]),
+        ("msr (lote de {0})".format(tamanhoLote), lambda: lotes(msr.aplicaLote)),
+    ]
+    for nome, funcao in casos:
+        inicio = time.time()
+        funcao()
+        tempo = time.time() - inicio
+        print("{0:32s} {1:9.1f} imagens/s".format(nome, len(arrays) / max(tempo, 1e-9)))
+
+
+if __name__ == '__main__':
+    # python effects.py ace ../pessoas_224x224_crop_bruta/ --graus 5,7,9 --escalas 1,0.5,0.25
+    # python effects.py retinex ../pessoas_224x224_crop_bruta/ --lote 16
+    ap = argparse.ArgumentParser()
+    modos = ap.add_subparsers(dest="modo")
+    apACE = modos.add_parser("ace", help="compara aceRapido com o ACE do colorcorrect")
+    apACE.add_argument("pasta", help="pasta com faces de exemplo")
+    apACE.add_argument("--quantidade", type=int, default=20)
+    apACE.add_argument("--tamanho", type=int, default=224,
+        help="redimensiona as faces para tamanho x tamanho (0 = como estao)")
+    apACE.add_argument("--graus", default="5,7,9")
+    apACE.add_argument("--escalas", default="1,0.5,0.25")
+    apRetinex = modos.add_parser("retinex", help="imagens/s do retinex atual contra os nativos")
+    apRetinex.add_argument("pasta", help="pasta com faces de exemplo")
+    apRetinex.add_argument("--quantidade", type=int, default=64)
+    apRetinex.add_argument("--tamanho", type=int, default=224)
+    apRetinex.add_argument("--lote", type=int, default=16)
+    args = vars(ap.parse_args())
+
+    if args["modo"] == "retinex":
+        imagens = leImagens(args["pasta"], args["quantidade"], args["tamanho"])
+        # REPETE AS FACES ATE COMPLETAR A QUANTIDADE, PARA MEDIR LOTES CHEIOS
+        imagens = (imagens * (args["quantidade"] // len(imagens) + 1))[:args["quantidade"]]
+        benchmarkRetinex(imagens, args["lote"])
+    elif args["modo"] == "ace":
+        imagens = leImagens(args["pasta"], args["quantidade"], args["tamanho"])
+        benchmarkACE(imagens, [int(g) for g in args["graus"].split(",")],
+                     [float(e) for e in args["escalas"].split(",")])
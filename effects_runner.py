@@ -0,0 +1,167 @@
+# EXECUTOR DOS EFEITOS: LE, APLICA E GRAVA EM PARALELO
+#
+# effects_runner.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# USADO PELOS apply_effects_*.py. CADA TAREFA E (ENTRADA, SAIDA); O EFEITO
+# RECEBE E DEVOLVE UMA IMAGEM BGR uint8. LEITURA, EFEITO E GRAVACAO RODAM NO
+# MESMO WORKER; O PROGRESSO SAI NA ORDEM DAS TAREFAS. COM UM ShardWriter, OS
+# WORKERS DEVOLVEM A IMAGEM E QUEM GRAVA NO SHARD E O LACO PRINCIPAL.
+# copiaArquivos E O CAMINHO DAS FACES QUE PASSAM SEM EFEITO: SO COPIA OS BYTES.
+
+import cv2, os, shutil
+import multiprocessing
+import metricas
+from multiprocessing.pool import ThreadPool
+from prefetch_reader import PrefetchReader
+
+# EFEITO DO PROCESSO (MODO processos=True)
+efeitoWorker = None
+
+
+def leImagem(caminho):
+    with metricas.tempo("decode"):
+        return cv2.imread(caminho)
+
+
+def aplicaArquivo(efeito, entrada, saida, bgr=None):
+    """
+    :param saida: arquivo de saida; None devolve a imagem em vez de gravar.
+    :param bgr: imagem ja decodificada (PrefetchReader); sem ela le `entrada`.
+    :return: (falha, imagem) - falha e None se deu certo, ou o motivo;
+             imagem so vem quando `saida` e None.
+    """
+    if bgr is None:
+        bgr = leImagem(entrada)
+    if bgr is None:
+        return "nao foi possivel ler", None
+    resultado = efeito(bgr)
+    if resultado is None:
+        return "efeito nao devolveu imagem", None
+    if saida is None:
+        return None, resultado
+    pasta = os.path.dirname(saida)
+    if pasta and not os.path.isdir(pasta):
+        try:
+            os.makedirs(pasta)
+        except OSError:
+            pass  # OUTRO WORKER CRIOU ANTES
+    with metricas.tempo("write"):
+        gravou = cv2.imwrite(saida, resultado)
+    if not gravou:
+        return "nao foi possivel gravar", None
+    return None, None
+
+
+def iniciaWorker(efeito, comMetricas=False):
+    global efeitoWorker
+    # UM PROCESSO POR NUCLEO: O OPENCV NAO PRECISA ABRIR AS PROPRIAS THREADS
+    cv2.setNumThreads(1)
+    efeitoWorker = efeito
+    if comMetricas:
+        metricas.configura(None)
+
+
+def aplicaArquivoWorker(tarefa):
+    falha, imagem = aplicaArquivo(efeitoWorker, tarefa[0], tarefa[1])
+    # AS METRICAS DO PROCESSO VOLTAM JUNTO E SAO SOMADAS NO PRINCIPAL
+    return falha, imagem, metricas.deltas()
+
+
+def mesclaMetricas(resultados):
+    for falha, imagem, deltas in resultados:
+        metricas.mescla(deltas)
+        yield falha, imagem
+
+
+def executaEfeito(efeito, tarefas, rotulo, workers=1, processos=False, emVoo=8, shards=None):
+    """
+    Aplica `efeito` em cada (entrada, saida) de `tarefas`.
+
+    Com threads (o padrao), o trabalho do OpenCV solta o GIL e escala com
+    os nucleos. Com `processos`, serve para efeitos em Python puro; o efeito
+    precisa ser uma funcao de modulo (vai por pickle).
+
+    Com um worker so, a leitura das proximas imagens segue em threads
+    (no maximo `emVoo` na memoria) enquanto o efeito roda.
+
+    :param rotulo: nome do efeito no progresso ("CLAHE", "ACE/RETINEX", ...).
+    :param shards: ShardWriter; grava la (nome = arquivo de saida, classe =
+                   pasta de entrada) em vez de um arquivo por imagem.
+    :return: (quantidade ok, quantidade com falha).
+    """
+    count = 1
+    countOK = 0
+    if shards is not None:
+        # O QUE JA ESTA NOS SHARDS (EXECUCAO ANTERIOR) NAO E REFEITO
+        tarefas = [(entrada, saida) for entrada, saida in tarefas
+                   if not shards.contem(os.path.basename(saida), os.path.basename(os.path.dirname(entrada)))]
+    saidas = tarefas
+    if shards is not None:
+        tarefas = [(entrada, None) for entrada, saida in tarefas]
+    if workers <= 1:
+        leitor = PrefetchReader([((entrada, saida), entrada) for entrada, saida in tarefas], leImagem,
+                                emVoo=emVoo)
+        resultados = (aplicaArquivo(efeito, entrada, saida, bgr) for (entrada, saida), bgr in leitor)
+        pool = None
+    elif processos:
+        pool = multiprocessing.Pool(workers, iniciaWorker, (efeito, metricas.ativo))
+        resultados = mesclaMetricas(pool.imap(aplicaArquivoWorker, tarefas, 4))
+    else:
+        pool = ThreadPool(workers)
+        resultados = pool.imap(lambda tarefa: aplicaArquivo(efeito, tarefa[0], tarefa[1]), tarefas, 4)
+
+    for (entrada, saida), (falha, imagem) in zip(saidas, resultados):
+        if falha is None and shards is not None:
+            try:
+                shards.adiciona(os.path.basename(saida), imagem,
+                                os.path.basename(os.path.dirname(entrada)))
+            except ValueError as e:
+                falha = str(e)
+        if falha is None:
+            print("{0} > apply {1} em {2}".format(count, rotulo, entrada))
+            countOK = countOK + 1
+        else:
+            print("{0} > FALHA {1} em {2}: {3}".format(count, rotulo, entrada, falha))
+        metricas.conta("imagens", efeito=rotulo, resultado="ok" if falha is None else "falha")
+        metricas.gravaPeriodico()
+        count = count + 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    metricas.grava()
+    return countOK, count - 1 - countOK
+
+
+def copiaArquivos(tarefas, rotulo):
+    """
+    Copia cada entrada para a saida sem decodificar (o ramo que passa sem
+    efeito). So serve sem shards: no ShardWriter a imagem precisa ir
+    decodificada, entao ai use executaEfeito com um efeito identidade.
+
+    :return: (quantidade ok, quantidade com falha), como executaEfeito.
+    """
+    countOK = 0
+    for count, (entrada, saida) in enumerate(tarefas, 1):
+        pasta = os.path.dirname(saida)
+        try:
+            if pasta and not os.path.isdir(pasta):
+                os.makedirs(pasta)
+            with metricas.tempo("copy"):
+                shutil.copyfile(entrada, saida)
+            falha = None
+        except (IOError, OSError) as e:
+            falha = str(e)
+        if falha is None:
+            print("{0} > copia {1} em {2}".format(count, rotulo, entrada))
+            countOK = countOK + 1
+        else:
+            print("{0} > FALHA {1} em {2}: {3}".format(count, rotulo, entrada, falha))
+        metricas.conta("imagens", efeito=rotulo, resultado="ok" if falha is None else "falha")
+        metricas.gravaPeriodico()
+    metricas.grava()
+    return countOK, len(tarefas) - countOK
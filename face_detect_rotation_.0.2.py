@@ -9,10 +9,18 @@
 # import the necessary packages
 import numpy as np
 import argparse, imutils
-import cv2, sys, glob, os, os.path, time
+import cv2, sys, glob, os, os.path, time, json
+import multiprocessing
+import metricas
 from shutil import copyfile
-
-start_time = time.time()
+from face_detector import FaceDetector, benchmark, carregaPerfil, PERFIL_PADRAO
+from angle_scheduler import AngleScheduler
+from prefetch_reader import PrefetchReader
+from corpus_split import parseShard, filtraShard, sufixoShard
+from duplicate_index import DuplicateIndex, agrupaDuplicados, hashTexto
+from face_scan import processaDocumento, processaDocumentoWorker, iniciaWorker
+from face_scan import DESTINO_FINAIS, DESTINO_2FACES, leManifesto, leDocumento
+import quality_gate
 
 # CONFIG
 cascPath = "haarcascade_frontalface_default.xml"
@@ -27,168 +35,357 @@ pastaRelatorios = "relatorios/"
 pastaFotos = "documentos/"
 pastaFotosFinais =  "documentos_finais/"
 pasta_2Faces_FotosFinais =  "documentos_finais_2Faces/"
-totalImagens = len([name for name in os.listdir(pastaFotos) if os.path.isfile(os.path.join(pastaFotos, name))])
-
-fFail = open(pastaRelatorios + 'out_DOC_FAIL_' + data + '.txt', 'w')
-fOK = open(pastaRelatorios + 'out_DOC_OK_' + data + '.txt', 'w')
-fFinal = open(pastaRelatorios + 'out_rel_final_' + data + '.txt', 'w')
-#print >> f, 'Filename:', filename
-#f.write('...\n')
-fFail.write("DOCUMENTOS QUE NAO FOI DETECTADO ROSTO:\n")
-fOK.write("DOCUMENTOS QUE FOI DETECTADO ROSTO:\n")
-fFinal.write("RELATORIO FINAL em " + data + "\n\n")
-fFinal.write("minSizeSetado: " + str(minSizeSetado) + "\n")
-
-
-def calculaRecorteFace(x,y,w,h,widthImage,heightImage):
-    # CALCULO O CENTRO DA FACE
-    centroX = (x + w) / 2
-    centroY = (y + h) / 2
-    # print("x,y,w,h: ",x,y,w,h)
-    # print("centroX,centroY: ",centroX,centroY)
-    novoW = int(centroX/2 + w)
-    if(novoW > widthImage):
-        novoW = w
-    novoH = int(centroY + h)
-    if(novoH > heightImage):
-        novoH = h
-    # print("novoW,novoH: ",w,h)
-    novoX = int(x - centroX/4)
-    if(novoX < 0):
-        novoX = x
-    novoY = int(y - centroY/2)
-    if(novoY < 0):
-        novoY = y
-    # print("novoX,novoY: ",x,y)
-    return novoX,novoY,novoW,novoH
-
-
-def verificaImagem( image, imageName, angulo ):
-    global minSizeSetado, pastaFotosFinais, pasta_2Faces_FotosFinais
-
-    # print("# Verificando Imagem {0} em {1} graus".format(imageName, angulo))
-    resultado = 0;
-
-    try:
-
-        # Create the haar cascade
-        faceCascade = cv2.CascadeClassifier(cascPath)
-
-        # Grayscale the image
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # Detect faces in the image
-        faces = faceCascade.detectMultiScale(
-           gray,
-           scaleFactor = 1.1,
-           minNeighbors = 4,
-           minSize = (minSizeSetado, minSizeSetado)
-           #flags = cv2.cv.CV_HAAR_SCALE_IMAGE
-        )
-
-        resultado = int(len(faces))
-
-        heightImage, widthImage, channels = image.shape
-
-        # 1 FACE
-        if(resultado == 1):
-            for (x,y,w,h) in faces:
-                nX, nY, nW, nH = calculaRecorteFace(x,y,w,h,widthImage,heightImage)
-                cropdFoto = image[nY:(nY+nH), nX:(nX+nW)] # Crop from x, y, w, h
-                cv2.imwrite(pastaFotosFinais + imageName, cropdFoto)
-
-        # MAIS DE 1
-        if(resultado > 1):
-            cv2.imwrite(pasta_2Faces_FotosFinais + imageName, image)
-
-    except Exception:
-        # fFail.write(imageName + ' = ERRO \n')
-        # countIMGFail = countIMGFail + 1
-        pass
-    except:
-        # fFail.write(imageName + ' = ERRO \n')
-        # countIMGFail = countIMGFail + 1
-        pass
-
-    # print("Encontrado {0} faces, in {1}".format(len(faces), imageName))
-    return resultado
-
-
-def verificaAngulosPredF(image, nomeImagem):
-    angulos = [45,90,180,270]
-    encontrado = 'n'
-    for angle in angulos:
-        try:
-            rotated = imutils.rotate_bound(image, angle)
-            qtdFaces = verificaImagem( rotated, nomeImagem, angle)
-            if(qtdFaces >= 1):
-                encontrado = 's'
-                break
-        except Exception:
-            pass
-        except:
-            pass
-    # Se não pegar, vai de 30 em 30
-    if(encontrado=='n'):
-        encontrado = verificaVariosAngulos(image, nomeImagem)
-
-    return encontrado
-
-def verificaVariosAngulos(image, nomeImagem):
-    encontrado = 'n'
-    for angle in np.arange(0, 300, 30):
-        try:
-            rotated = imutils.rotate_bound(image, angle)
-            qtdFaces = verificaImagem( rotated, nomeImagem, angle)
-            if(qtdFaces >= 1):
-                encontrado = 's'
-                break
-        except Exception:
-            pass
-        except:
-            pass
-    return encontrado
-
-
-for file in os.listdir( pastaFotos ):
-    #if file.endswith(sufixo) and file.endswith(prefixo,0,1):
-    if file.endswith(prefixo,0,1):
-        encontrado = 'n'
-        nomeImagem = file
-        image = cv2.imread(pastaFotos + nomeImagem)
-        # verificaOriginal
-        qtdFaces = verificaImagem(image, nomeImagem, 0)
-        if(qtdFaces >= 1):
-            encontrado = 's'
-        elif(qtdFaces==0):
-            # verifica angulos predefinidos
-            encontrado = verificaAngulosPredF(image,nomeImagem)
-        # FINAL
-        if(encontrado=='s'):
-            fOK.write('('+str(count)+')' + nomeImagem + ' = FACE ENCONTRADA \n')
+pendentes = []      # entradas do diario ainda nao gravadas
+countDuplicados = 0
+duplicados = {}     # --duplicados: nome -> (original, distancia)
+hashes = {}         # --duplicados: nome -> dHash
+originais = {}      # resultado dos originais que tem duplicados (ou entrada do diario, se retomado)
+fDuplicados = None
+rejeitados = {}     # --portao: motivo -> quantidade
+
+
+def benchmarkInicial():
+    for file in os.listdir( pastaFotos ):
+        if file.endswith(prefixo,0,1):
+            image = cv2.imread(pastaFotos + file)
+            if image is None:
+                continue
+            tempos = benchmark(cascPath, image, minSize=minSizeSetado)
+            linha = ("BENCHMARK CASCADE ({0}): carga {1:.4f}s, deteccao {2:.4f}s, "
+                     "economia por documento ({3} tentativas): {4:.4f}s\n").format(
+                     file, tempos['tempoCarga'], tempos['tempoDeteccao'],
+                     tempos['tentativas'], tempos['economiaPorDoc'])
+            print(linha.strip())
+            fFinal.write(linha)
+            return
+
+
+def escreveResultado(resultado):
+    # UNICO ESCRITOR: RECORTES, RELATORIOS E CONTADORES
+    global count, countIMGOK, countIMGFail
+
+    nomeImagem = resultado['nome']
+    duplicadoDe = resultado.get('duplicadoDe')
+    motivo = resultado.get('motivo')
+    metricas.mescla(resultado.pop('metricas', None))
+    caminhoSaida = None
+    if resultado['imagem'] is not None:
+        if resultado['destino'] == DESTINO_2FACES:
+            pastaDestino = pasta_2Faces_FotosFinais
+        else:
+            pastaDestino = pastaFotosFinais
+        caminhoSaida = pastaDestino + nomeImagem
+        with metricas.tempo("write"):
+            with open(caminhoSaida, 'wb') as fImagem:
+                fImagem.write(resultado['imagem'])
+
+    # FINAL
+    marca = ' (DUPLICADO DE ' + duplicadoDe + ')' if duplicadoDe is not None else ''
+    if(resultado['qtdFaces'] >= 1):
+        fOK.write('('+str(count)+')' + nomeImagem + ' = FACE ENCONTRADA' + marca + ' \n')
+        countIMGOK = countIMGOK + 1
+    else:
+        fFail.write('('+str(count)+')' + nomeImagem + ' = FACE NAO ENCONTRADA' +
+                    quality_gate.marcaMotivo(motivo) + marca + ' \n')
+        countIMGFail = countIMGFail + 1
+    if motivo is not None:
+        rejeitados[motivo] = rejeitados.get(motivo, 0) + 1
+    metricas.conta("documentos", resultado="ok" if resultado['qtdFaces'] >= 1 else "fail",
+                   duplicado="sim" if duplicadoDe is not None else "nao")
+    metricas.conta("chamadas_detector", resultado['chamadas'])
+    if duplicadoDe is None and motivo is None:
+        # DUPLICADO E BARRADO NO PORTAO NAO RODARAM O DETECTOR: NAO ENTRAM NA ESTATISTICA DOS ANGULOS
+        agendador.registra(resultado['angulo'], resultado['chamadas'])
+    if nomeImagem in originais:
+        originais[nomeImagem] = resultado
+
+    # caixa: FACE (x,y,w,h) NO RECORTE E angulo VENCEDOR, LIDOS PELO align-dlib.py --boxes
+    pendentes.append({'n': count, 'nome': nomeImagem, 'qtdFaces': resultado['qtdFaces'],
+                      'angulo': resultado['angulo'], 'chamadas': resultado['chamadas'],
+                      'saida': caminhoSaida, 'caixa': resultado['caixa']})
+    if nomeImagem in hashes:
+        pendentes[-1]['hash'] = hashTexto(hashes[nomeImagem])
+    if duplicadoDe is not None:
+        pendentes[-1]['duplicadoDe'] = duplicadoDe
+    if motivo is not None:
+        pendentes[-1]['motivo'] = motivo
+    pendentes[-1]['relatorios'] = posicoesRelatorios()
+    if len(pendentes) >= tamanhoCheckpoint:
+        gravaCheckpoint()
+
+    count = count + 1
+    metricas.gravaPeriodico()
+    if count % 500 == 0:
+        print("Verificando Documento {0} de {1} - {2}".format(count, totalImagens, nomeImagem))
+
+
+def escreveDuplicado(nomeImagem):
+    # REAPROVEITA O RESULTADO DO ORIGINAL (QTD FACES, ANGULO E RECORTE)
+    global countDuplicados
+    original, distancia = duplicados[nomeImagem]
+    resultado = dict(originais[original])
+    if 'imagem' not in resultado:
+        # ORIGINAL DE UMA EXECUCAO ANTERIOR (--retomar): O RECORTE ESTA NO DISCO
+        imagem = None
+        if resultado.get('saida') and os.path.isfile(resultado['saida']):
+            with open(resultado['saida'], 'rb') as fImagem:
+                imagem = fImagem.read()
+        destino = DESTINO_2FACES if resultado.get('saida', '') and \
+            resultado['saida'].startswith(pasta_2Faces_FotosFinais) else DESTINO_FINAIS
+        resultado = {'qtdFaces': resultado['qtdFaces'], 'angulo': resultado['angulo'],
+                     'caixa': resultado.get('caixa'), 'destino': destino, 'imagem': imagem,
+                     'motivo': resultado.get('motivo')}
+    resultado['nome'] = nomeImagem
+    resultado['chamadas'] = 0
+    resultado['duplicadoDe'] = original
+    fDuplicados.write('(' + str(count) + ')' + nomeImagem + ' = DUPLICADO DE ' + original +
+                      ' (DISTANCIA ' + str(distancia) + ') \n')
+    countDuplicados = countDuplicados + 1
+    escreveResultado(resultado)
+
+
+def relatorios():
+    # CHAVE (NO DIARIO) -> ARQUIVO DE RELATORIO ABERTO
+    abertos = {'ok': fOK, 'fail': fFail, 'final': fFinal}
+    if fDuplicados is not None:
+        abertos['duplicados'] = fDuplicados
+    return abertos
+
+
+def posicoesRelatorios():
+    # ONDE CADA RELATORIO TERMINA DEPOIS DAS LINHAS DESTE DOCUMENTO (O --retomar CORTA AI)
+    return dict((chave, f.tell()) for chave, f in relatorios().items())
+
+
+def cortaRelatorios(caminhos, posicoes):
+    """
+    Descarta dos relatorios o que foi escrito depois da ultima entrada
+    gravada no diario: esses documentos vao ser processados de novo.
+    """
+    for chave, posicao in posicoes.items():
+        caminho = caminhos.get(chave)
+        if caminho is None or not os.path.isfile(caminho):
+            continue
+        if os.path.getsize(caminho) < posicao:
+            print("AVISO: " + caminho + " e menor que o registrado no diario")
+            continue
+        with open(caminho, 'r+b') as fTrunca:
+            fTrunca.truncate(posicao)
+
+
+def gravaCheckpoint():
+    # RELATORIOS PRIMEIRO: O DIARIO SO APONTA PARA POSICOES JA GRAVADAS NELES
+    for f in relatorios().values():
+        f.flush()
+        os.fsync(f.fileno())
+    for entrada in pendentes:
+        fManifesto.write(json.dumps(entrada) + "\n")
+    fManifesto.flush()
+    os.fsync(fManifesto.fileno())
+    del pendentes[:]
+
+
+def retomaManifesto(entradas):
+    # DOCUMENTOS JA GRAVADOS NO DIARIO: RESTAURA CONTADORES E ESTATISTICAS DOS ANGULOS
+    global count, countIMGOK, countIMGFail, countDuplicados
+    for entrada in entradas:
+        if entrada['qtdFaces'] >= 1:
             countIMGOK = countIMGOK + 1
         else:
-            fFail.write('('+str(count)+')' + nomeImagem + ' = FACE NAO ENCONTRADA \n')
             countIMGFail = countIMGFail + 1
+        if entrada.get('motivo'):
+            rejeitados[entrada['motivo']] = rejeitados.get(entrada['motivo'], 0) + 1
+        if entrada.get('duplicadoDe') is not None:
+            countDuplicados = countDuplicados + 1
+        elif not entrada.get('motivo'):
+            agendador.registra(entrada['angulo'], entrada.get('chamadas', 0))
         count = count + 1
-        if count % 500 == 0:
-            print("Verificando Documento {0} de {1} - {2}".format(count, totalImagens, nomeImagem))
+    return set(entrada['nome'] for entrada in entradas)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--benchmark", action="store_true",
+        help="mede, no inicio, o tempo economizado por documento com o cascade compartilhado")
+    ap.add_argument("--workers", type=int, default=1,
+        help="quantidade de processos; cada um carrega o seu proprio cascade")
+    ap.add_argument("--busca", choices=["exaustiva", "coarse"], default="exaustiva",
+        help="coarse: testa todos os angulos numa copia reduzida em cinza e confirma so o melhor")
+    ap.add_argument("--ladoBusca", type=int, default=800,
+        help="maior lado, em pixels, da copia reduzida usada na busca coarse")
+    ap.add_argument("--ordemAdaptativa", action="store_true",
+        help="testa primeiro os angulos que mais encontraram faces no lote")
+    ap.add_argument("--retomar", action="store_true",
+        help="pula os documentos ja gravados no diario e continua os relatorios em vez de sobrescrever")
+    ap.add_argument("--checkpoint", type=int, default=100,
+        help="documentos entre cada gravacao do diario")
+    ap.add_argument("--prefetch", type=int, default=8,
+        help="documentos lidos a frente, em threads, no modo sequencial (limita a memoria)")
+    ap.add_argument("--decodeReduzido", type=int, choices=[1, 2, 4, 8], default=1,
+        help="busca no JPEG decodificado em 1/N (cinza); le inteiro so quando acha face")
+    ap.add_argument("--shard", type=parseShard,
+        help="i/N: processa so a parte i de N do corpus (hash do nome); junte com merge_relatorios.py")
+    ap.add_argument("--duplicados", action="store_true",
+        help="pre-passagem com hash perceptual: documentos repetidos reaproveitam o resultado do primeiro")
+    ap.add_argument("--distanciaDuplicado", type=int, choices=range(8), default=4,
+        help="bits de diferenca (de 64) aceitos entre os hashes de dois documentos iguais")
+    ap.add_argument("--perfil",
+        help="JSON com scaleFactor, minNeighbors, minSize, minSizeRelativo, maxSizeRelativo e reducao "
+             "do detectMultiScale (gravado pelo detector_tuning.py)")
+    ap.add_argument("--portao", action="store_true",
+        help="descarta antes da busca os documentos que nao podem ter face (em branco, escuros, "
+             "borrados, menores que minSizeSetado); o motivo vai para o out_DOC_FAIL")
+    ap.add_argument("--limiarContraste", type=float, default=quality_gate.LIMIAR_CONTRASTE,
+        help="portao: diferenca minima entre os tons p0.1 e p99.9 da miniatura")
+    ap.add_argument("--limiarNitidez", type=float, default=quality_gate.LIMIAR_NITIDEZ,
+        help="portao: variancia minima do laplaciano no bloco mais nitido")
+    ap.add_argument("--metricas",
+        help="liga as metricas por etapa e grava <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    ap.add_argument("--intervaloMetricas", type=float, default=30,
+        help="segundos entre as gravacoes das metricas")
+    args = vars(ap.parse_args())
+    if args["decodeReduzido"] > 1 and args["busca"] == "coarse":
+        ap.error("--decodeReduzido vale para a busca exaustiva")
+    tamanhoCheckpoint = args["checkpoint"]
+    perfil = carregaPerfil(args["perfil"]) if args["perfil"] else dict(PERFIL_PADRAO, minSize=minSizeSetado)
+    minSizeSetado = perfil['minSize']
+    data = data + sufixoShard(args["shard"])
+    opcoes = {'busca': args["busca"], 'ladoBusca': args["ladoBusca"],
+              'ordemAdaptativa': args["ordemAdaptativa"], 'reducao': args["decodeReduzido"],
+              'metricas': bool(args["metricas"]), 'portao': args["portao"],
+              'limiarContraste': args["limiarContraste"], 'limiarNitidez': args["limiarNitidez"],
+              'perfil': perfil}
+    if args["metricas"]:
+        metricas.configura(args["metricas"], args["intervaloMetricas"])
+
+    # SEM REPETIR ANGULOS; NO MODO --workers TAMBEM SO CONTABILIZA (CADA WORKER APRENDE A SUA ORDEM)
+    agendador = AngleScheduler(args["ordemAdaptativa"])
+
+    start_time = time.time()
+
+    totalImagens = len([name for name in os.listdir(pastaFotos) if os.path.isfile(os.path.join(pastaFotos, name))])
+
+    # DIARIO POR DOCUMENTO (QTD FACES, ANGULO, SAIDA) PARA PODER RETOMAR
+    caminhoManifesto = pastaRelatorios + 'manifesto_' + data + '.jsonl'
+    entradasRetomadas, fimManifesto = leManifesto(caminhoManifesto) if args["retomar"] else ([], 0)
+    feitos = retomaManifesto(entradasRetomadas)
+    retomando = len(feitos) > 0
+    modo = 'a' if retomando else 'w'
+
+    #arquivos = [f for f in os.listdir(pastaFotos) if f.endswith(sufixo) and f.endswith(prefixo,0,1)]
+    arquivos = [f for f in os.listdir(pastaFotos) if f.endswith(prefixo,0,1) and f not in feitos]
+    arquivos = filtraShard(arquivos, args["shard"])
+    if retomando and not arquivos:
+        # EXECUCAO JA TERMINADA: NAO ACRESCENTA OUTRO RETOMADO NEM OUTRO RODAPE
+        print("RETOMADO: " + str(len(feitos)) + " documentos ja processados, nada novo")
+        sys.exit(0)
+
+    caminhosRelatorios = {'fail': pastaRelatorios + 'out_DOC_FAIL_' + data + '.txt',
+                          'ok': pastaRelatorios + 'out_DOC_OK_' + data + '.txt',
+                          'final': pastaRelatorios + 'out_rel_final_' + data + '.txt',
+                          'duplicados': pastaRelatorios + 'out_DOC_DUPLICADOS_' + data + '.txt'}
+    if retomando:
+        # DESCARTA A LINHA PELA METADE, SENAO A PRIMEIRA ENTRADA NOVA GRUDA NELA
+        with open(caminhoManifesto, 'r+b') as fTrunca:
+            fTrunca.truncate(fimManifesto)
+        # E AS LINHAS (E O RODAPE) ESCRITAS DEPOIS DO ULTIMO CHECKPOINT; DIARIO ANTIGO NAO TEM AS POSICOES
+        cortaRelatorios(caminhosRelatorios, entradasRetomadas[-1].get('relatorios', {}))
+    fFail = open(caminhosRelatorios['fail'], modo)
+    fOK = open(caminhosRelatorios['ok'], modo)
+    fFinal = open(caminhosRelatorios['final'], modo)
+    fManifesto = open(caminhoManifesto, modo)
+    #print >> f, 'Filename:', filename
+    #f.write('...\n')
+    if retomando:
+        fFinal.write("\nRETOMADO: " + str(len(feitos)) + " documentos ja processados\n")
+    else:
+        fFail.write("DOCUMENTOS QUE NAO FOI DETECTADO ROSTO:\n")
+        fOK.write("DOCUMENTOS QUE FOI DETECTADO ROSTO:\n")
+        fFinal.write("RELATORIO FINAL em " + data + "\n\n")
+        fFinal.write("minSizeSetado: " + str(minSizeSetado) + "\n")
+    fFinal.write("busca: " + args["busca"] + "\n")
+    if args["perfil"]:
+        fFinal.write("perfil: " + args["perfil"] + " " + json.dumps(perfil, sort_keys=True) + "\n")
+    if args["shard"] is not None:
+        fFinal.write("shard: " + str(args["shard"][0]) + "/" + str(args["shard"][1]) + "\n")
+    if args["portao"]:
+        fFinal.write("portao: contraste " + str(args["limiarContraste"]) +
+                     ", nitidez " + str(args["limiarNitidez"]) + "\n")
+    if args["decodeReduzido"] > 1:
+        fFinal.write("decodeReduzido: 1/" + str(args["decodeReduzido"]) + "\n")
+    if args["duplicados"]:
+        fDuplicados = open(caminhosRelatorios['duplicados'], modo)
+        if not retomando:
+            fDuplicados.write("DOCUMENTOS RESOLVIDOS COMO DUPLICADOS:\n")
+
+    if args["benchmark"]:
+        benchmarkInicial()
+
+    if args["duplicados"]:
+        # PRE-PASSAGEM NAS MINIATURAS; OS ORIGINAIS DE UMA EXECUCAO ANTERIOR TAMBEM CONTAM
+        indice = DuplicateIndex(args["distanciaDuplicado"])
+        anteriores = dict((entrada['nome'], entrada) for entrada in entradasRetomadas)
+        for entrada in entradasRetomadas:
+            if entrada.get('hash') and entrada.get('duplicadoDe') is None:
+                indice.adiciona(int(entrada['hash'], 16), entrada['nome'])
+        hashes, duplicados = agrupaDuplicados([(nomeImagem, pastaFotos + nomeImagem) for nomeImagem in arquivos],
+                                              indice)
+        for original, distancia in duplicados.values():
+            originais[original] = anteriores.get(original)
+        print("Duplicados: {0} de {1} documentos".format(len(duplicados), len(arquivos)))
+    unicos = [nomeImagem for nomeImagem in arquivos if nomeImagem not in duplicados]
+
+    pool = None
+    if args["workers"] > 1:
+        # imap MANTEM A ORDEM, ENTAO A NUMERACAO DOS RELATORIOS NAO MUDA
+        pool = multiprocessing.Pool(args["workers"], iniciaWorker, (cascPath, minSizeSetado, opcoes))
+        tarefas = [(pastaFotos, nomeImagem) for nomeImagem in unicos]
+        resultados = pool.imap(processaDocumentoWorker, tarefas, 4)
+    else:
+        # CASCADE CARREGADO UMA UNICA VEZ PARA TODA A VARREDURA
+        detector = FaceDetector(cascPath, **perfil)
+        leitor = PrefetchReader([(nomeImagem, pastaFotos + nomeImagem) for nomeImagem in unicos],
+                                lambda caminho: leDocumento(caminho, opcoes['reducao']),
+                                emVoo=args["prefetch"])
+        resultados = (processaDocumento(detector, pastaFotos, nomeImagem, opcoes, agendador, image)
+                      for nomeImagem, image in leitor)
+
+    # NA ORDEM DE arquivos: O ORIGINAL SEMPRE E ESCRITO ANTES DOS SEUS DUPLICADOS
+    for nomeImagem in arquivos:
+        if nomeImagem in duplicados:
+            escreveDuplicado(nomeImagem)
+        else:
+            escreveResultado(next(resultados))
         # if count > 50:
         #     print("# break, count > 50")
         #     break
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    gravaCheckpoint()
+    fManifesto.close()
+    metricas.grava()
 
-fFail.write("\n\n QTD:" + str(countIMGFail) + "\n")
-fOK.write("\n\n QTD:" + str(countIMGOK) + "\n")
+    fFail.write("\n\n QTD:" + str(countIMGFail) + "\n")
+    fOK.write("\n\n QTD:" + str(countIMGOK) + "\n")
 
-fFinal.write("\nQTD DOC NA PASTA:" + str(totalImagens) + "\n")
-fFinal.write("\nQTD DOC ANALISADAS:" + str(count) + "\n")
-fFinal.write("QTD DOC OK:" + str(countIMGOK) + "\n")
-fFinal.write("QTD DOC FAIL:" + str(countIMGFail) + "\n\n")
+    fFinal.write("\nQTD DOC NA PASTA:" + str(totalImagens) + "\n")
+    fFinal.write("\nQTD DOC ANALISADAS:" + str(count) + "\n")
+    fFinal.write("QTD DOC OK:" + str(countIMGOK) + "\n")
+    fFinal.write("QTD DOC FAIL:" + str(countIMGFail) + "\n\n")
+    if fDuplicados is not None:
+        fFinal.write("QTD DOC DUPLICADOS:" + str(countDuplicados) + "\n\n")
+        fDuplicados.write("\n\n QTD:" + str(countDuplicados) + "\n")
+        fDuplicados.close()
+    if args["portao"]:
+        fFinal.write(quality_gate.resumo(rejeitados))
+    fFinal.write(agendador.resumo())
 
-# fFinal.write("DOCUMENTOS BONS COPIADOS PARA A PASTA: " + str(pastaFotosFinais) + "\n\n")
-fFinal.write("\nTEMPO DE EXECUCAO: %s segundos." % (time.time() - start_time) + "\n\n")
+    # fFinal.write("DOCUMENTOS BONS COPIADOS PARA A PASTA: " + str(pastaFotosFinais) + "\n\n")
+    fFinal.write("\nTEMPO DE EXECUCAO: %s segundos." % (time.time() - start_time) + "\n\n")
 
-fFail.close()
-fOK.close()
-fFinal.close()
+    fFail.close()
+    fOK.close()
+    fFinal.close()
@@ -0,0 +1,195 @@
+# DETECTOR HAAR REUTILIZAVEL
+#
+# face_detector.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+import numpy as np
+import imutils
+import cv2, json, time
+import metricas
+
+# PARAMETROS DO detectMultiScale (OS VALORES DE SEMPRE); UM --perfil SOBRESCREVE
+# minSizeRelativo/maxSizeRelativo: FRACAO DO MENOR LADO DO DOCUMENTO (0 = NAO USA)
+# reducao: O CASCADE RODA NA IMAGEM REDUZIDA EM 1/reducao (1 = RESOLUCAO CHEIA)
+PERFIL_PADRAO = {
+    'scaleFactor': 1.1,
+    'minNeighbors': 4,
+    'minSize': 72,
+    'minSizeRelativo': 0.0,
+    'maxSizeRelativo': 0.0,
+    'reducao': 1.0,
+}
+
+
+class FaceDetector:
+    """
+    Detector Haar que carrega o cascade uma unica vez e reaproveita o
+    buffer de escala de cinza entre as chamadas.
+
+    Deve ser criado uma vez (por processo) e compartilhado por toda a
+    varredura dos documentos.
+
+    Os parametros sao os de PERFIL_PADRAO (detector_tuning.py escolhe).
+    """
+
+    def __init__(self, cascPath, minSize=72, scaleFactor=1.1, minNeighbors=4,
+                 minSizeRelativo=0.0, maxSizeRelativo=0.0, reducao=1.0):
+        self.cascPath = cascPath
+        self.minSize = minSize
+        self.scaleFactor = scaleFactor
+        self.minNeighbors = minNeighbors
+        self.minSizeRelativo = minSizeRelativo
+        self.maxSizeRelativo = maxSizeRelativo
+        self.reducao = reducao
+
+        self.cascade = cv2.CascadeClassifier(cascPath)
+        if self.cascade.empty():
+            raise IOError("Nao foi possivel carregar o cascade {0}".format(cascPath))
+
+        # BUFFER LINEAR, SO CRESCE QUANDO APARECE UMA IMAGEM MAIOR
+        self.bufferGray = np.empty(0, np.uint8)
+
+    def toGray(self, image):
+        """
+        Converte a imagem BGR para cinza dentro do buffer reaproveitado.
+        A imagem retornada so e valida ate a proxima chamada.
+        """
+        if image.ndim == 2:
+            return image
+        h, w = image.shape[:2]
+        if self.bufferGray.size < h * w:
+            self.bufferGray = np.empty(h * w, np.uint8)
+        gray = self.bufferGray[:h * w].reshape(h, w)
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+        return gray
+
+    def tamanhos(self, image, minSize=None):
+        """
+        :param minSize: sobrescreve o minSize (e o minSizeRelativo).
+        :return: (minSize, maxSize) em pixels para `image`; maxSize 0 e sem limite.
+        """
+        lado = min(image.shape[:2])
+        if minSize is None:
+            minSize = max(self.minSize, int(self.minSizeRelativo * lado))
+        maxSize = int(self.maxSizeRelativo * lado) if self.maxSizeRelativo else 0
+        return minSize, maxSize
+
+    def detectaCinza(self, gray, minSize, maxSize, comVizinhos=False):
+        """
+        Roda o cascade em `gray`. Com reducao > 1 ele roda numa copia menor
+        e as faces voltam para a escala de `gray`; vale para as duas buscas
+        (exaustiva e coarse), entao um perfil se comporta igual nas duas.
+
+        :param comVizinhos: usa o detectMultiScale2 e devolve tambem quantas
+                            deteccoes vizinhas foram agrupadas em cada face.
+        :return: faces, ou (faces, vizinhos) com `comVizinhos`.
+        """
+        reducao = self.reducao
+        if reducao > 1:
+            h, w = gray.shape
+            with metricas.tempo("resize"):
+                gray = cv2.resize(gray, (max(1, int(w / reducao)), max(1, int(h / reducao))),
+                                  interpolation=cv2.INTER_AREA)
+            minSize = max(self.windowSize(), int(round(minSize / reducao)))
+            maxSize = int(maxSize / reducao)
+        parametros = {'scaleFactor': self.scaleFactor, 'minNeighbors': self.minNeighbors,
+                      'minSize': (minSize, minSize)}
+        if maxSize > 0:
+            parametros['maxSize'] = (maxSize, maxSize)
+        with metricas.tempo("detectMultiScale"):
+            if comVizinhos:
+                faces, vizinhos = self.cascade.detectMultiScale2(gray, **parametros)
+            else:
+                faces = self.cascade.detectMultiScale(gray, **parametros)
+        if reducao > 1 and len(faces) > 0:
+            faces = np.int32(np.round(np.asarray(faces) * reducao))
+        return (faces, vizinhos) if comVizinhos else faces
+
+    def detect(self, image, angle=0, minSize=None):
+        """
+        Roda o cascade na imagem rotacionada de `angle` graus.
+
+        :param minSize: sobrescreve o minSize do detector (ex.: em uma
+                        copia reduzida do documento).
+        :return: (faces, imagem rotacionada) - as faces estao nas
+                 coordenadas da imagem rotacionada.
+        """
+        # TAMANHOS RELATIVOS AO DOCUMENTO, NAO A IMAGEM ROTACIONADA (QUE CRESCE NOS 45 GRAUS)
+        minSize, maxSize = self.tamanhos(image, minSize)
+        if angle != 0:
+            with metricas.tempo("rotate"):
+                image = imutils.rotate_bound(image, angle)
+
+        with metricas.tempo("cvtColor"):
+            gray = self.toGray(image)
+        faces = self.detectaCinza(gray, minSize, maxSize)
+        return faces, image
+
+    def detectWithScore(self, image, minSize=None):
+        """
+        Como `detect` (sem rotacao), mas devolve tambem quantas deteccoes
+        vizinhas foram agrupadas em cada face, usado como confianca.
+
+        :return: (faces, vizinhos)
+        """
+        minSize, maxSize = self.tamanhos(image, minSize)
+
+        with metricas.tempo("cvtColor"):
+            gray = self.toGray(image)
+        return self.detectaCinza(gray, minSize, maxSize, comVizinhos=True)
+
+    def windowSize(self):
+        # MENOR FACE QUE O CASCADE CONSEGUE ENXERGAR (24x24 NO FRONTALFACE)
+        return min(self.cascade.getOriginalWindowSize())
+
+
+def carregaPerfil(caminho):
+    """
+    Le um perfil (JSON) gravado pelo detector_tuning.py. Chaves que faltam
+    ficam com o PERFIL_PADRAO.
+
+    :return: dict com todas as chaves de PERFIL_PADRAO.
+    """
+    with open(caminho) as fPerfil:
+        lido = json.load(fPerfil)
+    # O detector_tuning GRAVA TAMBEM AS MEDIDAS (recall, porSegundo) EM "medidas"
+    lido = lido.get('parametros', lido)
+    desconhecidas = set(lido) - set(PERFIL_PADRAO)
+    if desconhecidas:
+        raise ValueError("perfil {0}: parametros desconhecidos {1}".format(caminho, ", ".join(sorted(desconhecidas))))
+    perfil = dict(PERFIL_PADRAO)
+    perfil.update(lido)
+    return perfil
+
+
+def benchmark(cascPath, image, tentativas=15, repeticoes=5, minSize=72):
+    """
+    Compara o custo de criar o cascade a cada tentativa (comportamento
+    antigo) com o detector compartilhado.
+
+    :param tentativas: chamadas ao detector por documento no pior caso
+                       (original + 4 angulos predefinidos + 10 de 30 em 30).
+    :return: dict com os tempos medios, em segundos.
+    """
+    inicio = time.time()
+    for i in range(repeticoes):
+        cv2.CascadeClassifier(cascPath)
+    tempoCarga = (time.time() - inicio) / repeticoes
+
+    detector = FaceDetector(cascPath, minSize)
+    inicio = time.time()
+    for i in range(repeticoes):
+        detector.detect(image, 0)
+    tempoDeteccao = (time.time() - inicio) / repeticoes
+
+    return {
+        'tempoCarga': tempoCarga,
+        'tempoDeteccao': tempoDeteccao,
+        'tentativas': tentativas,
+        'docAntigo': tentativas * (tempoCarga + tempoDeteccao),
+        'docNovo': tentativas * tempoDeteccao,
+        'economiaPorDoc': tentativas * tempoCarga,
+    }
@@ -0,0 +1,436 @@
+# VARREDURA DE UM DOCUMENTO: DETECCAO COM ROTACAO E RECORTE DA FACE
+#
+# face_scan.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+import numpy as np
+import cv2, os, json
+import metricas
+from face_detector import FaceDetector
+from angle_scheduler import AngleScheduler, ANGULOS_BUSCA
+from quality_gate import avaliaQualidade, LIMIAR_CONTRASTE, LIMIAR_NITIDEZ
+
+# DESTINOS DO RECORTE (A ESCRITA E FEITA POR QUEM RECEBE O RESULTADO)
+DESTINO_FINAIS = "finais"
+DESTINO_2FACES = "2faces"
+
+# LEITURA REDUZIDA (JA EM CINZA) PARA A BUSCA: O DECODER DO JPEG ESCALA NO DCT
+FLAGS_REDUZIDO = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# DETECTOR DO PROCESSO (UM POR WORKER)
+detectorWorker = None
+opcoesWorker = None
+agendadorWorker = None
+
+
+def calculaRecorteFace(x,y,w,h,widthImage,heightImage):
+    # CALCULO O CENTRO DA FACE
+    centroX = (x + w) / 2
+    centroY = (y + h) / 2
+    # print("x,y,w,h: ",x,y,w,h)
+    # print("centroX,centroY: ",centroX,centroY)
+    novoW = int(centroX/2 + w)
+    if(novoW > widthImage):
+        novoW = w
+    novoH = int(centroY + h)
+    if(novoH > heightImage):
+        novoH = h
+    # print("novoW,novoH: ",w,h)
+    novoX = int(x - centroX/4)
+    if(novoX < 0):
+        novoX = x
+    novoY = int(y - centroY/2)
+    if(novoY < 0):
+        novoY = y
+    # print("novoX,novoY: ",x,y)
+    return novoX,novoY,novoW,novoH
+
+
+def recortaFace(image, face):
+    """
+    Recorta a face (x,y,w,h) de `image` com a margem de calculaRecorteFace.
+
+    :return: saida (DESTINO_FINAIS, recorte, caixa) - caixa e a face
+             (x,y,w,h) nas coordenadas do recorte, para o alinhamento nao
+             precisar detectar de novo.
+    """
+    (x, y, w, h) = face
+    heightImage, widthImage = image.shape[:2]
+    with metricas.tempo("crop"):
+        nX, nY, nW, nH = calculaRecorteFace(x, y, w, h, widthImage, heightImage)
+        cropdFoto = image[nY:(nY+nH), nX:(nX+nW)] # Crop from x, y, w, h
+    # O RECORTE PODE TER SIDO CORTADO NA BORDA DA IMAGEM
+    cX, cY = max(0, x - nX), max(0, y - nY)
+    cW = min(w, cropdFoto.shape[1] - cX)
+    cH = min(h, cropdFoto.shape[0] - cY)
+    return DESTINO_FINAIS, cropdFoto, (int(cX), int(cY), int(cW), int(cH))
+
+
+def verificaImagem(detector, image, imageName, angulo):
+    """
+    Procura faces na imagem rotacionada de `angulo` graus.
+
+    :return: (qtdFaces, saida) - saida e (destino, imagem, caixa) a ser
+             gravada, ou None se nada foi encontrado. caixa e a face no
+             recorte (so com 1 face; com mais, None).
+    """
+    # print("# Verificando Imagem {0} em {1} graus".format(imageName, angulo))
+    resultado = 0
+    saida = None
+
+    try:
+        # Rotate and detect faces in the image
+        faces, image = detector.detect(image, angulo)
+
+        resultado = int(len(faces))
+
+        # 1 FACE
+        if(resultado == 1):
+            saida = recortaFace(image, faces[0])
+
+        # MAIS DE 1
+        if(resultado > 1):
+            saida = (DESTINO_2FACES, image, None)
+
+    except Exception:
+        pass
+
+    # print("Encontrado {0} faces, in {1}".format(len(faces), imageName))
+    return resultado, saida
+
+
+def verificaAngulos(detector, image, nomeImagem, angulos):
+    """
+    :return: (qtdFaces, angulo, saida, chamadas) - para no primeiro angulo
+             com face; chamadas e quantas vezes o detector rodou.
+    """
+    chamadas = 0
+    for angle in angulos:
+        chamadas += 1
+        metricas.conta("angulo_tentativas", angulo=angle)
+        qtdFaces, saida = verificaImagem(detector, image, nomeImagem, angle)
+        if(qtdFaces >= 1):
+            metricas.conta("angulo_sucessos", angulo=angle)
+            return qtdFaces, angle, saida, chamadas
+    return 0, None, None, chamadas
+
+
+def matrizRotacao(w, h, angulo):
+    """
+    Mesma matriz do imutils.rotate_bound, para poder levar coordenadas de
+    um lado para o outro da rotacao.
+
+    :return: (M, nW, nH)
+    """
+    (cX, cY) = (w / 2.0, h / 2.0)
+    M = cv2.getRotationMatrix2D((cX, cY), -angulo, 1.0)
+    cos = np.abs(M[0, 0])
+    sin = np.abs(M[0, 1])
+    nW = int((h * sin) + (w * cos))
+    nH = int((h * cos) + (w * sin))
+    M[0, 2] += (nW / 2.0) - cX
+    M[1, 2] += (nH / 2.0) - cY
+    return M, nW, nH
+
+
+def mapeiaFace(face, mOrigem, escala, mDestino):
+    """
+    Leva uma face (x,y,w,h) detectada em uma imagem reduzida e rotacionada
+    (matriz mOrigem) para a imagem original rotacionada (matriz mDestino).
+    O centro passa pelas duas rotacoes; o tamanho so muda de escala.
+    """
+    (x, y, w, h) = face
+    inversa = cv2.invertAffineTransform(mOrigem)
+    centro = np.array([x + w / 2.0, y + h / 2.0, 1.0])
+    cx, cy = inversa.dot(centro) / escala
+    cx, cy = mDestino.dot(np.array([cx, cy, 1.0]))
+    w = w / escala
+    h = h / escala
+    return int(round(cx - w / 2.0)), int(round(cy - h / 2.0)), int(round(w)), int(round(h))
+
+
+def confirmaFace(detector, rotated, face):
+    """
+    Confirma em resolucao cheia, rodando o cascade apenas numa janela em
+    volta da face mapeada.
+
+    :return: face confirmada nas coordenadas de `rotated`, ou None.
+    """
+    (x, y, w, h) = face
+    margem = max(w, h) // 2
+    heightImage, widthImage = rotated.shape[:2]
+    x0, y0 = max(0, x - margem), max(0, y - margem)
+    x1, y1 = min(widthImage, x + w + margem), min(heightImage, y + h + margem)
+    if x1 - x0 < detector.minSize or y1 - y0 < detector.minSize:
+        return None
+    faces, rotated = detector.detect(rotated[y0:y1, x0:x1], 0)
+    if len(faces) == 0:
+        return None
+    # FICA COM A MAIOR DA JANELA
+    (fx, fy, fw, fh) = max(faces, key=lambda f: f[2] * f[3])
+    return x0 + fx, y0 + fy, fw, fh
+
+
+def buscaCoarseToFine(detector, image, nomeImagem, angulos=ANGULOS_BUSCA, ladoBusca=800, vizinhosAceite=8):
+    """
+    Testa os angulos numa copia reduzida em cinza, escolhe o angulo com
+    mais deteccoes agrupadas e so entao rotaciona a imagem original uma
+    vez para confirmar e recortar.
+
+    :param ladoBusca: maior lado da copia reduzida, em pixels. Na copia o
+                      minSize cai na mesma proporcao (nunca abaixo da janela
+                      do cascade), entao faces muito pequenas so aparecem
+                      na busca exaustiva.
+    :param vizinhosAceite: um angulo com pelo menos essa quantidade de
+                           deteccoes agrupadas encerra a varredura na hora.
+    :return: (qtdFaces, angulo, saida, chamadas), como verificaAngulos.
+    """
+    heightImage, widthImage = image.shape[:2]
+    escala = min(1.0, float(ladoBusca) / max(heightImage, widthImage))
+    minSizeReduzido = max(detector.windowSize(), int(detector.minSize * escala))
+    reduzida = cv2.resize(detector.toGray(image), (int(widthImage * escala), int(heightImage * escala)),
+                          interpolation=cv2.INTER_AREA)
+    escala = float(reduzida.shape[1]) / widthImage
+
+    candidatos = []
+    chamadas = 0
+    for angulo in angulos:
+        mReduzida, nW, nH = matrizRotacao(reduzida.shape[1], reduzida.shape[0], angulo)
+        with metricas.tempo("rotate"):
+            rotacionada = cv2.warpAffine(reduzida, mReduzida, (nW, nH))
+        faces, vizinhos = detector.detectWithScore(rotacionada, minSizeReduzido)
+        metricas.conta("angulo_tentativas", angulo=angulo)
+        chamadas += 1
+        if len(faces) == 0:
+            continue
+        if max(vizinhos) >= vizinhosAceite:
+            # CANDIDATO FORTE: CONFIRMA JA; SE NAO CONFIRMAR, SEGUE A VARREDURA
+            qtdFaces, angulo, saida = confirmaAngulo(detector, image, angulo, faces, mReduzida, escala)
+            chamadas += len(faces)
+            if qtdFaces >= 1:
+                metricas.conta("angulo_sucessos", angulo=angulo)
+                return qtdFaces, angulo, saida, chamadas
+        else:
+            candidatos.append((max(vizinhos), angulo, mReduzida, faces))
+
+    # MELHOR ANGULO PRIMEIRO; EMPATE FICA COM A ORDEM DA BUSCA
+    candidatos.sort(key=lambda c: -c[0])
+    for (confianca, angulo, mReduzida, faces) in candidatos:
+        qtdFaces, angulo, saida = confirmaAngulo(detector, image, angulo, faces, mReduzida, escala)
+        chamadas += len(faces)
+        if qtdFaces >= 1:
+            metricas.conta("angulo_sucessos", angulo=angulo)
+            return qtdFaces, angulo, saida, chamadas
+    return 0, None, None, chamadas
+
+
+def confirmaAngulo(detector, image, angulo, faces, mReduzida, escala):
+    """
+    Rotaciona a imagem original no angulo escolhido, confirma as faces da
+    copia reduzida em resolucao cheia e monta o recorte.
+
+    :return: (qtdFaces, angulo, saida)
+    """
+    heightImage, widthImage = image.shape[:2]
+    mOriginal, nW, nH = matrizRotacao(widthImage, heightImage, angulo)
+    with metricas.tempo("rotate"):
+        rotated = cv2.warpAffine(image, mOriginal, (nW, nH))
+    confirmadas = []
+    for face in faces:
+        face = confirmaFace(detector, rotated, mapeiaFace(face, mReduzida, escala, mOriginal))
+        if face is not None:
+            confirmadas.append(face)
+    if len(confirmadas) == 1:
+        return 1, angulo, recortaFace(rotated, confirmadas[0])
+    if len(confirmadas) > 1:
+        return len(confirmadas), angulo, (DESTINO_2FACES, rotated, None)
+    return 0, None, None
+
+
+def leDocumento(caminho, reducao=1):
+    """
+    :param reducao: 1 (colorida, resolucao cheia) ou 2, 4, 8 (cinza, reduzida).
+    """
+    with metricas.tempo("decode"):
+        if reducao > 1:
+            return cv2.imread(caminho, FLAGS_REDUZIDO[reducao])
+        return cv2.imread(caminho)
+
+
+def buscaReduzida(detector, reduzida, caminho, reducao, angulos=ANGULOS_BUSCA):
+    """
+    Busca nos angulos usando o documento decodificado reduzido (leDocumento
+    com reducao > 1). O minSize cai na mesma proporcao, sem passar da
+    janela do cascade. So quando acha face o documento e lido inteiro,
+    rotacionado uma vez, e as faces sao levadas para la antes do recorte.
+
+    Com minSize 72 e reducao 4, o minimo vira a janela do cascade (24), ou
+    seja, 96 pixels no documento: faces menores so na leitura cheia.
+
+    :return: (qtdFaces, angulo, saida, chamadas), como verificaAngulos.
+    """
+    minSizeReduzido = max(detector.windowSize(), int(round(float(detector.minSize) / reducao)))
+    chamadas = 0
+    for angulo in angulos:
+        chamadas += 1
+        metricas.conta("angulo_tentativas", angulo=angulo)
+        try:
+            mReduzida, nW, nH = matrizRotacao(reduzida.shape[1], reduzida.shape[0], angulo)
+            with metricas.tempo("rotate"):
+                rotacionada = cv2.warpAffine(reduzida, mReduzida, (nW, nH)) if angulo != 0 else reduzida
+            faces, rotacionada = detector.detect(rotacionada, 0, minSizeReduzido)
+            if len(faces) == 0:
+                continue
+            image = leDocumento(caminho)
+            escala = float(reduzida.shape[1]) / image.shape[1]
+            mOriginal, nW, nH = matrizRotacao(image.shape[1], image.shape[0], angulo)
+            with metricas.tempo("rotate"):
+                rotated = cv2.warpAffine(image, mOriginal, (nW, nH)) if angulo != 0 else image
+            faces = [mapeiaFace(face, mReduzida, escala, mOriginal) for face in faces]
+        except Exception:
+            continue
+        metricas.conta("angulo_sucessos", angulo=angulo)
+        if len(faces) == 1:
+            return 1, angulo, recortaFace(rotated, faces[0]), chamadas
+        return len(faces), angulo, (DESTINO_2FACES, rotated, None), chamadas
+    return 0, None, None, chamadas
+
+
+def codificaSaida(nomeImagem, saida):
+    # MESMO FORMATO QUE O cv2.imwrite ESCOLHERIA PELA EXTENSAO
+    extensao = os.path.splitext(nomeImagem)[1] or ".jpg"
+    with metricas.tempo("encode"):
+        ok, buf = cv2.imencode(extensao, saida)
+    return buf.tobytes() if ok else None
+
+
+def buscaFace(detector, image, nomeImagem, opcoes=None, agendador=None):
+    """
+    Busca a face num documento ja decodificado, na ordem de angulos de
+    `processaDocumento`. Usado direto pelo pipeline em memoria.
+
+    :param agendador: AngleScheduler; sem ele, a ordem fixa (ANGULOS_BUSCA).
+    :return: (qtdFaces, angulo, saida, chamadas); saida e (destino, recorte,
+             caixa) ou None.
+    """
+    opcoes = opcoes or {}
+    angulos = agendador.ordem() if agendador is not None else ANGULOS_BUSCA
+    if opcoes.get('busca') == 'coarse':
+        try:
+            return buscaCoarseToFine(detector, image, nomeImagem, angulos, opcoes.get('ladoBusca', 800))
+        except Exception:
+            return 0, None, None, 0
+    return verificaAngulos(detector, image, nomeImagem, angulos)
+
+
+def processaDocumento(detector, pastaFotos, nomeImagem, opcoes=None, agendador=None, image=None):
+    """
+    Varre um documento: original, angulos predefinidos e de 30 em 30.
+
+    Nao grava nada em disco; o recorte volta codificado no resultado para
+    que um unico escritor produza os relatorios e as pastas finais.
+
+    :param opcoes: dict com 'busca' ('exaustiva' ou 'coarse'), 'ladoBusca'
+                   (maior lado da copia reduzida no modo coarse), 'reducao'
+                   (1, ou 2/4/8 para buscar no JPEG decodificado reduzido) e
+                   'portao' (descarta antes da busca o que nao pode ter face;
+                   limiares em 'limiarContraste' e 'limiarNitidez').
+    :param agendador: AngleScheduler que decide a ordem dos angulos. Sem
+                      ele, a ordem fixa (ANGULOS_BUSCA, sem repeticoes).
+                      Quem recebe o resultado e que chama `registra`.
+    :param image: documento ja decodificado com leDocumento(caminho,
+                  opcoes['reducao']) (PrefetchReader); sem ele le do disco.
+    :return: dict com nome, qtdFaces, angulo, chamadas, destino, imagem
+             (bytes), caixa ([x, y, w, h] da face no recorte, ou None) e
+             motivo (quality_gate.MOTIVOS, se o portao descartou; ou None).
+    """
+    opcoes = opcoes or {}
+    caminho = os.path.join(pastaFotos, nomeImagem)
+    reducao = opcoes.get('reducao', 1)
+    if image is None:
+        image = leDocumento(caminho, reducao)
+    motivo = None
+    if opcoes.get('portao'):
+        motivo = avaliaQualidade(image, detector.minSize, reducao,
+                                 opcoes.get('limiarContraste', LIMIAR_CONTRASTE),
+                                 opcoes.get('limiarNitidez', LIMIAR_NITIDEZ))
+    if motivo is not None:
+        metricas.conta("portao_rejeitados", motivo=motivo)
+        qtdFaces, angulo, saida, chamadas = 0, None, None, 0
+    elif reducao > 1:
+        angulos = agendador.ordem() if agendador is not None else ANGULOS_BUSCA
+        qtdFaces, angulo, saida, chamadas = buscaReduzida(detector, image, caminho, reducao, angulos)
+    else:
+        qtdFaces, angulo, saida, chamadas = buscaFace(detector, image, nomeImagem, opcoes, agendador)
+
+    resultado = {
+        'nome': nomeImagem,
+        'qtdFaces': qtdFaces,
+        'angulo': int(angulo) if qtdFaces >= 1 else None,
+        'chamadas': chamadas,
+        'destino': None,
+        'imagem': None,
+        'caixa': None,
+        'motivo': motivo,
+    }
+    if saida is not None:
+        resultado['destino'] = saida[0]
+        resultado['imagem'] = codificaSaida(nomeImagem, saida[1])
+        if saida[2] is not None:
+            resultado['caixa'] = list(saida[2])
+    return resultado
+
+
+def leManifesto(caminho):
+    """
+    Le o diario (uma linha JSON por documento) gravado pelo
+    face_detect_rotation. Uma ultima linha pela metade (queda no meio da
+    gravacao) e ignorada.
+
+    :return: (entradas, tamanho) - lista de dicts na ordem em que foram
+             gravados e o byte onde termina a ultima linha completa; quem
+             for continuar o diario trunca nele antes de acrescentar.
+    """
+    entradas = []
+    tamanho = 0
+    if not os.path.isfile(caminho):
+        return entradas, tamanho
+    with open(caminho, 'rb') as fManifesto:
+        for linha in fManifesto:
+            if not linha.endswith(b"\n"):
+                break
+            try:
+                entradas.append(json.loads(linha.decode('utf-8')))
+            except ValueError:
+                break
+            tamanho += len(linha)
+    return entradas, tamanho
+
+
+def iniciaWorker(cascPath, minSize, opcoes=None):
+    # CADA PROCESSO CARREGA O SEU PROPRIO CASCADE E APRENDE A SUA ORDEM DE ANGULOS
+    global detectorWorker, opcoesWorker, agendadorWorker
+    opcoesWorker = opcoes or {}
+    # PARAMETROS DO detectMultiScale DO --perfil (face_detector.carregaPerfil)
+    perfil = dict(opcoesWorker.get('perfil') or {})
+    perfil['minSize'] = minSize
+    detectorWorker = FaceDetector(cascPath, **perfil)
+    if opcoesWorker.get('metricas'):
+        # O WORKER SO ACUMULA; QUEM GRAVA E O PROCESSO PRINCIPAL (mescla)
+        metricas.configura(None)
+    agendadorWorker = AngleScheduler(opcoesWorker.get('ordemAdaptativa', False))
+
+
+def processaDocumentoWorker(tarefa):
+    pastaFotos, nomeImagem = tarefa
+    resultado = processaDocumento(detectorWorker, pastaFotos, nomeImagem, opcoesWorker, agendadorWorker)
+    agendadorWorker.registra(resultado['angulo'], resultado['chamadas'])
+    resultado['metricas'] = metricas.deltas()
+    return resultado
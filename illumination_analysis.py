@@ -0,0 +1,163 @@
+# ANALISE DE ILUMINACAO: ESCOLHE, POR FACE, QUAIS EFEITOS VALEM A PENA
+#
+# illumination_analysis.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# ESTATISTICAS BARATAS DA LUMINANCIA (L DO Lab) DE CADA FACE ALINHADA:
+#   faixa        p98 - p2 (ESCURA, LAVADA OU ESTOURADA TEM FAIXA CURTA)
+#   media        L MEDIO
+#   desigualdade |METADE ESQUERDA - METADE DIREITA| / MEDIA (A FACE E SIMETRICA;
+#                LUZ DE LADO APARECE AQUI)
+#   dominante    DISTANCIA DO (a, b) MEDIO ATE O TOM DE PELE DE REFERENCIA
+#   contraste    DESVIO PADRAO MEDIO DE L EM BLOCOS 4x4
+#
+# RAMOS:
+#   completo  ACE + RETINEX + CLAHE (COR OU LUZ PRECISAM DE CORRECAO)
+#   clahe     SO CLAHE (LUZ BOA, MAS CONTRASTE LOCAL BAIXO)
+#   nenhum    PASSA DIRETO (JA ESTA BEM ILUMINADA)
+#
+# python apply_effects_ACE_RETINEX.py --condicional --ramos ramos_iluminacao.jsonl
+# python apply_effects_CLAHE.py --ramos ramos_iluminacao.jsonl
+
+import cv2, json, os
+import numpy as np
+import metricas
+from multiprocessing.pool import ThreadPool
+from effects import aplicaACE, aplicaRetinex, aplicaCLAHE, ACE_GRAU, ACE_ESCALA
+
+COMPLETO = "completo"
+CLAHE = "clahe"
+NENHUM = "nenhum"
+RAMOS = [COMPLETO, CLAHE, NENHUM]
+
+LIMIARES_PADRAO = {
+    'faixaMinima': 100,         # p98 - p2 DE L (0..255)
+    'mediaMinima': 70,
+    'mediaMaxima': 190,
+    'desigualdadeMaxima': 0.2,
+    'dominanteMaxima': 12,      # EM UNIDADES DE a/b DO Lab DO OPENCV
+    'peleA': 10,                # (a, b) MEDIO DE UMA FACE SEM DOMINANTE
+    'peleB': 10,
+    'contrasteMinimo': 35,
+}
+
+
+def carregaLimiares(caminho):
+    """
+    JSON com uma parte das chaves de LIMIARES_PADRAO; o resto fica com o padrao.
+    """
+    with open(caminho) as fLimiares:
+        lidos = json.load(fLimiares)
+    desconhecidos = set(lidos) - set(LIMIARES_PADRAO)
+    if desconhecidos:
+        raise ValueError("limiares {0}: chaves desconhecidas {1}".format(caminho, ", ".join(sorted(desconhecidos))))
+    limiares = dict(LIMIARES_PADRAO)
+    limiares.update(lidos)
+    return limiares
+
+
+def estatisticasIluminacao(bgr, limiares=LIMIARES_PADRAO):
+    lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)
+    L = lab[:, :, 0]
+    h, w = L.shape
+    baixo, alto = np.percentile(L, (2, 98))
+    media = float(L.mean())
+    esquerda = float(L[:, :w // 2].mean())
+    direita = float(L[:, w - w // 2:].mean())
+    a = float(lab[:, :, 1].mean()) - 128
+    b = float(lab[:, :, 2].mean()) - 128
+    blocos = L[:h - h % 4, :w - w % 4].reshape(4, h // 4, 4, w // 4).astype(np.float32)
+    return {
+        'faixa': float(alto - baixo),
+        'media': media,
+        'desigualdade': abs(esquerda - direita) / max(media, 1.0),
+        'dominante': float(np.hypot(a - limiares['peleA'], b - limiares['peleB'])),
+        'contraste': float(blocos.std(axis=(1, 3)).mean()),
+    }
+
+
+def escolheRamo(estatisticas, limiares=LIMIARES_PADRAO):
+    """
+    :return: (ramo, motivo) - motivo e a primeira regra que decidiu.
+    """
+    if estatisticas['faixa'] < limiares['faixaMinima']:
+        return COMPLETO, "faixa"
+    if estatisticas['media'] < limiares['mediaMinima']:
+        return COMPLETO, "escura"
+    if estatisticas['media'] > limiares['mediaMaxima']:
+        return COMPLETO, "clara"
+    if estatisticas['desigualdade'] > limiares['desigualdadeMaxima']:
+        return COMPLETO, "desigual"
+    if estatisticas['dominante'] > limiares['dominanteMaxima']:
+        return COMPLETO, "dominante"
+    if estatisticas['contraste'] < limiares['contrasteMinimo']:
+        return CLAHE, "contraste"
+    return NENHUM, "bem iluminada"
+
+
+def analisaImagem(bgr, limiares=LIMIARES_PADRAO):
+    """
+    :return: dict com ramo, motivo e estatisticas.
+    """
+    with metricas.tempo("iluminacao"):
+        estatisticas = estatisticasIluminacao(bgr, limiares)
+        ramo, motivo = escolheRamo(estatisticas, limiares)
+    metricas.conta("ramos", ramo=ramo)
+    return {'ramo': ramo, 'motivo': motivo, 'estatisticas': estatisticas}
+
+
+def aplicaRamo(bgr, ramo, motorACE="rapido", grau=ACE_GRAU, escala=ACE_ESCALA, motorRetinex="maximo", clahe=None):
+    if ramo == COMPLETO:
+        return aplicaCLAHE(aplicaRetinex(aplicaACE(bgr, motorACE, grau, escala), motorRetinex), clahe)
+    if ramo == CLAHE:
+        return aplicaCLAHE(bgr, clahe)
+    return bgr
+
+
+def analisaTarefas(tarefas, limiares, caminhoDiario, workers=4):
+    """
+    Analisa as entradas de (entrada, saida) em threads e grava o diario
+    (uma linha JSON por arquivo: entrada, saida, ramo, motivo, estatisticas).
+
+    :return: dict saida -> ramo; arquivos ilegiveis ficam de fora.
+    """
+    def analisa(tarefa):
+        with metricas.tempo("decode"):
+            bgr = cv2.imread(tarefa[0])
+        return None if bgr is None else analisaImagem(bgr, limiares)
+
+    pool = ThreadPool(max(1, workers))
+    ramos = {}
+    contagem = dict((ramo, 0) for ramo in RAMOS)
+    with open(caminhoDiario, 'w') as fDiario:
+        for (entrada, saida), analise in zip(tarefas, pool.imap(analisa, tarefas, 16)):
+            if analise is None:
+                print("ILUMINACAO: nao foi possivel ler {0}".format(entrada))
+                continue
+            ramos[saida] = analise['ramo']
+            contagem[analise['ramo']] += 1
+            linha = {'entrada': entrada, 'saida': saida}
+            linha.update(analise)
+            fDiario.write(json.dumps(linha, sort_keys=True) + "\n")
+    pool.close()
+    pool.join()
+    print("ILUMINACAO: " + ", ".join("{0} {1}".format(ramo, contagem[ramo]) for ramo in RAMOS))
+    return ramos
+
+
+def leRamos(caminhoDiario):
+    """
+    :return: dict nome do arquivo de saida (sem a pasta) -> ramo.
+    """
+    ramos = {}
+    with open(caminhoDiario) as fDiario:
+        for linha in fDiario:
+            try:
+                entrada = json.loads(linha)
+            except ValueError:
+                break
+            ramos[os.path.basename(entrada['saida'])] = entrada['ramo']
+    return ramos
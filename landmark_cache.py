@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+#
+# Persistent cache of dlib face boxes and landmarks (used by align-dlib.py).
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+
+def imageKey(rgbImg):
+    """
+    Hash of the decoded image: shape, dtype and pixel bytes.
+
+    :param rgbImg: Image. Shape: (height, width, 3)
+    :type rgbImg: numpy.ndarray
+    :rtype: str
+    """
+    rgbImg = np.ascontiguousarray(rgbImg)
+    h = hashlib.sha1()
+    h.update("{}{}".format(rgbImg.shape, rgbImg.dtype).encode('ascii'))
+    h.update(rgbImg.data)
+    return h.hexdigest()
+
+
+def modelKey(path, chunkSize=1 << 20):
+    """
+    Hash of a model file, so landmarks from a different predictor never match.
+
+    :param path: Path to the model, e.g. dlib's shape predictor.
+    :type path: str
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        chunk = f.read(chunkSize)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(chunkSize)
+    return h.hexdigest()
+
+
+class LandmarkCache:
+    """
+    SQLite file mapping image content to the face boxes found by the dlib
+    HOG detector and to the landmarks found by a shape predictor.
+
+    Boxes are keyed by image only (the detector is fixed); landmarks are
+    keyed by image, predictor model and box. Re-running alignment at a
+    different size or with other landmark indices only needs lookups.
+
+    The file is kept in WAL mode so several processes can share it: reads
+    never wait for a writer, and a writer only holds the lock while it
+    commits. Processes sharing the file should use `commitEvery=1`.
+    """
+
+    def __init__(self, path, facePredictor, commitEvery=100):
+        """
+        :param path: SQLite file; created if missing.
+        :type path: str
+        :param facePredictor: Path to the shape predictor whose landmarks are cached.
+        :type facePredictor: str
+        :param commitEvery: Number of writes between commits.
+        :type commitEvery: int
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS boxes "
+                          "(image TEXT PRIMARY KEY, boxes TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS landmarks "
+                          "(image TEXT, model TEXT, box TEXT, points TEXT, "
+                          "PRIMARY KEY (image, model, box))")
+        self.conn.commit()
+        self.model = modelKey(facePredictor)
+        self.commitEvery = commitEvery
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def getBoxes(self, imgKey):
+        """
+        :return: List of (left, top, right, bottom), or None if not cached.
+        """
+        row = self.conn.execute("SELECT boxes FROM boxes WHERE image = ?",
+                                (imgKey,)).fetchone()
+        return self._count(None if row is None else [tuple(b) for b in json.loads(row[0])])
+
+    def putBoxes(self, imgKey, boxes):
+        self.conn.execute("INSERT OR REPLACE INTO boxes VALUES (?, ?)",
+                          (imgKey, json.dumps([list(b) for b in boxes])))
+        self._written()
+
+    def getLandmarks(self, imgKey, box):
+        """
+        :return: List of (x, y), or None if not cached.
+        """
+        row = self.conn.execute("SELECT points FROM landmarks WHERE image = ? AND model = ? AND box = ?",
+                                (imgKey, self.model, json.dumps(list(box)))).fetchone()
+        return self._count(None if row is None else [tuple(p) for p in json.loads(row[0])])
+
+    def putLandmarks(self, imgKey, box, points):
+        self.conn.execute("INSERT OR REPLACE INTO landmarks VALUES (?, ?, ?, ?)",
+                          (imgKey, self.model, json.dumps(list(box)),
+                           json.dumps([list(p) for p in points])))
+        self._written()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commitEvery:
+            self.conn.commit()
+            self.pending = 0
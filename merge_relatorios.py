@@ -0,0 +1,171 @@
+# JUNTA OS RELATORIOS DOS SHARDS (--shard i/N) NUM RELATORIO SO
+#
+# merge_relatorios.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# python merge_relatorios.py no0/relatorios/ no1/relatorios/ no2/relatorios/ --data 17.04.17_72px
+#
+# LE OS DIARIOS (manifesto_<data>_shard*.jsonl) E OS RELATORIOS FINAIS DE CADA
+# SHARD E GRAVA out_DOC_OK, out_DOC_FAIL, out_rel_final E manifesto COM <data>,
+# NO MESMO FORMATO DO face_detect_rotation_.0.2.py.
+
+import argparse
+import glob, json, os, re
+from angle_scheduler import AngleScheduler
+from face_scan import leManifesto
+from corpus_split import leSufixoShard
+import quality_gate
+
+
+def arquivosShard(pastas, prefixo, data, extensao):
+    """
+    :return: os arquivos de cada shard, na ordem do indice i (nao do texto:
+             _shard10de12 vem depois de _shard2de12).
+    :raise ValueError: se os arquivos nao sao exatamente os shards 0..N-1
+                       de um mesmo N.
+    """
+    porShard = {}
+    totais = set()
+    for pasta in pastas:
+        for caminho in glob.glob(os.path.join(pasta, prefixo + data + "_shard*" + extensao)):
+            shard = leSufixoShard(os.path.basename(caminho)[len(prefixo + data):])
+            if shard is None:
+                continue
+            if shard[0] in porShard:
+                raise ValueError("shard {0}/{1} repetido: {2} e {3}".format(
+                    shard[0], shard[1], porShard[shard[0]], caminho))
+            porShard[shard[0]] = caminho
+            totais.add(shard[1])
+    if not porShard:
+        return []
+    if len(totais) > 1:
+        raise ValueError("{0}: shards de divisoes diferentes (N = {1})".format(
+            prefixo + data, ", ".join(str(n) for n in sorted(totais))))
+    n = totais.pop()
+    faltando = [i for i in range(n) if i not in porShard]
+    if faltando:
+        raise ValueError("{0}: faltam os shards {1} de {2}".format(
+            prefixo + data, ", ".join(str(i) for i in faltando), n))
+    return [porShard[i] for i in range(n)]
+
+
+def leValor(texto, rotulo):
+    encontrado = re.search(re.escape(rotulo) + r"\s*([0-9.]+)", texto)
+    return encontrado.group(1) if encontrado else None
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pastas", nargs="+", help="pastas relatorios/ de cada shard")
+    ap.add_argument("--data", required=True, help="a mesma `data` do face_detect_rotation")
+    ap.add_argument("--saida", default="relatorios/", help="pasta do relatorio juntado")
+    args = vars(ap.parse_args())
+    data = args["data"]
+    pastaRelatorios = args["saida"]
+
+    try:
+        manifestos = arquivosShard(args["pastas"], "manifesto_", data, ".jsonl")
+        finais = arquivosShard(args["pastas"], "out_rel_final_", data, ".txt")
+    except ValueError as e:
+        ap.error(str(e))
+    if not manifestos:
+        ap.error("nenhum manifesto_" + data + "_shard*.jsonl nas pastas")
+
+    # DOCUMENTOS NA ORDEM DOS SHARDS; REPETIDO E SINAL DE SHARDS SOBREPOSTOS
+    entradas = []
+    vistos = set()
+    for caminho in manifestos:
+        for entrada in leManifesto(caminho)[0]:
+            if entrada['nome'] in vistos:
+                print("REPETIDO: {0} ({1})".format(entrada['nome'], caminho))
+                continue
+            vistos.add(entrada['nome'])
+            entradas.append(entrada)
+
+    textosFinais = []
+    for caminho in finais:
+        with open(caminho) as f:
+            textosFinais.append(f.read())
+    minSizeSetado = leValor(textosFinais[0], "minSizeSetado:") if textosFinais else None
+    busca = re.search(r"busca: (\S+)", textosFinais[0]).group(1) if textosFinais else None
+    totalImagens = max([int(leValor(t, "QTD DOC NA PASTA:") or 0) for t in textosFinais] or [0])
+    tempos = [float(leValor(t, "TEMPO DE EXECUCAO:") or 0) for t in textosFinais]
+
+    if not os.path.isdir(pastaRelatorios):
+        os.makedirs(pastaRelatorios)
+    fFail = open(os.path.join(pastaRelatorios, 'out_DOC_FAIL_' + data + '.txt'), 'w')
+    fOK = open(os.path.join(pastaRelatorios, 'out_DOC_OK_' + data + '.txt'), 'w')
+    fFinal = open(os.path.join(pastaRelatorios, 'out_rel_final_' + data + '.txt'), 'w')
+    fManifesto = open(os.path.join(pastaRelatorios, 'manifesto_' + data + '.jsonl'), 'w')
+
+    fFail.write("DOCUMENTOS QUE NAO FOI DETECTADO ROSTO:\n")
+    fOK.write("DOCUMENTOS QUE FOI DETECTADO ROSTO:\n")
+    fFinal.write("RELATORIO FINAL em " + data + "\n\n")
+    if minSizeSetado is not None:
+        fFinal.write("minSizeSetado: " + minSizeSetado + "\n")
+    if busca is not None:
+        fFinal.write("busca: " + busca + "\n")
+    fFinal.write("shards juntados: " + str(len(manifestos)) + "\n")
+
+    # DUPLICADOS (--duplicados) SO SAO RECONHECIDOS DENTRO DE CADA SHARD
+    fDuplicados = None
+    if any(entrada.get('duplicadoDe') for entrada in entradas):
+        fDuplicados = open(os.path.join(pastaRelatorios, 'out_DOC_DUPLICADOS_' + data + '.txt'), 'w')
+        fDuplicados.write("DOCUMENTOS RESOLVIDOS COMO DUPLICADOS:\n")
+
+    agendador = AngleScheduler()
+    count = 1
+    countIMGOK = 0
+    countIMGFail = 0
+    countDuplicados = 0
+    rejeitados = {}
+    for entrada in entradas:
+        duplicadoDe = entrada.get('duplicadoDe')
+        marca = ' (DUPLICADO DE ' + duplicadoDe + ')' if duplicadoDe is not None else ''
+        if entrada['qtdFaces'] >= 1:
+            fOK.write('('+str(count)+')' + entrada['nome'] + ' = FACE ENCONTRADA' + marca + ' \n')
+            countIMGOK = countIMGOK + 1
+        else:
+            fFail.write('('+str(count)+')' + entrada['nome'] + ' = FACE NAO ENCONTRADA' +
+                        quality_gate.marcaMotivo(entrada.get('motivo')) + marca + ' \n')
+            countIMGFail = countIMGFail + 1
+        if entrada.get('motivo'):
+            rejeitados[entrada['motivo']] = rejeitados.get(entrada['motivo'], 0) + 1
+        if duplicadoDe is not None:
+            fDuplicados.write('(' + str(count) + ')' + entrada['nome'] + ' = DUPLICADO DE ' + duplicadoDe + ' \n')
+            countDuplicados = countDuplicados + 1
+        elif not entrada.get('motivo'):
+            agendador.registra(entrada['angulo'], entrada.get('chamadas', 0))
+        entrada['n'] = count
+        fManifesto.write(json.dumps(entrada) + "\n")
+        count = count + 1
+
+    fFail.write("\n\n QTD:" + str(countIMGFail) + "\n")
+    fOK.write("\n\n QTD:" + str(countIMGOK) + "\n")
+
+    # MESMA CONTAGEM DO SCRIPT ORIGINAL (O CONTADOR COMECA EM 1)
+    fFinal.write("\nQTD DOC NA PASTA:" + str(totalImagens) + "\n")
+    fFinal.write("\nQTD DOC ANALISADAS:" + str(count) + "\n")
+    fFinal.write("QTD DOC OK:" + str(countIMGOK) + "\n")
+    fFinal.write("QTD DOC FAIL:" + str(countIMGFail) + "\n\n")
+    if fDuplicados is not None:
+        fFinal.write("QTD DOC DUPLICADOS:" + str(countDuplicados) + "\n\n")
+        fDuplicados.write("\n\n QTD:" + str(countDuplicados) + "\n")
+        fDuplicados.close()
+    if rejeitados:
+        fFinal.write(quality_gate.resumo(rejeitados))
+    fFinal.write(agendador.resumo())
+
+    # OS SHARDS RODAM EM PARALELO: O TEMPO DO LOTE E O DO MAIS LENTO
+    fFinal.write("\nTEMPO DE EXECUCAO: %s segundos." % max(tempos or [0]) + "\n")
+    fFinal.write("TEMPO SOMADO DOS SHARDS: %s segundos." % sum(tempos) + "\n\n")
+
+    fFail.close()
+    fOK.close()
+    fFinal.close()
+    fManifesto.close()
+    print("{0} documentos de {1} shards: {2} OK, {3} FAIL".format(
+        len(entradas), len(manifestos), countIMGOK, countIMGFail))
@@ -0,0 +1,203 @@
+# TEMPOS POR ETAPA E CONTADORES, EXPORTADOS EM JSON E NO FORMATO DO PROMETHEUS
+#
+# metricas.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# USO:
+#   import metricas
+#   metricas.configura("relatorios/metricas", intervalo=30)  # grava .json e .prom
+#   with metricas.tempo("decode"):
+#       image = cv2.imread(caminho)
+#   metricas.conta("angulo_tentativas", angulo=45)
+#   metricas.gravaPeriodico()   # no laco principal; so grava a cada `intervalo` segundos
+#   metricas.grava()            # no fim
+#
+# DESLIGADO (O PADRAO), tempo() DEVOLVE UM OBJETO QUE NAO FAZ NADA E conta()
+# RETORNA NA PRIMEIRA LINHA. O .prom E GRAVADO EM UM TEMPORARIO E RENOMEADO,
+# COMO O textfile collector DO node_exporter PEDE.
+#
+# EM PROCESSOS (multiprocessing), CADA WORKER ACUMULA O SEU E DEVOLVE
+# deltas() JUNTO COM O RESULTADO; O PROCESSO PRINCIPAL CHAMA mescla().
+
+import json, os, threading, time
+from timeit import default_timer
+
+PREFIXO = "face_pipeline"
+
+# LIMITES DOS BALDES DO HISTOGRAMA, EM SEGUNDOS (O ULTIMO, +Inf, E IMPLICITO)
+BALDES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ativo = False
+caminhoBase = None
+intervalo = 30.0
+ultimaGravacao = 0.0
+trava = threading.Lock()
+histogramas = {}    # etapa -> {'baldes': [...], 'soma': s, 'quantidade': n}
+contadores = {}     # (nome, ((rotulo, valor), ...)) -> total
+
+
+class CronometroNulo:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *erro):
+        return False
+
+
+NULO = CronometroNulo()
+
+
+class Cronometro:
+    def __init__(self, etapa):
+        self.etapa = etapa
+
+    def __enter__(self):
+        self.inicio = default_timer()
+        return self
+
+    def __exit__(self, *erro):
+        observa(self.etapa, default_timer() - self.inicio)
+        return False
+
+
+def configura(base, intervaloGravacao=30.0):
+    """
+    Liga a coleta.
+
+    :param base: caminho sem extensao; grava <base>.json e <base>.prom.
+                 None liga a coleta sem gravar (workers).
+    :param intervaloGravacao: segundos entre as gravacoes de gravaPeriodico.
+    """
+    global ativo, caminhoBase, intervalo, ultimaGravacao
+    ativo = True
+    caminhoBase = base
+    intervalo = intervaloGravacao
+    ultimaGravacao = time.time()
+    if base:
+        pasta = os.path.dirname(base)
+        if pasta and not os.path.isdir(pasta):
+            os.makedirs(pasta)
+
+
+def tempo(etapa):
+    if not ativo:
+        return NULO
+    return Cronometro(etapa)
+
+
+def observa(etapa, segundos):
+    if not ativo:
+        return
+    with trava:
+        histograma = histogramas.get(etapa)
+        if histograma is None:
+            histograma = histogramas[etapa] = {'baldes': [0] * (len(BALDES) + 1), 'soma': 0.0, 'quantidade': 0}
+        i = 0
+        while i < len(BALDES) and segundos > BALDES[i]:
+            i += 1
+        histograma['baldes'][i] += 1
+        histograma['soma'] += segundos
+        histograma['quantidade'] += 1
+
+
+def conta(nome, valor=1, **rotulos):
+    if not ativo:
+        return
+    chave = (nome, tuple(sorted((k, str(v)) for k, v in rotulos.items())))
+    with trava:
+        contadores[chave] = contadores.get(chave, 0) + valor
+
+
+def instantaneo():
+    """
+    :return: dict serializavel (JSON, pickle) com tudo o que foi coletado.
+    """
+    with trava:
+        return {
+            'histogramas': dict((etapa, {'baldes': list(h['baldes']), 'soma': h['soma'],
+                                         'quantidade': h['quantidade']})
+                                for etapa, h in histogramas.items()),
+            'contadores': [{'nome': nome, 'rotulos': dict(rotulos), 'valor': valor}
+                           for (nome, rotulos), valor in sorted(contadores.items())],
+        }
+
+
+def deltas():
+    """
+    O que foi coletado desde a ultima chamada (zera os acumuladores).
+    Para os workers devolverem junto com cada resultado; None se desligado.
+    """
+    if not ativo:
+        return None
+    atual = instantaneo()
+    with trava:
+        histogramas.clear()
+        contadores.clear()
+    return atual
+
+
+def mescla(outro):
+    if not ativo or not outro:
+        return
+    with trava:
+        for etapa, h in outro['histogramas'].items():
+            meu = histogramas.get(etapa)
+            if meu is None:
+                meu = histogramas[etapa] = {'baldes': [0] * (len(BALDES) + 1), 'soma': 0.0, 'quantidade': 0}
+            meu['baldes'] = [a + b for a, b in zip(meu['baldes'], h['baldes'])]
+            meu['soma'] += h['soma']
+            meu['quantidade'] += h['quantidade']
+        for contador in outro['contadores']:
+            chave = (contador['nome'], tuple(sorted(contador['rotulos'].items())))
+            contadores[chave] = contadores.get(chave, 0) + contador['valor']
+
+
+def textoPrometheus(dados):
+    linhas = []
+    nomeHistograma = PREFIXO + "_etapa_segundos"
+    if dados['histogramas']:
+        linhas.append("# HELP {0} Tempo de cada etapa, em segundos.".format(nomeHistograma))
+        linhas.append("# TYPE {0} histogram".format(nomeHistograma))
+    for etapa in sorted(dados['histogramas']):
+        h = dados['histogramas'][etapa]
+        acumulado = 0
+        for limite, quantidade in zip(list(BALDES) + ["+Inf"], h['baldes']):
+            acumulado += quantidade
+            linhas.append('{0}_bucket{{etapa="{1}",le="{2}"}} {3}'.format(nomeHistograma, etapa, limite, acumulado))
+        linhas.append('{0}_sum{{etapa="{1}"}} {2!r}'.format(nomeHistograma, etapa, h['soma']))
+        linhas.append('{0}_count{{etapa="{1}"}} {2}'.format(nomeHistograma, etapa, h['quantidade']))
+    vistos = set()
+    for contador in dados['contadores']:
+        nome = PREFIXO + "_" + contador['nome'] + "_total"
+        if nome not in vistos:
+            linhas.append("# TYPE {0} counter".format(nome))
+            vistos.add(nome)
+        rotulos = ",".join('{0}="{1}"'.format(k, v) for k, v in sorted(contador['rotulos'].items()))
+        linhas.append("{0}{1} {2}".format(nome, "{" + rotulos + "}" if rotulos else "", contador['valor']))
+    return "\n".join(linhas) + "\n"
+
+
+def gravaAtomico(caminho, texto):
+    temporario = caminho + ".tmp"
+    with open(temporario, 'w') as f:
+        f.write(texto)
+    os.rename(temporario, caminho)
+
+
+def grava():
+    global ultimaGravacao
+    if not ativo or not caminhoBase:
+        return
+    dados = instantaneo()
+    dados['gravadoEm'] = time.time()
+    gravaAtomico(caminhoBase + ".json", json.dumps(dados, indent=1, sort_keys=True))
+    gravaAtomico(caminhoBase + ".prom", textoPrometheus(dados))
+    ultimaGravacao = time.time()
+
+
+def gravaPeriodico():
+    if ativo and time.time() - ultimaGravacao >= intervalo:
+        grava()
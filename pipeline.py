@@ -0,0 +1,292 @@
+# PIPELINE EM MEMORIA: DETECCAO -> ALINHAMENTO -> ACE -> RETINEX -> CLAHE
+#
+# pipeline.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# AS ETAPAS PASSAM ARRAYS NUMPY (BGR uint8) DE UMA PARA OUTRA; SO A SAIDA FINAL
+# (E, SE PEDIDO, OS INTERMEDIARIOS) VAI PARA O DISCO.
+#
+# python pipeline.py documentos/ pessoas_effects_final/ --dlibFacePredictor shape_predictor_68_face_landmarks.dat
+# python pipeline.py pessoas_align/ saida/ --etapas ace,retinex,clahe --intermediarios debug/
+
+import argparse
+import cv2, json, os, time
+from face_detector import FaceDetector, carregaPerfil
+from face_scan import buscaFace, leDocumento
+from angle_scheduler import AngleScheduler
+from quality_gate import avaliaQualidade, LIMIAR_CONTRASTE, LIMIAR_NITIDEZ
+from prefetch_reader import PrefetchReader
+import metricas
+from corpus_split import parseShard, filtraShard
+from effects import aplicaACE, aplicaRetinex, aplicaCLAHE, ACE_GRAU, ACE_ESCALA
+from illumination_analysis import analisaImagem, aplicaRamo, carregaLimiares, LIMIARES_PADRAO
+
+ETAPAS = ["detect", "align", "ace", "retinex", "clahe"]
+# NO LUGAR DE ace,retinex,clahe: ESCOLHE POR IMAGEM ENTRE OS TRES, SO CLAHE OU NADA
+ETAPA_ILUMINACAO = "iluminacao"
+
+
+def carregaAlignDlib():
+    # align-dlib.py TEM HIFEN NO NOME, ENTAO NAO DA PARA USAR import
+    caminho = os.path.join(os.path.dirname(os.path.abspath(__file__)), "align-dlib.py")
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location("align_dlib", caminho)
+        modulo = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modulo)
+    except ImportError:
+        import imp
+        modulo = imp.load_source("align_dlib", caminho)
+    return modulo
+
+
+def etapaDetect(cascPath, minSize, opcoes=None, caixas=None):
+    """
+    :param caixas: dict compartilhado com etapaAlign; recebe a face (x,y,w,h)
+                   no recorte, para o alinhamento nao detectar de novo.
+    """
+    opcoes = opcoes or {}
+    perfil = dict(opcoes.get('perfil') or {})
+    perfil['minSize'] = minSize
+    detector = FaceDetector(cascPath, **perfil)
+    # A MESMA ORDEM DE ANGULOS DO face_detect_rotation (E O MESMO APRENDIZADO COM ordemAdaptativa)
+    agendador = AngleScheduler(opcoes.get('ordemAdaptativa', False))
+
+    def detect(nome, bgr):
+        if opcoes.get('portao'):
+            motivo = avaliaQualidade(bgr, minSize, 1, opcoes.get('limiarContraste', LIMIAR_CONTRASTE),
+                                     opcoes.get('limiarNitidez', LIMIAR_NITIDEZ))
+            if motivo is not None:
+                metricas.conta("portao_rejeitados", motivo=motivo)
+                return None
+        # COM MAIS DE UMA FACE SEGUE A IMAGEM ROTACIONADA; O ALINHAMENTO PEGA A MAIOR
+        qtdFaces, angulo, saida, chamadas = buscaFace(detector, bgr, nome, opcoes, agendador)
+        agendador.registra(angulo, chamadas)
+        if saida is None:
+            return None
+        if caixas is not None and saida[2] is not None:
+            caixas[nome] = saida[2]
+        return saida[1]
+    return detect
+
+
+def etapaAlign(facePredictor, tamanho, engine="numpy", cache=None, caixas=None):
+    """
+    :param caixas: dict preenchido pelo etapaDetect; sem caixa para a imagem,
+                   o dlib procura a face (HOG).
+    """
+    alignDlib = carregaAlignDlib()
+    align = alignDlib.AlignDlib(facePredictor, engine=engine, cache=cache)
+
+    def alinha(nome, bgr):
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        bb = None
+        if caixas is not None and nome in caixas:
+            bb = alignDlib.haarToRect(caixas.pop(nome), rgb.shape)
+        outRgb = align.align(tamanho, rgb, bb=bb, landmarkIndices=alignDlib.AlignDlib.INNER_EYES_AND_BOTTOM_LIP)
+        if outRgb is None:
+            return None
+        return cv2.cvtColor(outRgb, cv2.COLOR_RGB2BGR)
+    return alinha
+
+
+def etapaACE(motor, grau, escala):
+    return lambda nome, bgr: aplicaACE(bgr, motor, grau, escala)
+
+
+def etapaRetinex(motor):
+    return lambda nome, bgr: aplicaRetinex(bgr, motor)
+
+
+def etapaCLAHE():
+    # UM CLAHE SO PARA O LOTE INTEIRO
+    clahe = cv2.createCLAHE()
+    return lambda nome, bgr: aplicaCLAHE(bgr, clahe)
+
+
+def etapaIluminacao(motorACE, grau, escala, motorRetinex, limiares=None, diario=None):
+    """
+    :param diario: arquivo aberto; recebe uma linha JSON por imagem com o
+                   ramo escolhido (illumination_analysis.analisaImagem).
+    """
+    limiares = limiares or LIMIARES_PADRAO
+    clahe = cv2.createCLAHE()
+
+    def ilumina(nome, bgr):
+        analise = analisaImagem(bgr, limiares)
+        if diario is not None:
+            linha = {'nome': nome}
+            linha.update(analise)
+            diario.write(json.dumps(linha, sort_keys=True) + "\n")
+            diario.flush()
+        return aplicaRamo(bgr, analise['ramo'], motorACE, grau, escala, motorRetinex, clahe)
+    return ilumina
+
+
+def criaEtapas(nomes, opcoes):
+    """
+    :param nomes: etapas na ordem em que rodam (subconjunto de ETAPAS).
+    :param opcoes: dict com cascPath, minSize, perfil, busca, ladoBusca, portao,
+                   facePredictor, tamanho, engine, motorACE, aceGrau, aceEscala,
+                   motorRetinex e, para a etapa iluminacao, limiares e diarioRamos.
+    :return: lista de (nome, funcao(nomeImagem, bgr) -> bgr ou None).
+    """
+    etapas = []
+    # FACE ACHADA PELO CASCADE NO detect, REAPROVEITADA PELO align (OS EFEITOS NAO MUDAM A GEOMETRIA)
+    caixas = {}
+    for nome in nomes:
+        if nome == "detect":
+            funcao = etapaDetect(opcoes["cascPath"], opcoes["minSize"], opcoes, caixas)
+        elif nome == "align":
+            funcao = etapaAlign(opcoes["facePredictor"], opcoes["tamanho"], opcoes.get("engine", "numpy"),
+                                caixas=caixas)
+        elif nome == "ace":
+            funcao = etapaACE(opcoes.get("motorACE", "rapido"), opcoes.get("aceGrau", ACE_GRAU),
+                              opcoes.get("aceEscala", ACE_ESCALA))
+        elif nome == "retinex":
+            funcao = etapaRetinex(opcoes.get("motorRetinex", "maximo"))
+        elif nome == "clahe":
+            funcao = etapaCLAHE()
+        elif nome == ETAPA_ILUMINACAO:
+            funcao = etapaIluminacao(opcoes.get("motorACE", "rapido"), opcoes.get("aceGrau", ACE_GRAU),
+                                     opcoes.get("aceEscala", ACE_ESCALA), opcoes.get("motorRetinex", "maximo"),
+                                     opcoes.get("limiares"), opcoes.get("diarioRamos"))
+        else:
+            raise ValueError("etapa desconhecida: {0} (use {1})".format(nome, ",".join(ETAPAS + [ETAPA_ILUMINACAO])))
+        etapas.append((nome, funcao))
+    return etapas
+
+
+class Pipeline:
+    """
+    Encadeia as etapas em memoria. Uma etapa que devolve None (face nao
+    encontrada, alinhamento falhou) interrompe a imagem.
+    """
+
+    def __init__(self, etapas, pastaIntermediarios=None):
+        self.etapas = etapas
+        self.pastaIntermediarios = pastaIntermediarios
+        if pastaIntermediarios:
+            for nome, funcao in etapas:
+                pasta = os.path.join(pastaIntermediarios, nome)
+                if not os.path.isdir(pasta):
+                    os.makedirs(pasta)
+
+    def processa(self, nomeImagem, bgr):
+        """
+        :return: (imagem final ou None, nome da etapa que parou ou None).
+        """
+        for nome, funcao in self.etapas:
+            # "pipeline_ace" E A ETAPA INTEIRA; "ace" E SO O EFEITO, MEDIDO EM effects.py
+            with metricas.tempo("pipeline_" + nome):
+                bgr = funcao(nomeImagem, bgr)
+            if bgr is None:
+                return None, nome
+            if self.pastaIntermediarios:
+                cv2.imwrite(os.path.join(self.pastaIntermediarios, nome, nomeSaida(nomeImagem)), bgr)
+        return bgr, None
+
+
+def nomeSaida(nomeImagem, extensao=".png"):
+    # PNG POR PADRAO: SEM PERDA NA UNICA CODIFICACAO QUE SOBROU
+    return os.path.splitext(nomeImagem)[0] + extensao
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pastaEntrada", help="pasta com as imagens de entrada")
+    ap.add_argument("pastaSaida", help="pasta da saida final")
+    ap.add_argument("--etapas", default=",".join(ETAPAS),
+        help="etapas separadas por virgula, na ordem: " + ",".join(ETAPAS) +
+             "; " + ETAPA_ILUMINACAO + " no lugar de ace,retinex,clahe escolhe por imagem")
+    ap.add_argument("--limiares",
+        help="etapa " + ETAPA_ILUMINACAO + ": JSON com os limiares (illumination_analysis.LIMIARES_PADRAO)")
+    ap.add_argument("--ramos",
+        help="etapa " + ETAPA_ILUMINACAO + ": grava o ramo escolhido para cada imagem neste jsonl")
+    ap.add_argument("--prefixo", default="",
+        help="processa apenas as imagens com esse prefixo")
+    ap.add_argument("--intermediarios",
+        help="grava a saida de cada etapa em <pasta>/<etapa>/ (para depurar)")
+    ap.add_argument("--extensao", default=".png",
+        help="extensao (formato) da saida final")
+    ap.add_argument("--shard", type=parseShard,
+        help="i/N: processa so a parte i de N das imagens (hash do nome)")
+    ap.add_argument("--prefetch", type=int, default=8,
+        help="imagens lidas a frente, em threads (limita a memoria)")
+    ap.add_argument("--cascPath", default="haarcascade_frontalface_default.xml")
+    ap.add_argument("--minSize", type=int, default=72)
+    ap.add_argument("--perfil",
+        help="JSON do detector_tuning.py (parametros do detectMultiScale); o minSize vem dele")
+    ap.add_argument("--busca", choices=["exaustiva", "coarse"], default="exaustiva")
+    ap.add_argument("--ordemAdaptativa", action="store_true",
+        help="testa primeiro os angulos que mais encontraram faces")
+    ap.add_argument("--ladoBusca", type=int, default=800)
+    ap.add_argument("--portao", action="store_true",
+        help="detect: descarta antes da busca as imagens que nao podem ter face (quality_gate.py)")
+    ap.add_argument("--dlibFacePredictor", default="shape_predictor_68_face_landmarks.dat")
+    ap.add_argument("--size", type=int, default=224)
+    ap.add_argument("--engine", default="numpy")
+    ap.add_argument("--ace", choices=["rapido", "colorcorrect"], default="rapido",
+        help="motor do ACE; o colorcorrect e o original, bem mais lento")
+    ap.add_argument("--aceGrau", type=int, default=ACE_GRAU,
+        help="ACE rapido: grau do polinomio da saturacao (mais alto = mais fiel)")
+    ap.add_argument("--aceEscala", type=float, default=ACE_ESCALA,
+        help="ACE rapido: fracao do tamanho usada no termo de contexto (1 = cheia)")
+    ap.add_argument("--retinex", choices=["maximo", "msr", "colorcorrect"], default="maximo",
+        help="maximo: o retinex do colorcorrect em numpy; msr: retinex multi-escala")
+    ap.add_argument("--metricas",
+        help="grava o tempo de cada etapa em <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    ap.add_argument("--intervaloMetricas", type=float, default=30,
+        help="segundos entre as gravacoes das metricas")
+    args = vars(ap.parse_args())
+    if args["metricas"]:
+        metricas.configura(args["metricas"], args["intervaloMetricas"])
+
+    nomesEtapas = [e.strip() for e in args["etapas"].split(",") if e.strip()]
+    perfil = carregaPerfil(args["perfil"]) if args["perfil"] else None
+    opcoes = {'cascPath': args["cascPath"], 'minSize': perfil['minSize'] if perfil else args["minSize"],
+              'perfil': perfil,
+              'busca': args["busca"], 'ladoBusca': args["ladoBusca"], 'portao': args["portao"],
+              'ordemAdaptativa': args["ordemAdaptativa"],
+              'facePredictor': args["dlibFacePredictor"], 'tamanho': args["size"],
+              'engine': args["engine"], 'motorACE': args["ace"],
+              'aceGrau': args["aceGrau"], 'aceEscala': args["aceEscala"],
+              'motorRetinex': args["retinex"],
+              'limiares': carregaLimiares(args["limiares"]) if args["limiares"] else None,
+              'diarioRamos': open(args["ramos"], 'w') if args["ramos"] else None}
+    pipeline = Pipeline(criaEtapas(nomesEtapas, opcoes), args["intermediarios"])
+
+    if not os.path.isdir(args["pastaSaida"]):
+        os.makedirs(args["pastaSaida"])
+
+    start_time = time.time()
+    count = 1
+    countOK = 0
+    arquivos = [f for f in sorted(os.listdir(args["pastaEntrada"])) if f.startswith(args["prefixo"])]
+    arquivos = filtraShard(arquivos, args["shard"])
+    leitor = PrefetchReader([(f, os.path.join(args["pastaEntrada"], f)) for f in arquivos],
+                            leDocumento, emVoo=args["prefetch"])
+    for file, bgr in leitor:
+        if bgr is None:
+            print("{0} > {1}: nao foi possivel ler".format(count, file))
+        else:
+            final, parou = pipeline.processa(file, bgr)
+            if final is None:
+                print("{0} > {1}: parou em {2}".format(count, file, parou))
+                metricas.conta("imagens", resultado="parou", etapa=parou)
+            else:
+                with metricas.tempo("write"):
+                    cv2.imwrite(os.path.join(args["pastaSaida"], nomeSaida(file, args["extensao"])), final)
+                countOK = countOK + 1
+                metricas.conta("imagens", resultado="ok")
+        count = count + 1
+        metricas.gravaPeriodico()
+    metricas.grava()
+    if opcoes['diarioRamos'] is not None:
+        opcoes['diarioRamos'].close()
+
+    print("QTD IMAGENS: {0}, OK: {1}".format(count - 1, countOK))
+    print("TEMPO DE EXECUCAO: %s segundos." % (time.time() - start_time))
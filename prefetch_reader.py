@@ -0,0 +1,66 @@
+# LEITURA ANTECIPADA DE IMAGENS EM THREADS
+#
+# prefetch_reader.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# ENQUANTO O LACO PRINCIPAL PROCESSA UMA IMAGEM, AS PROXIMAS JA ESTAO SENDO
+# LIDAS E DECODIFICADAS (O cv2.imread SOLTA O GIL). NO MAXIMO `emVoo` IMAGENS
+# FICAM EM MEMORIA ESPERANDO A VEZ.
+
+import cv2
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+
+class PrefetchReader:
+    """
+    Itera (nome, imagem) na mesma ordem de `itens`, decodificando a frente.
+
+    Uso:
+
+        for nome, image in PrefetchReader([(f, pasta + f) for f in arquivos]):
+            ...
+
+    :param itens: sequencia de (nome, argumento); `decodifica(argumento)`
+                  devolve a imagem (ou None, se nao deu para ler).
+    :param decodifica: funcao de leitura; o padrao e cv2.imread (BGR).
+    :param threads: threads de leitura.
+    :param emVoo: maximo de imagens lidas e ainda nao entregues.
+    """
+
+    def __init__(self, itens, decodifica=cv2.imread, threads=2, emVoo=8):
+        self.itens = itens
+        self.decodifica = decodifica
+        self.threads = max(threads, 1)
+        self.emVoo = max(emVoo, 1)
+
+    def _le(self, argumento):
+        try:
+            return self.decodifica(argumento)
+        except Exception:
+            # ARQUIVO CORROMPIDO OU SUMIU: QUEM CONSOME DECIDE O QUE FAZER COM O None
+            return None
+
+    def __iter__(self):
+        pool = ThreadPool(self.threads)
+        pendentes = deque()
+        itens = iter(self.itens)
+        try:
+            for nome, argumento in itens:
+                pendentes.append((nome, pool.apply_async(self._le, (argumento,))))
+                if len(pendentes) >= self.emVoo:
+                    break
+            while pendentes:
+                nome, leitura = pendentes.popleft()
+                image = leitura.get()
+                # ABRE A VAGA ANTES DE ENTREGAR, PARA A LEITURA SEGUIR DURANTE O PROCESSAMENTO
+                for proximoNome, argumento in itens:
+                    pendentes.append((proximoNome, pool.apply_async(self._le, (argumento,))))
+                    break
+                yield nome, image
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,128 @@
+# PORTAO DE QUALIDADE ANTES DA BUSCA COM ROTACAO
+#
+# quality_gate.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# O DOCUMENTO E REDUZIDO ATE A FACE DE minSize VIRAR A JANELA DO CASCADE (24
+# PIXELS NO FRONTALFACE): E A RESOLUCAO MAIS FINA QUE O DETECTOR OLHA. SE NESSA
+# MINIATURA NAO HA CONTRASTE NEM DETALHE EM NENHUM BLOCO DO TAMANHO DA JANELA,
+# NENHUM DOS 15 ANGULOS VAI ACHAR FACE E O DOCUMENTO VAI DIRETO PARA O FAIL.
+#
+# OS LIMIARES SAO CONSERVADORES: SO CAI NO PORTAO O QUE NAO TEM CHANCE (PAGINA
+# EM BRANCO, QUASE PRETA, DESFOCADA A PONTO DE NAO SOBRAR BORDA, MENOR QUE A FACE).
+
+import cv2
+import numpy as np
+import metricas
+
+# MOTIVOS (VAO PARA O out_DOC_FAIL E PARA O DIARIO)
+ILEGIVEL = "ILEGIVEL"
+PEQUENA = "PEQUENA"
+ESCURA = "ESCURA"
+EM_BRANCO = "EM_BRANCO"
+SEM_CONTRASTE = "SEM_CONTRASTE"
+BORRADA = "BORRADA"
+
+MOTIVOS = [ILEGIVEL, PEQUENA, ESCURA, EM_BRANCO, SEM_CONTRASTE, BORRADA]
+
+JANELA = 24             # LADO DA JANELA DO haarcascade_frontalface_default
+LIMIAR_CONTRASTE = 16   # p99.9 - p0.1 DOS TONS DE CINZA NA MINIATURA
+LIMIAR_NITIDEZ = 1.0    # VARIANCIA DO LAPLACIANO NO BLOCO MAIS NITIDO (nitidezMaxima)
+
+
+def miniatura(image, minSize, reducao=1):
+    """
+    Cinza, na escala em que uma face de `minSize` pixels do documento ocupa
+    JANELA pixels. Nunca amplia.
+
+    :param reducao: a imagem ja veio decodificada em 1/reducao (leDocumento).
+    """
+    h, w = image.shape[:2]
+    escala = min(1.0, float(JANELA) * reducao / minSize)
+    if escala < 1.0:
+        image = cv2.resize(image, (max(1, int(w * escala)), max(1, int(h * escala))),
+                           interpolation=cv2.INTER_AREA)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def nitidezMaxima(gray):
+    """
+    Variancia do laplaciano bloco a bloco (blocos de JANELA x JANELA), na
+    maior de todas as escalas, da miniatura (pulada: o arredondamento para
+    uint8 sozinho ja da ~2) ate o documento inteiro caber numa janela.
+    Por bloco, para uma face pequena numa pagina lisa ainda contar; por
+    escala, porque uma face grande continua detectavel com muito mais
+    desfoque que uma de minSize.
+    """
+    maxima = 0.0
+    nivel = cv2.pyrDown(np.float32(gray))
+    while min(nivel.shape) >= JANELA:
+        h, w = nivel.shape
+        h, w = h - h % JANELA, w - w % JANELA
+        laplaciano = cv2.Laplacian(nivel[:h, :w], cv2.CV_32F)
+        blocos = laplaciano.reshape(h // JANELA, JANELA, w // JANELA, JANELA)
+        maxima = max(maxima, float(blocos.var(axis=(1, 3)).max()))
+        nivel = cv2.pyrDown(nivel)
+    return maxima
+
+
+def estatisticas(image, minSize, reducao=1):
+    """
+    :return: dict com lado (menor lado do documento, em pixels da leitura
+             cheia), p0.1, p99.9, media e nitidez (nitidezMaxima; None se a
+             miniatura e pequena demais para medir) da miniatura.
+    """
+    lado = min(image.shape[:2]) * reducao
+    gray = miniatura(image, minSize, reducao)
+    baixo, alto = np.percentile(gray, (0.1, 99.9))
+    return {
+        'lado': int(lado),
+        'p0.1': float(baixo),
+        'p99.9': float(alto),
+        'media': float(gray.mean()),
+        'nitidez': nitidezMaxima(gray) if min(gray.shape) >= 2 * JANELA else None,
+    }
+
+
+def avaliaQualidade(image, minSize, reducao=1, limiarContraste=LIMIAR_CONTRASTE, limiarNitidez=LIMIAR_NITIDEZ):
+    """
+    :param image: documento decodificado (BGR, ou cinza reduzido) ou None.
+    :return: None se vale a pena procurar a face, senao o motivo (MOTIVOS).
+    """
+    if image is None or image.size == 0:
+        return ILEGIVEL
+    with metricas.tempo("portao"):
+        if min(image.shape[:2]) * reducao < minSize:
+            return PEQUENA
+        dados = estatisticas(image, minSize, reducao)
+        if dados['p99.9'] - dados['p0.1'] < limiarContraste:
+            if dados['media'] < 64:
+                return ESCURA
+            if dados['media'] > 192:
+                return EM_BRANCO
+            return SEM_CONTRASTE
+        if dados['nitidez'] is not None and dados['nitidez'] < limiarNitidez:
+            return BORRADA
+    return None
+
+
+def marcaMotivo(motivo):
+    # SUFIXO DA LINHA NO out_DOC_FAIL
+    return ' (PORTAO: ' + motivo + ')' if motivo else ''
+
+
+def resumo(rejeitados):
+    """
+    :param rejeitados: dict motivo -> quantidade.
+    :return: texto para o out_rel_final.
+    """
+    texto = "QTD DOC REJEITADOS NO PORTAO:" + str(sum(rejeitados.values())) + "\n"
+    for motivo in MOTIVOS:
+        if rejeitados.get(motivo):
+            texto += "  " + motivo + ": " + str(rejeitados[motivo]) + "\n"
+    return texto + "\n"
@@ -0,0 +1,200 @@
+# FACES DE TAMANHO FIXO EM SHARDS .npy (EM VEZ DE UM ARQUIVO POR FACE)
+#
+# shard_store.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# LAYOUT DA PASTA:
+#   shards.json          forma, dtype e ordem dos canais (BGR, como o cv2.imread)
+#   shard_00000.npy      (N, H, W, 3) uint8, aberto com memmap
+#   indice.jsonl         uma linha por face: nome, classe, shard e posicao (gravada
+#                        logo depois da face; ao reabrir, uma ultima linha pela
+#                        metade e cortada)
+#
+# LEITURA SEM COPIA:
+#   leitor = ShardReader("pessoas_224_shards/")
+#   for nome, classe, face in leitor:   # face e uma view do memmap
+#       ...
+
+import json, os
+import numpy as np
+
+NOME_META = "shards.json"
+NOME_INDICE = "indice.jsonl"
+
+
+def nomeShard(numero):
+    return "shard_{0:05d}.npy".format(numero)
+
+
+def encolheShard(caminho, quantidade, forma, inicioDados):
+    """
+    Reescreve o cabecalho do .npy para `quantidade` faces, com o mesmo
+    tamanho de cabecalho (os dados nao saem do lugar), e corta o arquivo.
+
+    :param inicioDados: onde comecam os dados (o `offset` do memmap).
+    """
+    with open(caminho, 'r+b') as f:
+        versao = np.lib.format.read_magic(f)
+        # MAGICA (6) + VERSAO (2) + TAMANHO DO CABECALHO (2 NA 1.0, 4 NA 2.0)
+        inicioCabecalho = 8 + (2 if versao == (1, 0) else 4)
+        cabecalho = "{{'descr': '|u1', 'fortran_order': False, 'shape': {0!r}, }}".format(
+            (quantidade,) + tuple(forma))
+        cabecalho = cabecalho.ljust(inicioDados - inicioCabecalho - 1) + "\n"
+        f.seek(inicioCabecalho)
+        f.write(cabecalho.encode('latin1'))
+        f.truncate(inicioDados + quantidade * int(np.prod(forma)))
+
+
+class ShardWriter:
+    """
+    Acrescenta faces de tamanho fixo em shards .npy mapeados em memoria.
+
+    Ao reabrir uma pasta existente, continua num shard novo e `contem`
+    responde pelas faces ja gravadas, para quem quiser pular.
+
+    :param pasta: pasta dos shards (criada se nao existir).
+    :param forma: (H, W, 3) das faces; None = a forma da primeira face.
+    :param tamanhoShard: faces por shard.
+    """
+
+    def __init__(self, pasta, forma=None, tamanhoShard=4096):
+        self.pasta = pasta
+        if not os.path.isdir(pasta):
+            os.makedirs(pasta)
+        self.tamanhoShard = tamanhoShard
+        self.forma = tuple(forma) if forma is not None else None
+        self.gravados = set()
+        self.numeroShard = 0
+
+        caminhoMeta = os.path.join(pasta, NOME_META)
+        if os.path.isfile(caminhoMeta):
+            with open(caminhoMeta) as f:
+                meta = json.load(f)
+            if self.forma is not None and tuple(meta['forma']) != self.forma:
+                raise ValueError("shards em {0} tem forma {1}, nao {2}".format(pasta, meta['forma'], self.forma))
+            self.forma = tuple(meta['forma'])
+        entradas, fimIndice = leIndiceComFim(pasta)
+        for entrada in entradas:
+            self.gravados.add((entrada['classe'], entrada['nome']))
+            self.numeroShard = max(self.numeroShard, entrada['shard'] + 1)
+
+        caminhoIndice = os.path.join(pasta, NOME_INDICE)
+        if os.path.isfile(caminhoIndice) and os.path.getsize(caminhoIndice) > fimIndice:
+            # QUEDA NO MEIO DE UMA LINHA: SEM CORTAR, A PRIMEIRA ENTRADA NOVA GRUDA NELA
+            with open(caminhoIndice, 'r+b') as f:
+                f.truncate(fimIndice)
+        self.fIndice = open(caminhoIndice, 'a')
+        self.atual = None
+        self.posicao = 0
+
+    def contem(self, nome, classe=""):
+        return (classe, nome) in self.gravados
+
+    def adiciona(self, nome, imagem, classe=""):
+        """
+        :param imagem: (H, W, 3) uint8, na forma do shard.
+        """
+        if self.forma is None:
+            self.forma = tuple(imagem.shape)
+        if tuple(imagem.shape) != self.forma:
+            raise ValueError("{0}: forma {1}, o shard e {2}".format(nome, imagem.shape, self.forma))
+        if self.atual is None:
+            self._abreShard()
+        self.atual[self.posicao] = imagem
+        self.fIndice.write(json.dumps({'nome': nome, 'classe': classe,
+                                       'shard': self.numeroShard, 'posicao': self.posicao}) + "\n")
+        # A FACE JA ESTA NO MEMMAP; A LINHA SAI INTEIRA, NUNCA PELA METADE DO BUFFER
+        self.fIndice.flush()
+        self.gravados.add((classe, nome))
+        self.posicao += 1
+        if self.posicao == self.tamanhoShard:
+            self._fechaShard()
+
+    def _abreShard(self):
+        caminhoMeta = os.path.join(self.pasta, NOME_META)
+        if not os.path.isfile(caminhoMeta):
+            with open(caminhoMeta, 'w') as f:
+                json.dump({'forma': list(self.forma), 'dtype': 'uint8', 'ordem': 'BGR'}, f)
+        self.atual = np.lib.format.open_memmap(
+            os.path.join(self.pasta, nomeShard(self.numeroShard)), mode='w+',
+            dtype=np.uint8, shape=(self.tamanhoShard,) + self.forma)
+        self.posicao = 0
+
+    def _fechaShard(self):
+        self.atual.flush()
+        inicioDados = self.atual.offset
+        del self.atual
+        self.atual = None
+        if self.posicao < self.tamanhoShard:
+            encolheShard(os.path.join(self.pasta, nomeShard(self.numeroShard)), self.posicao,
+                         self.forma, inicioDados)
+        self.fIndice.flush()
+        self.numeroShard += 1
+        self.posicao = 0
+
+    def close(self):
+        if self.atual is not None:
+            self._fechaShard()
+        self.fIndice.close()
+
+
+def leIndiceComFim(pasta):
+    """
+    :return: (entradas, tamanho) - as linhas completas do indice e o byte
+             onde termina a ultima delas.
+    """
+    entradas = []
+    tamanho = 0
+    caminho = os.path.join(pasta, NOME_INDICE)
+    if not os.path.isfile(caminho):
+        return entradas, tamanho
+    with open(caminho, 'rb') as f:
+        for linha in f:
+            if not linha.endswith(b"\n"):
+                break  # ULTIMA LINHA INCOMPLETA
+            try:
+                entradas.append(json.loads(linha.decode('utf-8')))
+            except ValueError:
+                break
+            tamanho += len(linha)
+    return entradas, tamanho
+
+
+def leIndice(pasta):
+    return leIndiceComFim(pasta)[0]
+
+
+class ShardReader:
+    """
+    Le os shards sem copiar: cada face devolvida e uma view do memmap.
+    """
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        with open(os.path.join(pasta, NOME_META)) as f:
+            self.meta = json.load(f)
+        self.indice = leIndice(pasta)
+        self.posicoes = dict(((e['classe'], e['nome']), i) for i, e in enumerate(self.indice))
+        self.shards = {}
+
+    def shard(self, numero):
+        if numero not in self.shards:
+            self.shards[numero] = np.load(os.path.join(self.pasta, nomeShard(numero)), mmap_mode='r')
+        return self.shards[numero]
+
+    def __len__(self):
+        return len(self.indice)
+
+    def __getitem__(self, i):
+        entrada = self.indice[i]
+        return self.shard(entrada['shard'])[entrada['posicao']]
+
+    def busca(self, nome, classe=""):
+        return self[self.posicoes[(classe, nome)]]
+
+    def __iter__(self):
+        for entrada in self.indice:
+            yield entrada['nome'], entrada['classe'], self.shard(entrada['shard'])[entrada['posicao']]
@@ -0,0 +1,220 @@
+# WARP ENGINES FOR align-dlib.py
+#
+# warp_engines.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# The three resampling paths used by AlignDlib.align. They only need numpy and
+# cv2, so the numeric check below runs without dlib or a landmark model:
+#
+# python warp_engines.py
+# python warp_engines.py --cases 200 --seed 7
+
+import argparse
+import sys
+
+import cv2
+import numpy as np
+
+#: Largest per-pixel difference between `warpNumpy` and `warpLoop`. The loop
+#: mixes numpy float32 scalars with Python floats: numpy 2 keeps that in
+#: float32, like `warpNumpy`, while numpy 1.x promotes it to float64, so the
+#: final truncation to uint8 can land one level apart.
+NUMPY_TOLERANCE = 1
+
+
+def warpLoop(rgbImg, H, imgDim):
+    """
+    Reference per-pixel resampling. Note the thumbnail is indexed
+    `thumbnail[x][y]`, so output rows follow x.
+    """
+    imgWidth = np.shape(rgbImg)[0]
+    imgHeight = np.shape(rgbImg)[1]
+    thumbnail = np.zeros((imgDim, imgDim,3), np.uint8)
+
+    #interpolation from input image to output pixels using transformation mat H to compute
+    #which input coordinates map to output
+    for y in range(imgDim):
+        for x in range(imgDim):
+            xprime = x * H[0][1] + y * H[0][0] + H[0][2]
+            yprime = x * H[1][1] + y * H[1][0] + H[1][2]
+            tx = int(xprime)
+            ty = int(yprime)
+            horzOffset = 1
+            vertOffset = 1
+            if(tx < 0 or tx >= imgWidth or ty < 0 or ty >= imgHeight):
+                continue
+            if(tx == imgWidth - 1):
+                horzOffset = 0
+            if(ty == imgHeight - 1):
+                vertOffset = 0
+            f1 = xprime - float(tx)
+            f2 = yprime - float(ty)
+            upperLeft = rgbImg[ty][tx]
+            upperRight = rgbImg[ty][tx + horzOffset]
+            bottomLeft = rgbImg[ty + vertOffset][tx]
+            bottomRight = rgbImg[ty + vertOffset][tx + horzOffset]
+
+            thumbnail[x][y][0] = upperLeft[0] * (1.0 - f1) * (1.0 - f2) + upperRight[0] * f1 * (1.0 - f2) + bottomLeft[0] * (1.0 - f1) * f2 + bottomRight[0] * f1 * f2
+            thumbnail[x][y][1] = upperLeft[1] * (1.0 - f1) * (1.0 - f2) + upperRight[1] * f1 * (1.0 - f2) + bottomLeft[1] * (1.0 - f1) * f2 + bottomRight[1] * f1 * f2
+            thumbnail[x][y][2] = upperLeft[2] * (1.0 - f1) * (1.0 - f2) + upperRight[2] * f1 * (1.0 - f2) + bottomLeft[2] * (1.0 - f1) * f2 + bottomRight[2] * f1 * f2
+
+    return thumbnail
+
+
+def warpNumpy(rgbImg, H, imgDim, out=None):
+    """
+    Vectorized version of `warpLoop` with the same float32 arithmetic,
+    truncation, bounds test and edge clamping, so both paths agree within
+    `NUMPY_TOLERANCE` on every pixel (exactly under numpy 2).
+
+    Inputs where the loop would index past the image (its bounds test
+    swaps width and height, which only matters for non-square images)
+    are clamped to the last row/column instead of raising.
+
+    :param out: Optional preallocated (imgDim, imgDim, 3) uint8 buffer.
+    """
+    imgWidth = np.shape(rgbImg)[0]
+    imgHeight = np.shape(rgbImg)[1]
+    if out is None:
+        out = np.zeros((imgDim, imgDim, 3), np.uint8)
+    else:
+        out[...] = 0
+
+    # First index of the thumbnail is x, second is y.
+    x, y = np.meshgrid(np.arange(imgDim, dtype=np.float32),
+                       np.arange(imgDim, dtype=np.float32), indexing='ij')
+    xprime = x * H[0][1] + y * H[0][0] + H[0][2]
+    yprime = x * H[1][1] + y * H[1][0] + H[1][2]
+    tx = np.trunc(xprime).astype(np.int64)
+    ty = np.trunc(yprime).astype(np.int64)
+
+    inside = (tx >= 0) & (tx < imgWidth) & (ty >= 0) & (ty < imgHeight)
+    xprime, yprime, tx, ty = xprime[inside], yprime[inside], tx[inside], ty[inside]
+    horzOffset = (tx != imgWidth - 1).astype(np.int64)
+    vertOffset = (ty != imgHeight - 1).astype(np.int64)
+    f1 = (xprime - tx.astype(np.float32))[:, None]
+    f2 = (yprime - ty.astype(np.float32))[:, None]
+
+    lastRow, lastCol = rgbImg.shape[0] - 1, rgbImg.shape[1] - 1
+    top = np.minimum(ty, lastRow)
+    bottom = np.minimum(ty + vertOffset, lastRow)
+    left = np.minimum(tx, lastCol)
+    right = np.minimum(tx + horzOffset, lastCol)
+    upperLeft = rgbImg[top, left, :3].astype(np.float32)
+    upperRight = rgbImg[top, right, :3].astype(np.float32)
+    bottomLeft = rgbImg[bottom, left, :3].astype(np.float32)
+    bottomRight = rgbImg[bottom, right, :3].astype(np.float32)
+
+    one = np.float32(1.0)
+    out[inside] = (upperLeft * (one - f1) * (one - f2) + upperRight * f1 * (one - f2) +
+                   bottomLeft * (one - f1) * f2 + bottomRight * f1 * f2).astype(np.uint8)
+    return out
+
+
+def warpCv2(rgbImg, H, imgDim):
+    """
+    Single `cv2.warpAffine` call. H already maps (column, row) of the
+    thumbnail to input (x, y), which is what WARP_INVERSE_MAP expects.
+    Faster than `warpNumpy` but rounds instead of truncating and blends
+    the last row/column with black, so it is not pixel-exact.
+    """
+    return cv2.warpAffine(rgbImg, H, (imgDim, imgDim),
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def randomTransform(rng, imgDim, maxOffset):
+    """
+    Random similarity in the layout `transformMatrix` produces: H maps the
+    thumbnail position (y, x) to the input position (xprime, yprime).
+    """
+    scale = rng.uniform(0.6, 1.6)
+    angle = rng.uniform(-0.5, 0.5)
+    c, s = scale * np.cos(angle), scale * np.sin(angle)
+    return np.float32([[c, -s, rng.uniform(0, maxOffset)],
+                       [s, c, rng.uniform(0, maxOffset)]])
+
+
+def randomImage(rng, height, width):
+    # Smooth content, like a face crop, so bilinear rounding stays small.
+    noise = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), 2)
+
+
+def interiorMask(H, imgDim, imgHeight, imgWidth):
+    """
+    Thumbnail pixels whose four bilinear neighbours are all inside the input.
+    `warpCv2` blends the last row/column with the black border and rounds
+    instead of truncating, so it is only compared there.
+    """
+    x, y = np.meshgrid(np.arange(imgDim, dtype=np.float32),
+                       np.arange(imgDim, dtype=np.float32), indexing='ij')
+    xprime = x * H[0][1] + y * H[0][0] + H[0][2]
+    yprime = x * H[1][1] + y * H[1][0] + H[1][2]
+    return ((xprime >= 0) & (xprime <= imgWidth - 2) &
+            (yprime >= 0) & (yprime <= imgHeight - 2))
+
+
+def checkEngines(cases=50, seed=0, imgDim=48, size=96, tolerance=2, numpyTolerance=NUMPY_TOLERANCE):
+    """
+    Compare `warpNumpy` (within `numpyTolerance` on every pixel) and
+    `warpCv2` (within `tolerance` on interior pixels) with `warpLoop` on
+    synthetic images and matrices. The loop runs twice, with H in float32
+    and in float64, to cover both numpy 2 and the wider arithmetic numpy 1.x
+    uses for it. The last case is a non-square image with H kept inside it,
+    since `warpLoop` raises when a non-square input is sampled past its
+    shorter side.
+
+    :return: List of failure messages; empty when every engine agrees.
+    """
+    rng = np.random.RandomState(seed)
+    failures = []
+    for case in range(cases + 1):
+        if case < cases:
+            rgbImg = randomImage(rng, size, size)
+            H = randomTransform(rng, imgDim, size - imgDim)
+        else:
+            rgbImg = randomImage(rng, size, size + size // 2)
+            H = np.float32([[0.9, 0.1, 10], [-0.1, 0.9, 15]])
+
+        reference = warpLoop(rgbImg, H, imgDim)
+        out = warpNumpy(rgbImg, H, imgDim)
+        for dtype in (np.float32, np.float64):
+            loop = reference if dtype is np.float32 else warpLoop(rgbImg, H.astype(dtype), imgDim)
+            diff = np.abs(loop.astype(np.int16) - out).max()
+            if diff > numpyTolerance:
+                failures.append("case {}: numpy differs from the {} loop by {}".format(
+                    case, np.dtype(dtype).name, diff))
+        reused = np.full((imgDim, imgDim, 3), 255, np.uint8)
+        if not np.array_equal(out, warpNumpy(rgbImg, H, imgDim, out=reused)):
+            failures.append("case {}: numpy with out= differs from numpy".format(case))
+
+        inside = interiorMask(H, imgDim, rgbImg.shape[0], rgbImg.shape[1])
+        diff = np.abs(reference.astype(np.int16) - warpCv2(rgbImg, H, imgDim))[inside]
+        if diff.size and diff.max() > tolerance:
+            failures.append("case {}: cv2 differs from loop by {} on interior pixels".format(
+                case, diff.max()))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Check warpNumpy and warpCv2 against warpLoop on synthetic data.")
+    parser.add_argument('--cases', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=48, help="Thumbnail size.")
+    parser.add_argument('--tolerance', type=int, default=2,
+                        help="Largest accepted cv2 difference on interior pixels.")
+    parser.add_argument('--numpyTolerance', type=int, default=NUMPY_TOLERANCE,
+                        help="Largest accepted numpy difference on any pixel.")
+    args = parser.parse_args()
+
+    failures = checkEngines(args.cases, args.seed, args.size, 2 * args.size, args.tolerance,
+                            args.numpyTolerance)
+    for failure in failures:
+        print("  + " + failure)
+    print("{} cases, {} failures".format(args.cases + 1, len(failures)))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,221 @@
+# SERVICO QUE VIGIA UMA PASTA DE ENTRADA E PROCESSA CADA DOCUMENTO NA HORA
+#
+# watch_service.py
+#
+# Copyright 2017
+#   Johnatan Oliveira (johnoliv@gmail.com)
+#   www.johnatan.net
+
+# CASCADE, AlignDlib (shape predictor + HOG) E EFEITOS SAO CARREGADOS UMA VEZ;
+# DEPOIS E SO LER, PROCESSAR (pipeline.py) E GRAVAR CADA ARQUIVO QUE CHEGA.
+#
+# python watch_service.py entrada/ saida/ --dlibFacePredictor shape_predictor_68_face_landmarks.dat
+#
+# QUEM ENTREGA DEVE GRAVAR COM UM NOME TEMPORARIO (.tmp/.part) E RENOMEAR, OU
+# SIMPLESMENTE COPIAR: UM ARQUIVO SO E PEGO QUANDO O TAMANHO E O mtime PARAM
+# DE MUDAR ENTRE DUAS VARREDURAS. DEPOIS DE PROCESSADO, O ORIGINAL VAI PARA
+# entrada/processados/ (OU entrada/falhas/). A LATENCIA DE CADA DOCUMENTO
+# (DA CHEGADA ATE A SAIDA GRAVADA) VAI PARA O TERMINAL E PARA latencias.jsonl.
+
+import argparse
+import cv2, json, os, shutil, signal, threading, time, traceback
+import numpy as np
+import metricas
+from face_scan import leDocumento
+from effects import ACE_GRAU, ACE_ESCALA
+from face_detector import carregaPerfil
+from pipeline import ETAPAS, Pipeline, criaEtapas, nomeSaida
+
+EXTENSOES_TEMPORARIAS = (".tmp", ".part", ".crdownload")
+PASTA_PROCESSADOS = "processados"
+PASTA_FALHAS = "falhas"
+
+
+class WatchService:
+    """
+    Vigia `pastaEntrada` por varredura (os.listdir a cada `intervalo`
+    segundos, sem dependencias) e passa cada documento novo pelo Pipeline.
+
+    Para testes: `processaPendentes()` faz uma varredura so; `roda()` em
+    uma thread e `para()` de outra.
+
+    :param pipeline: Pipeline ja montado (modelos carregados).
+    :param arquivoLatencias: jsonl com uma linha por documento; None nao grava.
+    """
+
+    def __init__(self, pipeline, pastaEntrada, pastaSaida, extensao=".png", intervalo=0.2,
+                 arquivoLatencias=None):
+        self.pipeline = pipeline
+        self.pastaEntrada = pastaEntrada
+        self.pastaSaida = pastaSaida
+        self.extensao = extensao
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.vistos = {}        # nome -> (tamanho, mtime, chegada)
+        self.naoMovidos = set() # (nome, tamanho, mtime) processados que nao sairam da pasta
+        self.latencias = []
+        for pasta in (pastaSaida, os.path.join(pastaEntrada, PASTA_PROCESSADOS),
+                      os.path.join(pastaEntrada, PASTA_FALHAS)):
+            if not os.path.isdir(pasta):
+                os.makedirs(pasta)
+        self.fLatencias = open(arquivoLatencias, 'a') if arquivoLatencias else None
+
+    def prontos(self):
+        """
+        :return: arquivos cujo tamanho e mtime nao mudaram desde a varredura
+                 anterior, na ordem de chegada. Os que ja foram processados
+                 mas nao puderam ser movidos ficam de fora ate mudarem.
+        """
+        agora = time.time()
+        prontos = []
+        presentes = set()
+        for nome in os.listdir(self.pastaEntrada):
+            caminho = os.path.join(self.pastaEntrada, nome)
+            if nome.startswith(".") or nome.endswith(EXTENSOES_TEMPORARIAS) or not os.path.isfile(caminho):
+                continue
+            presentes.add(nome)
+            try:
+                estado = os.stat(caminho)
+            except OSError:
+                continue  # RENOMEADO OU APAGADO NO MEIO DA VARREDURA
+            if (nome, estado.st_size, estado.st_mtime) in self.naoMovidos:
+                continue
+            anterior = self.vistos.get(nome)
+            # TAMANHO SO NAO BASTA: QUEM PREALOCA O ARQUIVO ESCREVE SEM MUDAR O TAMANHO
+            if anterior is None or anterior[:2] != (estado.st_size, estado.st_mtime):
+                # A CHEGADA CONTA DO mtime (QUANDO TERMINOU DE SER ESCRITO), NAO DA VARREDURA
+                self.vistos[nome] = (estado.st_size, estado.st_mtime, min(agora, estado.st_mtime))
+            else:
+                prontos.append((anterior[2], nome))
+        for nome in list(self.vistos):
+            if nome not in presentes:
+                del self.vistos[nome]
+        self.naoMovidos = set(chave for chave in self.naoMovidos if chave[0] in presentes)
+        return [nome for chegada, nome in sorted(prontos)]
+
+    def processa(self, nome):
+        caminho = os.path.join(self.pastaEntrada, nome)
+        tamanho, mtime, chegada = self.vistos.pop(nome)
+        inicio = time.time()
+        erro = None
+        try:
+            bgr = leDocumento(caminho)
+            if bgr is None:
+                final, parou = None, "leitura"
+            else:
+                final, parou = self.pipeline.processa(nome, bgr)
+            if final is not None:
+                with metricas.tempo("write"):
+                    cv2.imwrite(os.path.join(self.pastaSaida, nomeSaida(nome, self.extensao)), final)
+        except Exception as e:
+            # UM DOCUMENTO RUIM NAO DERRUBA O SERVICO: VAI PARA falhas/ E SEGUE
+            traceback.print_exc()
+            final, parou, erro = None, "erro", "{0}: {1}".format(type(e).__name__, e)
+        fim = time.time()
+
+        destino = PASTA_PROCESSADOS if final is not None else PASTA_FALHAS
+        try:
+            shutil.move(caminho, os.path.join(self.pastaEntrada, destino, nome))
+        except (IOError, OSError) as e:
+            # SE FICOU NA PASTA (EX.: SEM PERMISSAO EM falhas/), NAO E PROCESSADO DE NOVO ATE MUDAR
+            print("{0}: nao foi possivel mover para {1}/ ({2})".format(nome, destino, e))
+            self.naoMovidos.add((nome, tamanho, mtime))
+
+        registro = {'nome': nome, 'ok': final is not None, 'parou': parou,
+                    'latencia': fim - chegada, 'processamento': fim - inicio, 'quando': fim}
+        if erro is not None:
+            registro['erro'] = erro
+        self.latencias.append(registro['latencia'])
+        metricas.observa("documento", registro['latencia'])
+        metricas.conta("documentos", resultado="ok" if final is not None else "parou")
+        if self.fLatencias is not None:
+            self.fLatencias.write(json.dumps(registro) + "\n")
+            self.fLatencias.flush()
+        print("{0} > {1} em {2:.0f} ms (processamento {3:.0f} ms)".format(
+            nome, "OK" if final is not None else "parou em " + parou,
+            registro['latencia'] * 1000, registro['processamento'] * 1000))
+        return registro
+
+    def processaPendentes(self):
+        """
+        Uma varredura: processa o que ja esta pronto.
+
+        :return: lista dos registros (nome, ok, latencia, ...) processados.
+        """
+        return [self.processa(nome) for nome in self.prontos()]
+
+    def roda(self):
+        try:
+            while not self.parar.is_set():
+                self.processaPendentes()
+                metricas.gravaPeriodico()
+                self.parar.wait(self.intervalo)
+        finally:
+            metricas.grava()
+            if self.fLatencias is not None:
+                self.fLatencias.close()
+
+    def para(self):
+        self.parar.set()
+
+    def resumo(self):
+        if not self.latencias:
+            return "nenhum documento processado"
+        latencias = np.array(self.latencias) * 1000
+        return "{0} documentos, latencia p50 {1:.0f} ms, p90 {2:.0f} ms, max {3:.0f} ms".format(
+            len(latencias), np.percentile(latencias, 50), np.percentile(latencias, 90), latencias.max())
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pastaEntrada", help="pasta vigiada")
+    ap.add_argument("pastaSaida", help="pasta da saida final")
+    ap.add_argument("--etapas", default=",".join(ETAPAS),
+        help="etapas separadas por virgula, na ordem: " + ",".join(ETAPAS))
+    ap.add_argument("--intervalo", type=float, default=0.2,
+        help="segundos entre as varreduras da pasta")
+    ap.add_argument("--extensao", default=".png")
+    ap.add_argument("--latencias", default="latencias.jsonl",
+        help="jsonl com a latencia de cada documento")
+    ap.add_argument("--metricas",
+        help="grava o tempo de cada etapa em <METRICAS>.json e <METRICAS>.prom (node_exporter)")
+    ap.add_argument("--cascPath", default="haarcascade_frontalface_default.xml")
+    ap.add_argument("--minSize", type=int, default=72)
+    ap.add_argument("--perfil",
+        help="JSON do detector_tuning.py (parametros do detectMultiScale); o minSize vem dele")
+    ap.add_argument("--busca", choices=["exaustiva", "coarse"], default="exaustiva")
+    ap.add_argument("--ordemAdaptativa", action="store_true",
+        help="testa primeiro os angulos que mais encontraram faces")
+    ap.add_argument("--ladoBusca", type=int, default=800)
+    ap.add_argument("--portao", action="store_true",
+        help="detect: descarta antes da busca as imagens que nao podem ter face (quality_gate.py)")
+    ap.add_argument("--dlibFacePredictor", default="shape_predictor_68_face_landmarks.dat")
+    ap.add_argument("--size", type=int, default=224)
+    ap.add_argument("--engine", default="numpy")
+    ap.add_argument("--ace", choices=["rapido", "colorcorrect"], default="rapido")
+    ap.add_argument("--retinex", choices=["maximo", "msr", "colorcorrect"], default="maximo")
+    args = vars(ap.parse_args())
+    if args["metricas"]:
+        metricas.configura(args["metricas"])
+
+    inicio = time.time()
+    perfil = carregaPerfil(args["perfil"]) if args["perfil"] else None
+    opcoes = {'cascPath': args["cascPath"], 'minSize': perfil['minSize'] if perfil else args["minSize"],
+              'perfil': perfil,
+              'busca': args["busca"], 'ladoBusca': args["ladoBusca"], 'portao': args["portao"],
+              'ordemAdaptativa': args["ordemAdaptativa"],
+              'facePredictor': args["dlibFacePredictor"], 'tamanho': args["size"],
+              'engine': args["engine"], 'motorACE': args["ace"],
+              'aceGrau': ACE_GRAU, 'aceEscala': ACE_ESCALA, 'motorRetinex': args["retinex"]}
+    nomesEtapas = [e.strip() for e in args["etapas"].split(",") if e.strip()]
+    servico = WatchService(Pipeline(criaEtapas(nomesEtapas, opcoes)), args["pastaEntrada"],
+                           args["pastaSaida"], args["extensao"], args["intervalo"], args["latencias"])
+    print("modelos carregados em {0:.1f}s; vigiando {1}".format(time.time() - inicio, args["pastaEntrada"]))
+
+    # SIGTERM (systemd, docker stop) TERMINA O DOCUMENTO ATUAL E SAI
+    signal.signal(signal.SIGTERM, lambda sinal, quadro: servico.para())
+    try:
+        servico.roda()
+    except KeyboardInterrupt:
+        servico.para()
+    print(servico.resumo())